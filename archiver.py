@@ -0,0 +1,291 @@
+import io
+import os
+import sys
+import glob
+import gzip
+import json
+import argparse
+import datetime
+import psycopg2
+
+from dotenv import load_dotenv
+from batch_writer import copy_unescape
+from partition_manager import PartitionManager, partition_end, partition_name
+
+
+class ArchiveWriter:
+    """ File object for copy_expert that gzips COPY TO output and indexes it
+
+    The data is written as it arrives, so a partition is never held in
+    memory. Complete lines are inspected for their IMEI and timestamp to
+    build the index of the file.
+    """
+
+    def __init__(self, path, columns):
+        self.raw = open(path, "wb")
+        self.file = io.TextIOWrapper(gzip.GzipFile(fileobj=self.raw, mode="wb"), encoding="utf-8", newline="")
+        self.imei_index = columns.index("imei")
+        self.timestamp_index = columns.index("timestamp")
+        self.partial = ""
+        self.rows = 0
+        self.imeis = set()
+        self.first = None
+        self.last = None
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        self.file.write(data)
+
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            fields = line.split("\t")
+            self.rows += 1
+            imei = copy_unescape(fields[self.imei_index])
+            if imei is not None:
+                self.imeis.add(imei)
+            timestamp = copy_unescape(fields[self.timestamp_index])
+            if timestamp is not None:
+                if self.first is None or timestamp < self.first:
+                    self.first = timestamp
+                if self.last is None or timestamp > self.last:
+                    self.last = timestamp
+
+    def close(self):
+        """ Finishes the gzip stream and syncs the file to disk """
+        try:
+            self.file.close()
+            self.raw.flush()
+            os.fsync(self.raw.fileno())
+        finally:
+            self.raw.close()
+
+
+def fsync_directory(directory):
+    """ Makes the renames in directory durable """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def archive_base(directory, table, start):
+    """ Path without extension for a new archive of the range starting at start
+
+    An existing archive is never replaced: rows that arrive for a range
+    after it was archived go to <table>_<start>_2, _3 and so on, each with
+    its own index.
+    """
+    base = os.path.join(directory, partition_name(table, start))
+    candidate, number = base, 1
+    while os.path.exists(candidate + ".tsv.gz") or os.path.exists(candidate + ".json"):
+        number += 1
+        candidate = f"{base}_{number}"
+    return candidate
+
+
+def table_columns(cur, table):
+    cur.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position",
+        (table,),
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def archive_range(conn, source, start, end, directory, table="mqtt"):
+    """ Writes the rows of source from start up to end to a gzipped COPY file
+
+    The rows are streamed with COPY TO in timestamp order into
+    <table>_<start>.tsv.gz, next to it <table>_<start>.json records the
+    columns, the time range, the row count and the IMEIs in the file. Both
+    are written under a temporary name, synced and renamed once complete,
+    and the directory is synced after the renames, so an index always
+    belongs to a complete file and both are on disk before the caller
+    removes the rows. A range that was archived before gets a file with a
+    suffix, see archive_base().
+
+    Args:
+        conn: psycopg2 connection
+        source string: partition or table to read
+        start datetime.date: first day
+        end datetime.date: day after the last
+        directory string: archive directory
+
+    Returns:
+        dict: the index of the file
+    """
+    cur = conn.cursor()
+    columns = table_columns(cur, table)
+    base = archive_base(directory, table, start)
+    writer = ArchiveWriter(base + ".tsv.gz.tmp", columns)
+    try:
+        cur.copy_expert(
+            cur.mogrify(
+                f"COPY (SELECT * FROM {source} WHERE timestamp >= %s AND timestamp < %s ORDER BY timestamp) TO STDOUT",
+                (start, end),
+            ).decode(),
+            writer,
+        )
+    finally:
+        writer.close()
+    conn.commit()
+
+    index = {
+        "file": os.path.basename(base) + ".tsv.gz",
+        "columns": columns,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "first": writer.first,
+        "last": writer.last,
+        "rows": writer.rows,
+        "imeis": sorted(writer.imeis),
+    }
+    with open(base + ".json.tmp", "w") as f:
+        json.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(base + ".tsv.gz.tmp", base + ".tsv.gz")
+    os.replace(base + ".json.tmp", base + ".json")
+    fsync_directory(directory)
+    return index
+
+
+def archive(conn, manager, directory, older_than_days, today=None):
+    """ Archives and removes every closed range that ended older_than_days ago
+
+    A partitioned mqtt is archived partition by partition and each one is
+    detached and dropped after its file is written. A plain mqtt is archived
+    per day and the day is removed with DELETE. Rows are only removed when
+    the file holds as many rows as the range has.
+
+    Returns:
+        list: the indexes of the files written
+    """
+    today = today or datetime.date.today()
+    cutoff = today - datetime.timedelta(days=older_than_days)
+    cur = conn.cursor()
+    written = []
+
+    if manager.is_partitioned(cur):
+        for name, start, end in manager.partitions(cur):
+            if end > cutoff:
+                break
+            index = archive_range(conn, name, start, end, directory, manager.table)
+            cur.execute(f"LOCK TABLE {name} IN ACCESS EXCLUSIVE MODE")
+            cur.execute(f"SELECT count(*) FROM {name}")
+            if cur.fetchone()[0] != index["rows"]:
+                print(f"{name} changed while it was archived, it is kept")
+                conn.commit()
+                continue
+            cur.execute(f"ALTER TABLE {manager.table} DETACH PARTITION {name}")
+            cur.execute(f"DROP TABLE {name}")
+            conn.commit()
+            written.append(index)
+            print(f"{datetime.datetime.now()} - Archived {index['rows']} rows of {name} to {index['file']}")
+        return written
+
+    cur.execute(f"SELECT min(timestamp)::date FROM {manager.table}")
+    first = cur.fetchone()[0]
+    conn.commit()
+    day = first
+    while day is not None and day < cutoff:
+        end = partition_end(day, "day")
+        # Days between the first one and the cutoff may have been archived already and be empty
+        cur.execute(f"SELECT 1 FROM {manager.table} WHERE timestamp >= %s AND timestamp < %s LIMIT 1", (day, end))
+        if cur.fetchone() is None:
+            conn.commit()
+            day = end
+            continue
+        index = archive_range(conn, manager.table, day, end, directory, manager.table)
+        cur.execute(f"DELETE FROM {manager.table} WHERE timestamp >= %s AND timestamp < %s", (day, end))
+        if cur.rowcount != index["rows"]:
+            conn.rollback()
+            print(f"Rows of {day} changed while they were archived, they are kept")
+        else:
+            conn.commit()
+            written.append(index)
+            print(f"{datetime.datetime.now()} - Archived {index['rows']} rows of {day} to {index['file']}")
+        day = end
+    return written
+
+
+def read_indexes(directory):
+    indexes = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(path) as f:
+            indexes.append(json.load(f))
+    return indexes
+
+
+def query(directory, imei=None, start=None, end=None):
+    """ Yields the archived rows of imei with start <= timestamp < end
+
+    Files are picked from their index, so only the files that cover the
+    time range and contain the IMEI are decompressed. Timestamps are
+    compared as ISO strings, "2024-05-01" or "2024-05-01 12:00:00".
+
+    Yields:
+        dict: column name to value, as text
+    """
+    start = start.replace("T", " ") if start else None
+    end = end.replace("T", " ") if end else None
+    for index in read_indexes(directory):
+        if index["rows"] == 0 or index["first"] is None:
+            continue
+        if start and index["last"] < start:
+            continue
+        if end and index["first"] >= end:
+            continue
+        if imei and imei not in index["imeis"]:
+            continue
+
+        columns = index["columns"]
+        imei_index = columns.index("imei")
+        timestamp_index = columns.index("timestamp")
+        with gzip.open(os.path.join(directory, index["file"]), "rt", encoding="utf-8", newline="") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if imei and copy_unescape(fields[imei_index]) != imei:
+                    continue
+                timestamp = copy_unescape(fields[timestamp_index])
+                if start and (timestamp is None or timestamp < start):
+                    continue
+                if end and (timestamp is None or timestamp >= end):
+                    continue
+                yield dict(zip(columns, (copy_unescape(v) for v in fields)))
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Moves old mqtt rows to compressed files and reads them back")
+    parser.add_argument("command", choices=("archive", "query", "list"))
+    parser.add_argument("--dir", default=os.environ.get("ARCHIVE_DIR", "archive"))
+    parser.add_argument("--older-than-days", type=int, default=int(os.environ.get("ARCHIVE_AFTER_DAYS", "90")))
+    parser.add_argument("--imei")
+    parser.add_argument("--from", dest="start", help="query: first timestamp, e.g. 2024-05-01")
+    parser.add_argument("--to", dest="end", help="query: timestamp after the last")
+    args = parser.parse_args()
+
+    if args.command == "query":
+        for row in query(args.dir, args.imei, args.start, args.end):
+            print("\t".join("" if v is None else v for v in row.values()))
+        sys.exit(0)
+
+    if args.command == "list":
+        for index in read_indexes(args.dir):
+            print(f"{index['file']}\t{index['first']}\t{index['last']}\t{index['rows']} rows\t{len(index['imeis'])} devices")
+        sys.exit(0)
+
+    os.makedirs(args.dir, exist_ok=True)
+    conn = psycopg2.connect(
+        host=os.environ.get('POSTGRES_HOST'),
+        dbname=os.environ.get('POSTGRES_DBNAME'),
+        user=os.environ.get('POSTGRES_USER'),
+        password=os.environ.get('POSTGRES_PASSWORD'),
+        port=os.environ.get('POSTGRES_PORT'),
+    )
+    written = archive(conn, PartitionManager(), args.dir, args.older_than_days)
+    print(f"Archived {sum(i['rows'] for i in written)} rows into {len(written)} files")
@@ -0,0 +1,90 @@
+from column_registry import COLUMN_NAME, ColumnRegistry, quote_column
+
+
+# Column types that attribute values can be merged into in the compatibility view
+TEXT_TYPES = ("text", "character varying")
+
+
+class AttributeRegistry(ColumnRegistry):
+    """ Attribute names of things stored in a JSONB column
+
+    With THINGS_STORAGE=jsonb the attributes of a device are merged into
+    things.attrs instead of one TEXT column per topic, so a new topic never
+    needs ALTER TABLE on things. The registry keeps the attribute names seen
+    so far and the view that shows them as columns, for the queries written
+    against the column layout: every attribute becomes a column of the view,
+    and an attribute that also has a legacy column shows the JSONB value
+    when there is one and the column value otherwise.
+
+    create() rebuilds the view instead of altering things; that only locks
+    the view, the writers keep going.
+    """
+
+    kind = "view column"
+
+    def __init__(self, table="things", view="things_view", column="attrs"):
+        super().__init__(table)
+        self.view = view
+        self.column = column
+        self.table_columns = {}
+
+    def attrs_column_sql(self):
+        return "ALTER TABLE " + self.table + " ADD COLUMN IF NOT EXISTS " + self.column + " JSONB NOT NULL DEFAULT '{}'::jsonb"
+
+    def table_columns_sql(self):
+        return "SELECT column_name, data_type FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s"
+
+    def keys_sql(self):
+        return "SELECT DISTINCT jsonb_object_keys(" + self.column + ") FROM " + self.table
+
+    def load(self, cur):
+        """ Adds the JSONB column when it is missing, loads the attribute names and rebuilds the view
+
+        The caller commits.
+
+        Args:
+            cur: psycopg2 cursor
+
+        Returns:
+            int: number of attributes
+        """
+        cur.execute(self.attrs_column_sql())
+        cur.execute(self.table_columns_sql(), (self.table,))
+        self.load_rows(cur.fetchall())
+        cur.execute(self.keys_sql())
+        count = self.load_keys(cur.fetchall())
+        for statement in self.create_statements([]):
+            cur.execute(statement)
+        return count
+
+    def load_rows(self, rows):
+        """ Fills the columns of the table from (column_name, data_type) rows """
+        with self.lock:
+            self.table_columns = {row[0]: row[1] for row in rows}
+            return len(self.table_columns)
+
+    def load_keys(self, rows):
+        """ Fills the attribute names from (key,) rows, names that cannot be view columns are left out """
+        with self.lock:
+            self.columns = {row[0] for row in rows if COLUMN_NAME.match(row[0])}
+            return len(self.columns)
+
+    def create_statements(self, names, types=None):
+        """ Statements that recreate the view with the known attributes and names, types are not needed """
+        keys = self.columns | set(names)
+        select = []
+        for name, data_type in self.table_columns.items():
+            if name == self.column:
+                continue
+            if name in keys and data_type in TEXT_TYPES:
+                select.append(f"COALESCE({self.column} ->> '{name}', {quote_column(name)}) AS {quote_column(name)}")
+            else:
+                select.append(quote_column(name))
+        for key in sorted(keys):
+            if key not in self.table_columns:
+                select.append(f"{self.column} ->> '{key}' AS {quote_column(key)}")
+
+        return [
+            "DROP VIEW IF EXISTS " + self.view,
+            "CREATE VIEW " + self.view + " AS SELECT " + ", ".join(select) + " FROM " + self.table,
+        ]
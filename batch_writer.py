@@ -0,0 +1,120 @@
+import io
+import time
+
+from commit_policy import CommitPolicy
+
+
+# Column order of the rows queued by main.py: (*message, env, topic)
+MQTT_COPY_COLUMNS = ("timestamp", "imei", "message", "payload", "crc", "env", "topic")
+
+
+def copy_escape(value):
+    """ Formats a single value for the COPY text format
+
+    Args:
+        value: any python value, None becomes NULL
+
+    Returns:
+        string: value with backslash, tab, newline and carriage return escaped
+    """
+    if value is None:
+        return "\\N"
+    text = str(value)
+    return (
+        text.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+COPY_UNESCAPE = {"\\": "\\", "t": "\t", "n": "\n", "r": "\r"}
+
+
+def copy_unescape(text):
+    """ Reverses copy_escape for one field of a COPY text line, \\N becomes None """
+    if text == "\\N":
+        return None
+    if "\\" not in text:
+        return text
+    parts = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == "\\" and i + 1 < len(text):
+            i += 1
+            c = COPY_UNESCAPE.get(text[i], text[i])
+        parts.append(c)
+        i += 1
+    return "".join(parts)
+
+
+class MqttCopyBatch:
+    """ Collects raw mqtt rows and loads them with a single COPY
+
+    The commit policy decides when the batch is due for flushing, based on
+    its number of rows, their size and the age of the oldest row.
+    """
+
+    def __init__(self, policy=None, table="mqtt", columns=MQTT_COPY_COLUMNS):
+        self.policy = policy or CommitPolicy()
+        self.copy_sql = "COPY " + table + " (" + ", ".join(columns) + ") FROM STDIN"
+        self.rows = []
+        self.bytes = 0
+        self.started = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, row):
+        """ Adds a row, in MQTT_COPY_COLUMNS order, to the batch """
+        if not self.rows:
+            self.started = time.monotonic()
+        self.rows.append(row)
+        self.bytes += sum(len(v) for v in row if isinstance(v, str))
+
+    def age(self):
+        """ Seconds since the first row of this batch was added """
+        if self.started is None:
+            return 0.0
+        return time.monotonic() - self.started
+
+    def is_due(self):
+        """ True when the commit policy says the batch has to be flushed """
+        return self.policy.is_due(len(self.rows), self.bytes, self.age())
+
+    def remaining(self):
+        """ Seconds until the batch is due because of its age, None when it is empty """
+        if not self.rows:
+            return None
+        return self.policy.max_age - self.age()
+
+    def clear(self):
+        self.rows = []
+        self.bytes = 0
+        self.started = None
+
+    def flush(self, cur):
+        """ Sends all rows of the batch to the database with COPY
+
+        The caller is responsible for committing the transaction.
+
+        Args:
+            cur: psycopg2 cursor
+
+        Returns:
+            int: number of rows sent
+        """
+        if not self.rows:
+            return 0
+
+        buffer = io.StringIO()
+        for row in self.rows:
+            buffer.write("\t".join(copy_escape(v) for v in row))
+            buffer.write("\n")
+        buffer.seek(0)
+
+        cur.copy_expert(self.copy_sql, buffer)
+        count = len(self.rows)
+        self.clear()
+        return count
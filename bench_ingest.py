@@ -0,0 +1,622 @@
+import os
+import sys
+import json
+import time
+import socket
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+
+from collections import namedtuple
+from batch_writer import MQTT_COPY_COLUMNS, copy_unescape
+
+
+# What paho hands to on_message
+Message = namedtuple("Message", "topic payload")
+
+# Share of the generated messages per topic kind
+DEFAULT_MIX = "attribute=70,location=15,mqttstats=10,connect=5"
+
+# Attribute topics of a device with a payload generator each, the kinds PAYLOAD_TYPES infers
+ATTRIBUTES = {
+    "battery": lambda r: str(r.randint(0, 100)),
+    "rssi": lambda r: str(r.randint(-110, -50)),
+    "temperature": lambda r: f"{r.uniform(-10, 40):.2f}",
+    "feeding": lambda r: r.choice(("true", "false")),
+    "firmware": lambda r: r.choice(("1.4.2", "1.4.3", "1.5.0-rc1")),
+    "state": lambda r: json.dumps({"mode": r.choice(("auto", "manual")), "level": r.randint(0, 9)}),
+}
+
+CONNECTION_TOPICS = ("connect", "disconnect", "connection")
+
+# Tables for an empty database, the columns main.py writes
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS mqtt (timestamp TIMESTAMP, imei TEXT, message TEXT, payload TEXT, crc TEXT, env TEXT, topic TEXT)",
+    "CREATE INDEX IF NOT EXISTS mqtt_timestamp ON mqtt (timestamp)",
+    "CREATE TABLE IF NOT EXISTS things (imei TEXT, swd_imei TEXT, firstseen TIMESTAMP, lastupdated TIMESTAMP)",
+)
+
+# Tables of the optional features that hold rows per IMEI, deleted with the rows of a run
+FEATURE_TABLES = ("device_location", "device_track", "mqttstats_rollup")
+
+# Stage latencies reported, in the order a row passes them
+STAGES = ("on_message", "queue", "batch", "flush", "end_to_end")
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted values """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def summarize(seconds):
+    """ Count, percentiles and maximum of durations in seconds, reported in milliseconds """
+    values = sorted(seconds)
+    summary = {"count": len(values)}
+    for p in PERCENTILES:
+        value = percentile(values, p)
+        summary[f"p{p}"] = None if value is None else round(value * 1000, 3)
+    summary["max"] = round(values[-1] * 1000, 3) if values else None
+    return summary
+
+
+def parse_mix(text):
+    """ Parses "kind=weight,..." into [(kind, weight), ...] """
+    mix = []
+    for entry in text.split(","):
+        kind, _, weight = entry.strip().partition("=")
+        if kind not in ("attribute", "location", "mqttstats", "connect"):
+            raise ValueError(f"Unknown message kind in mix: {kind}")
+        mix.append((kind, float(weight)))
+    return mix
+
+
+class MessageGenerator:
+    """ Stream of realistic topics and payloads
+
+    Devices are picked with a Zipf-like distribution, so a few devices send
+    most of the messages, as in the field. Every device has a home position
+    it drifts around, and a counter for its mqttstats payloads.
+
+    Args:
+        devices int: number of IMEIs
+        mix list: (kind, weight) as returned by parse_mix
+        skew float: Zipf exponent, 0 picks every device equally often
+        prefix string: first topic segment
+        seed int: seed of the random generator, the same seed gives the same stream
+    """
+
+    def __init__(self, devices=5000, mix=None, skew=1.1, prefix="feedalert", seed=1, imei_prefix="35"):
+        self.random = random.Random(seed)
+        self.prefix = prefix
+        self.imeis = [imei_prefix + "".join(self.random.choice("0123456789") for _ in range(13)) for _ in range(devices)]
+        weights = [1 / (rank + 1) ** skew for rank in range(devices)]
+        self.device_weights = list(_accumulate(weights))
+        mix = mix or parse_mix(DEFAULT_MIX)
+        self.kinds = [kind for kind, _ in mix]
+        self.kind_weights = list(_accumulate(weight for _, weight in mix))
+        self.homes = {}
+        self.sent = {}
+
+    def next(self):
+        """ Returns (kind, Message) """
+        r = self.random
+        imei = r.choices(self.imeis, cum_weights=self.device_weights)[0]
+        kind = r.choices(self.kinds, cum_weights=self.kind_weights)[0]
+        if kind == "attribute":
+            attribute = r.choice(tuple(ATTRIBUTES))
+            payload = ATTRIBUTES[attribute](r)
+        elif kind == "location":
+            attribute = "location"
+            lat, lon = self.homes.setdefault(imei, (r.uniform(50.8, 53.4), r.uniform(3.4, 7.2)))
+            payload = json.dumps({"lat": round(lat + r.gauss(0, 0.001), 6), "lon": round(lon + r.gauss(0, 0.001), 6)})
+        elif kind == "mqttstats":
+            attribute = "mqttstats"
+            self.sent[imei] = self.sent.get(imei, 0) + 1
+            payload = json.dumps({"tx": self.sent[imei], "rssi": r.randint(-110, -50), "heap": {"free": r.randint(20000, 40000)}})
+        else:
+            attribute = r.choice(CONNECTION_TOPICS)
+            payload = str(int(time.time()))
+        return kind, Message(f"{self.prefix}/{imei}/{attribute}", payload.encode("utf-8"))
+
+
+def _accumulate(values):
+    total = 0.0
+    for value in values:
+        total += value
+        yield total
+
+
+class Schedule:
+    """ Message rate over time, with bursts
+
+    Every burst_interval seconds the rate is multiplied by burst_factor for
+    burst_length seconds, the way devices reconnecting after an outage
+    publish their backlog at once. A rate of 0 sends as fast as possible.
+    """
+
+    def __init__(self, rate, burst_factor=5.0, burst_interval=10.0, burst_length=1.0):
+        self.rate = rate
+        self.burst_factor = burst_factor
+        self.burst_interval = burst_interval
+        self.burst_length = burst_length
+
+    def rate_at(self, elapsed):
+        if self.burst_interval > 0 and elapsed % self.burst_interval >= self.burst_interval - self.burst_length:
+            return self.rate * self.burst_factor
+        return self.rate
+
+
+class FakeCursor:
+    """ Cursor that accepts every statement and waits as long as a round trip to Postgres would take """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+        self.statements = 0
+
+    def execute(self, sql, params=None):
+        self.statements += 1
+        self.rowcount = 1
+        self.connection.wait(self.connection.latency)
+
+    def mogrify(self, sql, params=None):
+        # The fake does not look at parameters, execute_batch only needs bytes to join
+        return sql.encode("utf-8") if isinstance(sql, str) else sql
+
+    def copy_expert(self, sql, file):
+        rows = file.read().count("\n")
+        self.rowcount = rows
+        self.connection.wait(self.connection.latency + rows * self.connection.copy_row)
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """ Stand-in for a psycopg2 connection with configurable latencies
+
+    Args:
+        latency float: seconds per statement
+        commit_latency float: seconds per commit
+        copy_row float: seconds per row sent with COPY, on top of latency
+    """
+
+    encoding = "UTF8"
+
+    def __init__(self, latency=0.0002, commit_latency=0.001, copy_row=0.000002):
+        self.latency = latency
+        self.commit_latency = commit_latency
+        self.copy_row = copy_row
+        self.autocommit = False
+
+    @staticmethod
+    def wait(seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.wait(self.commit_latency)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Recorder:
+    """ Times every mqtt row from on_message to its commit
+
+    The writers' connections are wrapped so the text of every COPY is kept
+    with the time it was sent and the time its transaction committed; the
+    rows are only parsed once the run is over, so recording costs the
+    writers next to nothing.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.copies = []
+        self.dequeued = {}
+        self.rows = 0
+        self.last_commit = None
+
+    def wrap_queue(self, write_queue):
+        """ Notes when each message is taken from a writer queue """
+        get = write_queue.get
+        dequeued = self.dequeued
+        crc = MQTT_COPY_COLUMNS.index("crc")
+
+        def timed_get(*args, **kwargs):
+            message = get(*args, **kwargs)
+            dequeued[message[crc]] = time.time()
+            return message
+
+        write_queue.get = timed_get
+
+    def committed(self, copies, when):
+        with self.lock:
+            for text, sent, rows in copies:
+                self.copies.append((text, sent, when))
+                self.rows += rows
+            if copies:
+                self.last_commit = when
+
+    def stage_latencies(self):
+        """ Returns {stage: [seconds, ...]} for queue, batch, flush and end_to_end """
+        received_at = MQTT_COPY_COLUMNS.index("timestamp")
+        crc_at = MQTT_COPY_COLUMNS.index("crc")
+        stages = {stage: [] for stage in STAGES[1:]}
+        for text, sent, committed in self.copies:
+            for line in text.splitlines():
+                fields = line.split("\t")
+                received = datetime.datetime.fromisoformat(copy_unescape(fields[received_at])).timestamp()
+                dequeued = self.dequeued.get(copy_unescape(fields[crc_at]), sent)
+                stages["queue"].append(dequeued - received)
+                stages["batch"].append(sent - dequeued)
+                stages["flush"].append(committed - sent)
+                stages["end_to_end"].append(committed - received)
+        return stages
+
+
+class RecordingCursor:
+    def __init__(self, cursor, connection):
+        self.cursor = cursor
+        self.recording = connection
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def copy_expert(self, sql, file):
+        # The batch writer hands over a StringIO, its text is kept without copying it again
+        text = file.getvalue()
+        sent = time.time()
+        self.cursor.copy_expert(sql, file)
+        self.recording.pending.append((text, sent, text.count("\n")))
+
+
+class RecordingConnection:
+    """ Wraps a connection of one writer for the Recorder """
+
+    def __init__(self, connection, recorder):
+        self.connection = connection
+        self.recorder = recorder
+        self.pending = []
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def __setattr__(self, name, value):
+        if name in ("connection", "recorder", "pending"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.connection, name, value)
+
+    def cursor(self, *args, **kwargs):
+        return RecordingCursor(self.connection.cursor(*args, **kwargs), self)
+
+    def commit(self):
+        self.connection.commit()
+        pending, self.pending = self.pending, []
+        self.recorder.committed(pending, time.time())
+
+    def rollback(self):
+        self.connection.rollback()
+        self.pending = []
+
+
+class TempPostgres:
+    """ Throwaway Postgres cluster in a temporary directory
+
+    Uses initdb and pg_ctl from PATH, or from the bindir of pg_config, and
+    points the POSTGRES_* settings at it.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.bindir = None
+        self.port = None
+
+    def find_bindir(self):
+        initdb = shutil.which("initdb")
+        if initdb:
+            return os.path.dirname(initdb)
+        if shutil.which("pg_config"):
+            bindir = subprocess.run(["pg_config", "--bindir"], capture_output=True, text=True).stdout.strip()
+            if os.path.exists(os.path.join(bindir, "initdb")):
+                return bindir
+        raise SystemExit("initdb was not found, install Postgres or pass --use-configured-db to use the POSTGRES_* database")
+
+    def start(self):
+        self.bindir = self.find_bindir()
+        self.directory = tempfile.mkdtemp(prefix="harness_pg_")
+        data = os.path.join(self.directory, "data")
+        subprocess.run(
+            [os.path.join(self.bindir, "initdb"), "-D", data, "-U", "postgres", "--auth=trust", "-E", "UTF8"],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        subprocess.run(
+            [os.path.join(self.bindir, "pg_ctl"), "-D", data, "-l", os.path.join(self.directory, "postgres.log"), "-w",
+             "-o", f"-p {self.port} -k {self.directory} -c listen_addresses=127.0.0.1", "start"],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        os.environ.update(
+            POSTGRES_HOST="127.0.0.1", POSTGRES_PORT=str(self.port), POSTGRES_USER="postgres",
+            POSTGRES_PASSWORD="", POSTGRES_DBNAME="postgres",
+        )
+
+    def stop(self):
+        if self.directory is None:
+            return
+        subprocess.run(
+            [os.path.join(self.bindir, "pg_ctl"), "-D", os.path.join(self.directory, "data"), "-m", "fast", "stop"],
+            stdout=subprocess.DEVNULL,
+        )
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+
+
+def prepare_database(conn, imeis):
+    """ Creates the tables in an empty database and the things rows of imeis """
+    cur = conn.cursor()
+    for statement in SCHEMA:
+        cur.execute(statement)
+    cur.execute("INSERT INTO things (imei, firstseen, lastupdated) SELECT i, NOW(), NOW() FROM unnest(%s::text[]) i", (imeis,))
+    conn.commit()
+
+
+def cleanup_database(conn, env, imeis):
+    """ Deletes the rows a run wrote: its raw rows, things rows and the rows of its devices in the feature tables """
+    conn.rollback()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM mqtt WHERE env = %s AND imei = ANY(%s)", (env, imeis))
+    cur.execute("DELETE FROM things WHERE imei = ANY(%s)", (imeis,))
+    for table in FEATURE_TABLES:
+        cur.execute("SELECT to_regclass(%s)", (table,))
+        if cur.fetchone()[0] is not None:
+            cur.execute(f"DELETE FROM {table} WHERE imei = ANY(%s)", (imeis,))
+    conn.commit()
+
+
+def configure_environment(args, spill_dir):
+    """ Settings main.py reads at import, so the run cannot touch production files or Logtail """
+    # The screen logger, DEBUG_MODE itself is switched off again after the import
+    os.environ["DEBUG_MODE"] = "True"
+    os.environ["WRITE_QUEUE_SPILL_FILE"] = os.path.join(spill_dir, "write_queue.spill")
+    os.environ["SPOOL_DIR"] = args.spool_dir or ""
+    os.environ["WRITER_POOL_SIZE"] = str(args.writers)
+    # Raw rows written to Postgres can be told apart from, and deleted without touching, real ones
+    os.environ["MQTT_ENV"] = args.env
+
+
+def run(args):
+    """ Generates messages for args.duration seconds, waits for the writers and returns the results """
+    spill_dir = tempfile.mkdtemp(prefix="bench_ingest_")
+    configure_environment(args, spill_dir)
+    # Imported here, main.py reads its settings and builds its queues at import
+    import main
+    main.DEBUG_MODE = "False"
+    if not args.verbose:
+        main.logger.setLevel("WARNING")
+
+    # Written to Postgres, the IMEIs start with 99 so they cannot be those of real devices
+    generator = MessageGenerator(args.devices, parse_mix(args.mix), args.skew, seed=args.seed, imei_prefix="99" if args.postgres else "35")
+    schedule = Schedule(args.rate, args.burst_factor, args.burst_interval, args.burst_length)
+    recorder = Recorder()
+
+    if args.postgres:
+        connect = main.connect_database
+        conn = connect()
+        if not args.use_configured_db:
+            # An empty cluster: the tables, and the most active devices in things
+            known = generator.imeis[:int(len(generator.imeis) * args.known_devices)]
+            prepare_database(conn, known)
+        main.devices.load(conn.cursor())
+        main.columns.load(conn.cursor())
+        conn.commit()
+        if main.LOCATION_TABLES == "True":
+            main.create_location_tables(conn)
+        if main.STATS_ROLLUP == "True":
+            main.create_stats_tables(conn)
+        conn.commit()
+    else:
+        def connect():
+            return FakeConnection(args.db_latency_ms / 1000, args.commit_latency_ms / 1000, args.copy_row_us / 1e6)
+        # The most active devices are in things, the others cost a lookup each negative_ttl
+        known = generator.imeis[:int(len(generator.imeis) * args.known_devices)]
+        main.devices.load_rows([(None, imei) for imei in known])
+    if main.decoder is not None:
+        main.decoder.load_columns(main.columns.types)
+
+    main.opendatabase = lambda: RecordingConnection(connect(), recorder)
+    for write_queue in main.writers.queues:
+        recorder.wrap_queue(write_queue)
+    main.writers.start(main.write_to_database)
+
+    depths = []
+    stop = threading.Event()
+
+    def sample_depth():
+        while not stop.wait(args.sample_interval):
+            depths.append(main.writers.qsize())
+
+    sampler = threading.Thread(target=sample_depth, name="bench-depth", daemon=True)
+    sampler.start()
+
+    on_message = []
+    expected = 0
+    keep_stats = main.STATS_ROLLUP != "True" or main.STATS_KEEP_RAW == "True"
+    started = time.monotonic()
+    wall_started = time.time()
+    sent = 0.0
+    while True:
+        now = time.monotonic()
+        elapsed = now - started
+        if elapsed >= args.duration:
+            break
+        rate = schedule.rate_at(elapsed)
+        # Messages due in this tick, a fraction is carried over to the next one
+        count = args.tick_size if rate <= 0 else int(sent + rate * args.tick) - int(sent)
+        sent += rate * args.tick
+        for _ in range(count):
+            kind, message = generator.next()
+            t = time.perf_counter()
+            main.on_message(None, None, message)
+            on_message.append(time.perf_counter() - t)
+            if kind != "mqttstats" or keep_stats:
+                expected += 1
+        if rate > 0:
+            time.sleep(max(0.0, started + elapsed + args.tick - time.monotonic()))
+    generated = time.monotonic() - started
+
+    # Wait for the writers to commit every raw row, or give up after the drain timeout
+    deadline = time.monotonic() + args.drain_timeout
+    while recorder.rows < expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    stop.set()
+    sampler.join()
+    if args.postgres:
+        if not args.keep:
+            cleanup_database(conn, args.env, generator.imeis)
+        conn.close()
+
+    stages = recorder.stage_latencies()
+    stages["on_message"] = on_message
+    idle, busy = sum(main.writers.idle), sum(main.writers.busy)
+    span = (recorder.last_commit or wall_started) - wall_started
+    ordered = sorted(depths)
+    return {
+        "settings": {key: value for key, value in vars(args).items() if key not in ("baseline", "output")},
+        "messages": len(on_message),
+        "rows_expected": expected,
+        "rows_committed": recorder.rows,
+        "drained": recorder.rows >= expected,
+        "generate_seconds": round(generated, 3),
+        "offered_per_second": round(len(on_message) / max(generated, 1e-9), 1),
+        "committed_per_second": round(recorder.rows / max(span, 1e-9), 1),
+        "writer_busy_percent": round(100 * busy / max(idle + busy, 1e-9), 1),
+        "queue_depth": {
+            "max": ordered[-1] if ordered else 0,
+            "mean": round(sum(ordered) / len(ordered), 1) if ordered else 0,
+            "p50": percentile(ordered, 50) or 0,
+            "p99": percentile(ordered, 99) or 0,
+        },
+        "latency_ms": {stage: summarize(stages[stage]) for stage in STAGES},
+    }
+
+
+def compare(results, baseline, tolerance):
+    """ Lists the ways results are worse than baseline by more than tolerance percent
+
+    Throughput may not drop and the p99 of every stage may not rise by more
+    than the tolerance; a run that did not drain always fails.
+    """
+    regressions = []
+    if not results["drained"]:
+        regressions.append(f"only {results['rows_committed']} of {results['rows_expected']} rows were committed")
+    factor = tolerance / 100
+    old, new = baseline["committed_per_second"], results["committed_per_second"]
+    if new < old * (1 - factor):
+        regressions.append(f"throughput {new}/s is below the baseline {old}/s")
+    for stage in STAGES:
+        old = baseline["latency_ms"].get(stage, {}).get("p99")
+        new = results["latency_ms"][stage]["p99"]
+        # Sub-millisecond stages are noise, they only count once they pass a millisecond
+        if old is not None and new is not None and new > max(old * (1 + factor), 1.0):
+            regressions.append(f"{stage} p99 {new} ms is above the baseline {old} ms")
+    return regressions
+
+
+def report(results):
+    print(f"Messages generated: {results['messages']} in {results['generate_seconds']} s, {results['offered_per_second']}/s offered")
+    print(f"Rows committed: {results['rows_committed']} of {results['rows_expected']}, {results['committed_per_second']}/s")
+    print(f"Writers busy: {results['writer_busy_percent']}%")
+    depth = results["queue_depth"]
+    print(f"Queue depth: max {depth['max']}, mean {depth['mean']}, p50 {depth['p50']}, p99 {depth['p99']}")
+    print(f"{'stage':<12}{'count':>10}" + "".join(f"{f'p{p} ms':>12}" for p in PERCENTILES) + f"{'max ms':>12}")
+    for stage in STAGES:
+        s = results["latency_ms"][stage]
+        print(f"{stage:<12}{s['count']:>10}" + "".join(f"{str(s[f'p{p}']):>12}" for p in PERCENTILES) + f"{str(s['max']):>12}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures messages per second through on_message, the write queues and write_to_database")
+    parser.add_argument("--duration", type=float, default=10, help="seconds messages are generated")
+    parser.add_argument("--rate", type=float, default=0, help="messages per second outside bursts, 0 sends as fast as possible")
+    parser.add_argument("--burst-factor", type=float, default=5.0, help="rate multiplier during a burst")
+    parser.add_argument("--burst-interval", type=float, default=10.0, help="seconds from one burst to the next, 0 disables bursts")
+    parser.add_argument("--burst-length", type=float, default=1.0, help="seconds a burst lasts")
+    parser.add_argument("--tick", type=float, default=0.01, help="seconds between batches of messages when a rate is set")
+    parser.add_argument("--tick-size", type=int, default=100, help="messages per batch when sending as fast as possible")
+    parser.add_argument("--devices", type=int, default=5000, help="number of IMEIs")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of the device popularity")
+    parser.add_argument("--known-devices", type=float, default=0.9, help="share of the devices that are in things, fake connection only")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights of attribute, location, mqttstats and connect messages")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--writers", type=int, default=int(os.environ.get("WRITER_POOL_SIZE", "1")), help="writer workers")
+    parser.add_argument("--spool-dir", help="enable the write-ahead spool in this directory")
+    parser.add_argument("--postgres", action="store_true", help="write to a throwaway Postgres cluster made with initdb instead of a fake connection")
+    parser.add_argument("--use-configured-db", action="store_true", help="with --postgres, write to the database of the POSTGRES_* settings instead")
+    parser.add_argument("--keep", action="store_true", help="with --postgres, keep the rows of the run afterwards")
+    parser.add_argument("--env", default="bench", help="env column of the raw rows")
+    parser.add_argument("--db-latency-ms", type=float, default=0.2, help="fake connection: milliseconds per statement")
+    parser.add_argument("--commit-latency-ms", type=float, default=1.0, help="fake connection: milliseconds per commit")
+    parser.add_argument("--copy-row-us", type=float, default=2.0, help="fake connection: microseconds per row sent with COPY")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="seconds to wait for the writers after the last message")
+    parser.add_argument("--sample-interval", type=float, default=0.05, help="seconds between queue depth samples")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with, exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=10, help="percent a result may be worse than the baseline")
+    parser.add_argument("--verbose", action="store_true", help="show the log of main.py")
+    args = parser.parse_args()
+
+    if args.use_configured_db and not args.postgres:
+        parser.error("--use-configured-db needs --postgres")
+
+    postgres = TempPostgres() if args.postgres and not args.use_configured_db else None
+    if postgres is not None:
+        postgres.start()
+        print(f"Started Postgres on port {postgres.port}")
+    elif args.postgres:
+        print(f"Writing to the configured Postgres, the rows of the run are stored with env {args.env} and {'kept' if args.keep else 'deleted afterwards'}")
+
+    try:
+        results = run(args)
+    finally:
+        if postgres is not None:
+            postgres.stop()
+    report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+    elif not results["drained"]:
+        sys.exit(1)
@@ -0,0 +1,197 @@
+import re
+import time
+import threading
+
+from psycopg2 import errors
+
+
+# Topics become things columns. Postgres folds unquoted names to lower case,
+# so a topic is stored under its lower case name, and only names that are
+# plain identifiers are accepted.
+COLUMN_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+# Longest identifier Postgres keeps without truncating it
+MAX_COLUMN_LENGTH = 63
+
+
+def quote_column(name):
+    """ Quotes a column name returned by ColumnRegistry.column_name """
+    return '"' + name + '"'
+
+
+class ColumnRegistry:
+    """ Set of columns of the things table, kept in memory
+
+    The set is loaded from information_schema at startup. The writer checks
+    every topic against it and creates missing columns before it writes the
+    values, instead of finding out from a failed UPDATE.
+
+    ALTER TABLE is serialised by its own lock, so a writer that waits for
+    it never holds the lock the other writers need to get to their commit,
+    and it gives up on the table lock after lock_timeout and tries again,
+    so the writers queued behind it are not held up for long.
+
+    Args:
+        table string: table the columns belong to
+        lock_timeout string: Postgres lock_timeout for ALTER TABLE
+        attempts int: times ALTER TABLE is tried before the error is raised
+    """
+
+    # What create() makes, for log messages
+    kind = "column"
+
+    def __init__(self, table="things", lock_timeout="2s", attempts=30):
+        self.table = table
+        self.lock_timeout = lock_timeout
+        self.attempts = attempts
+        self.columns = set()
+        self.types = {}
+        self.rejected = set()
+        self.lock = threading.Lock()
+        self.creation_lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __len__(self):
+        return len(self.columns)
+
+    def load(self, cur):
+        """ Loads the column names of the table
+
+        Args:
+            cur: psycopg2 cursor
+
+        Returns:
+            int: number of columns
+        """
+        cur.execute(
+            "SELECT column_name, data_type FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s",
+            (self.table,),
+        )
+        return self.load_rows(cur.fetchall())
+
+    def load_rows(self, rows):
+        """ Fills the registry from (column_name, data_type) rows """
+        with self.lock:
+            self.columns = {row[0] for row in rows}
+            self.types = {row[0]: row[1] for row in rows if len(row) > 1}
+            return len(self.columns)
+
+    def column_name(self, topic):
+        """ Returns the column a topic is stored in, or None when it cannot be a column """
+        name = topic.lower()
+        if len(name) > MAX_COLUMN_LENGTH or not COLUMN_NAME.match(name):
+            return None
+        return name
+
+    def reject(self, topic):
+        """ Records a topic that cannot be a column, True the first time it is seen
+
+        Without a lock, a topic seen by two writers at once may be reported twice.
+        """
+        if topic in self.rejected:
+            return False
+        self.rejected.add(topic)
+        return True
+
+    def missing(self, names):
+        """ Returns the names, out of names, that are not columns yet """
+        return sorted(name for name in names if name not in self.columns)
+
+    def add_column_sql(self, name, sql_type="TEXT"):
+        return "ALTER TABLE " + self.table + " ADD COLUMN IF NOT EXISTS " + quote_column(name) + " " + sql_type
+
+    def create_statements(self, names, types=None):
+        """ Statements that make the names, which are not columns yet, usable
+
+        types maps a name to its column type, names without one are TEXT.
+        """
+        types = types or {}
+        return [self.add_column_sql(name, types.get(name, "TEXT")) for name in names]
+
+    def lock_timeout_sql(self):
+        return "SET LOCAL lock_timeout = '" + self.lock_timeout + "'"
+
+    def alter_type_sql(self, name, sql_type):
+        return "ALTER TABLE " + self.table + " ALTER COLUMN " + quote_column(name) + " TYPE " + sql_type + " USING " + quote_column(name) + "::" + sql_type
+
+    def retype_statements(self, types):
+        """ Statements that change the type of existing columns, types maps a name to its new type """
+        return [self.alter_type_sql(name, sql_type) for name, sql_type in sorted(types.items())]
+
+    def add(self, name, sql_type="TEXT"):
+        """ Records a column that has been created """
+        with self.lock:
+            self.columns.add(name)
+            self.types[name] = sql_type.lower()
+
+    def retyped(self, name, sql_type):
+        """ Records a column whose type has been changed """
+        with self.lock:
+            self.types[name] = sql_type.lower()
+
+    def create(self, conn, names, types=None):
+        """ Creates the columns that do not exist yet and commits
+
+        ALTER TABLE waits for every open transaction on the table, so conn
+        must not have one open. Creation is serialised between writers.
+
+        Args:
+            conn: psycopg2 connection
+            names list: column names from column_name()
+            types dict: column type per name, TEXT when missing
+
+        Returns:
+            list: names of the columns that were created
+        """
+        with self.creation_lock:
+            created = [name for name in names if name not in self.columns]
+            if not created:
+                return []
+            self.execute_ddl(conn, self.create_statements(created, types))
+            with self.lock:
+                self.columns.update(created)
+                for name in created:
+                    self.types[name] = (types or {}).get(name, "TEXT").lower()
+            return created
+
+    def retype(self, conn, types):
+        """ Changes the type of existing columns and commits
+
+        Used when payloads no longer fit the type of their column, the
+        values are cast to the wider type. Like create(), conn must not
+        have a transaction open.
+
+        Args:
+            conn: psycopg2 connection
+            types dict: new column type per name
+
+        Returns:
+            list: names of the columns that were changed
+        """
+        with self.creation_lock:
+            changed = {name: sql_type for name, sql_type in types.items() if self.types.get(name) != sql_type.lower()}
+            if not changed:
+                return []
+            self.execute_ddl(conn, self.retype_statements(changed))
+            with self.lock:
+                for name, sql_type in changed.items():
+                    self.types[name] = sql_type.lower()
+            return sorted(changed)
+
+    def execute_ddl(self, conn, statements):
+        """ Runs statements in one transaction under lock_timeout and commits, again when the lock was not granted """
+        cur = conn.cursor()
+        for attempt in range(1, self.attempts + 1):
+            try:
+                cur.execute(self.lock_timeout_sql())
+                for statement in statements:
+                    cur.execute(statement)
+                conn.commit()
+                return
+            except errors.LockNotAvailable:
+                conn.rollback()
+                if attempt == self.attempts:
+                    raise
+                time.sleep(min(0.1 * attempt, 1.0))
@@ -0,0 +1,84 @@
+from collections import deque
+
+
+class CommitPolicy:
+    """ Decides when a writer commits its batch
+
+    A batch is committed when it holds max_rows rows, max_bytes bytes of
+    row data, or when its oldest row has waited max_age_ms milliseconds,
+    whichever comes first.
+    """
+
+    def __init__(self, max_rows=1000, max_bytes=4 * 1024 * 1024, max_age_ms=1000):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age_ms / 1000
+
+    def is_due(self, rows, size, age):
+        """ True when a batch of rows rows, size bytes and age seconds has to be committed """
+        if not rows:
+            return False
+        return rows >= self.max_rows or size >= self.max_bytes or age >= self.max_age
+
+    def observe(self, latency, rows):
+        """ Records how long the oldest row of a committed batch took to become visible """
+
+    def describe(self):
+        return f"max {self.max_rows} rows, {self.max_bytes} bytes, {self.max_age * 1000:.0f} ms"
+
+
+class AdaptiveCommitPolicy(CommitPolicy):
+    """ Commit policy that sizes batches to meet a latency target
+
+    The latency of a batch is the time its oldest row waited in the batch
+    plus the time the flush and commit took, i.e. the delay batching adds
+    before a row is visible. Every adjust_every commits the p99 over the
+    last window commits is compared with target_p99_ms: above the target
+    the row and age limits shrink by a quarter, well below it they grow by
+    a tenth. The configured limits are the ceiling, min_rows and
+    min_age_ms the floor.
+    """
+
+    def __init__(self, max_rows=1000, max_bytes=4 * 1024 * 1024, max_age_ms=1000, target_p99_ms=500,
+                 min_rows=10, min_age_ms=10, window=200, adjust_every=20):
+        super().__init__(max_rows, max_bytes, max_age_ms)
+        self.ceiling_rows = max_rows
+        self.ceiling_age = self.max_age
+        self.min_rows = min(min_rows, max_rows)
+        self.min_age = min(min_age_ms / 1000, self.max_age)
+        self.target = target_p99_ms / 1000
+        self.latencies = deque(maxlen=window)
+        self.adjust_every = adjust_every
+        self.commits = 0
+
+    def p99(self):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[int(0.99 * (len(ordered) - 1))]
+
+    def observe(self, latency, rows):
+        self.latencies.append(latency)
+        self.commits += 1
+        if self.commits % self.adjust_every:
+            return
+
+        p99 = self.p99()
+        if p99 > self.target:
+            self.max_rows = max(self.min_rows, int(self.max_rows * 0.75))
+            self.max_age = max(self.min_age, self.max_age * 0.75)
+        elif p99 < self.target * 0.7:
+            self.max_rows = min(self.ceiling_rows, int(self.max_rows * 1.1) + 1)
+            self.max_age = min(self.ceiling_age, self.max_age * 1.1)
+
+    def describe(self):
+        return super().describe() + f", p99 {self.p99() * 1000:.0f} ms of {self.target * 1000:.0f} ms target"
+
+
+def make_commit_policy(mode, max_rows, max_bytes, max_age_ms, target_p99_ms):
+    """ Builds the policy named by mode, "static" or "adaptive" """
+    if mode == "adaptive":
+        return AdaptiveCommitPolicy(max_rows, max_bytes, max_age_ms, target_p99_ms)
+    if mode == "static":
+        return CommitPolicy(max_rows, max_bytes, max_age_ms)
+    raise ValueError(f"Unknown commit policy: {mode}")
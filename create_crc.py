@@ -1,96 +1,159 @@
-import datetime
-import psycopg2
-import crcmod.predefined
 import os
+import sys
+import json
 import uuid
 import binascii
+import argparse
+import datetime
+import psycopg2
+import multiprocessing
+import crcmod.predefined
+
 from dotenv import load_dotenv
-import sys
+from psycopg2.extras import execute_values
 
 # Create a CRC-32 checksum object
 crc32 = crcmod.predefined.Crc('crc-32')
 # Load environment variables from the .env file
 load_dotenv()
 
+MQTT_ENV = os.environ.get('MQTT_ENV')
+
+# Rows of one block range are locked, given new CRCs and updated in a single statement
+UPDATE_RANGE = "UPDATE {table} AS t SET crc = v.crc, env = {env} FROM (VALUES %s) AS v(ctid, crc) WHERE t.ctid = v.ctid::tid"
 
+# A ctid range is only read as a TID Range Scan from PostgreSQL 14 on. Older
+# servers scan the whole table for every range, which makes the backfill quadratic.
+MIN_SERVER_VERSION = 140000
 
 
 def create_crc(data):
-    # Convert data to bytes and calculate the CRC-32 checksum
-    crc32.update(data.encode('utf-8'))
-    checksum = crc32.digest()
+    # A fresh CRC-32 per value, so a value does not depend on the rows before it
+    checksum = crc32.new(data.encode('utf-8')).digest()
 
     # Convert checksum to an ASCII-encoded hexadecimal string
-    hex_checksum = binascii.hexlify(checksum).decode('ascii')
-
-    # DOES NOT EXISTR! > Reset the checksum object for the next calculation
-    # crc32.reset()
-
-    return hex_checksum
-
-def create_serial_number(data):
-    my_date = datetime.datetime.now() 
-    serial_number = my_date.strftime("%Y%m%d%H%M%S%f")
-    crc = create_crc(data)
-    t = uuid.uuid4().hex
-    return crc + t
-    
-
-host = os.environ.get('POSTGRES_HOST')
-dbname = os.environ.get('POSTGRES_DBNAME')
-user = os.environ.get('POSTGRES_USER')
-password = os.environ.get('POSTGRES_PASSWORD')
-MQTT_ENV = os.environ.get('MQTT_ENV')
-print("Create new CRC's for each row in the database.")
-print("So we can then ensure the index for crc is unique.")
-print("Starting up...")
-# Number of records to update at a time
-
-# Check if there are any additional command-line arguments
-if len(sys.argv) > 1:
-    # Print all arguments except the script name
-    for i, arg in enumerate(sys.argv[1:], 1):
-        select_size = int(arg)
-else:
-    select_size = 1000
-
-print(f"Record batch size: {select_size}")
-
-print("Connecting to database and obtaining total records to update.")
-conn = psycopg2.connect(host=host, dbname=dbname, user=user, password=password)
-cur = conn.cursor()
-cur.execute("SELECT count(crc) from mqtt where length(crc) < 10;")
-tr = cur.fetchone()[0]
-print(f"Total records to update: {tr}")
-
-cur.execute("SELECT crc, timestamp, imei, message FROM mqtt where length(crc) < 10 limit " + str(select_size))
-things = cur.fetchall()
-
-# Keep total number of records updated
-td = 0
-
-while len(things) > 0:
-    for n in things:
-        # Create CRC from message and topic
-        my_date = datetime.datetime.now() 
-        serial_number = my_date.strftime("%Y%m%d%H%M%S%f")
-        crc = n[0]
-        imei = n[2]
-        payload = n[3]
-        timestamp = n[1]
-        
-        crc = create_crc(payload + crc + serial_number)
-        t = uuid.uuid4().hex
-        crc = crc + t
-        
-        q = "UPDATE mqtt SET crc = '" + crc + "', env='" + MQTT_ENV + "' WHERE imei = '" + imei + "' AND timestamp = '" + str(timestamp) + "' AND message='" + payload + "';"
-        cur.execute(q)
-        
-        
-    conn.commit()
-    td += select_size
-    print(f"{my_date} - Updated {len(things)} records. {td} of {tr} updated. {round(td/tr*100,2)}% complete.")    
-    
-    cur.execute("SELECT crc, timestamp, imei, message FROM mqtt where length(crc) < 10 limit " + str(select_size))
-    things = cur.fetchall()
-    
\ No newline at end of file
+    return binascii.hexlify(checksum).decode('ascii')
+
+
+def new_crc(message, crc):
+    serial_number = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+    return create_crc(message + crc + serial_number) + uuid.uuid4().hex
+
+
+def connect():
+    return psycopg2.connect(
+        host=os.environ.get('POSTGRES_HOST'),
+        dbname=os.environ.get('POSTGRES_DBNAME'),
+        user=os.environ.get('POSTGRES_USER'),
+        password=os.environ.get('POSTGRES_PASSWORD'),
+        port=os.environ.get('POSTGRES_PORT'),
+    )
+
+
+def tables(cur):
+    """ mqtt, or its partitions when it is partitioned, with their size in blocks """
+    cur.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass('mqtt') ORDER BY c.relname"
+    )
+    names = [row[0] for row in cur.fetchall()] or ["mqtt"]
+    result = []
+    for name in names:
+        cur.execute("SELECT pg_relation_size(%s) / current_setting('block_size')::int", (name,))
+        result.append((name, cur.fetchone()[0]))
+    return result
+
+
+def ranges(table_blocks, blocks):
+    """ Yields (table, first block, block after the last) covering every table """
+    for table, size in table_blocks:
+        for start in range(0, size + 1, blocks):
+            yield table, start, start + blocks
+
+
+# Each worker process keeps one connection
+worker_conn = None
+
+
+def start_worker():
+    global worker_conn
+    worker_conn = connect()
+
+
+def backfill_range(task):
+    """ Gives every row with a short CRC in one block range a new CRC
+
+    The rows are selected by ctid range, which reads only those blocks, and
+    locked so their ctid cannot change before the UPDATE.
+
+    Returns:
+        tuple: (table, first block, rows updated)
+    """
+    table, start, end = task
+    cur = worker_conn.cursor()
+    cur.execute(
+        f"SELECT ctid::text, crc, message FROM {table} "
+        f"WHERE ctid >= %s::tid AND ctid < %s::tid AND length(crc) < 10 FOR UPDATE",
+        (f"({start},0)", f"({end},0)"),
+    )
+    rows = [(ctid, new_crc(message or "", crc or "")) for ctid, crc, message in cur.fetchall()]
+    if rows:
+        env = cur.mogrify("%s", (MQTT_ENV,)).decode()
+        execute_values(cur, UPDATE_RANGE.format(table=table, env=env), rows, page_size=len(rows))
+    worker_conn.commit()
+    return table, start, len(rows)
+
+
+def load_checkpoint(path):
+    """ Returns {table: set of first blocks of finished ranges} """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {table: set(starts) for table, starts in json.load(f).items()}
+
+
+def save_checkpoint(path, done):
+    with open(path + ".tmp", "w") as f:
+        json.dump({table: sorted(starts) for table, starts in done.items()}, f)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create new CRC's for each row in the database, so the index for crc can be unique. "
+                                                 "Requires PostgreSQL 14 or later, which reads a block range without scanning the whole table.")
+    parser.add_argument("--blocks", type=int, default=1000, help="table blocks per range")
+    parser.add_argument("--workers", type=int, default=4, help="ranges processed in parallel")
+    parser.add_argument("--checkpoint", default="create_crc.checkpoint", help="file recording the finished ranges")
+    args = parser.parse_args()
+
+    print("Create new CRC's for each row in the database.")
+    print("So we can then ensure the index for crc is unique.")
+    print(f"Block range size: {args.blocks}, workers: {args.workers}")
+
+    conn = connect()
+    if conn.server_version < MIN_SERVER_VERSION:
+        print(f"PostgreSQL {conn.server_version // 10000} reads every block range with a full table scan, "
+              f"PostgreSQL 14 or later is required.")
+        conn.close()
+        sys.exit(1)
+    table_blocks = tables(conn.cursor())
+    conn.close()
+
+    done = load_checkpoint(args.checkpoint)
+    tasks = [t for t in ranges(table_blocks, args.blocks) if t[1] not in done.get(t[0], set())]
+    total = sum(1 for _ in ranges(table_blocks, args.blocks))
+    print(f"{total - len(tasks)} of {total} ranges already done, {len(tasks)} to go")
+
+    updated = 0
+    finished = total - len(tasks)
+    with multiprocessing.Pool(args.workers, initializer=start_worker) as pool:
+        for table, start, count in pool.imap_unordered(backfill_range, tasks):
+            done.setdefault(table, set()).add(start)
+            save_checkpoint(args.checkpoint, done)
+            updated += count
+            finished += 1
+            print(f"{datetime.datetime.now()} - {table} blocks {start}-{start + args.blocks}: updated {count} records. "
+                  f"{finished} of {total} ranges, {round(finished / max(total, 1) * 100, 2)}% complete.")
+
+    print(f"Done, {updated} records updated.")
+    sys.exit(0)
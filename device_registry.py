@@ -0,0 +1,130 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+
+# Device families as used by the writer. "old" devices are keyed on
+# things.swd_imei, "swx" devices on things.imei.
+FAMILY_OLD = "old"
+FAMILY_SWX = "swx"
+
+
+class DeviceRegistry:
+    """ In-memory map of IMEI to device family
+
+    The registry is filled once from the things table at startup. The
+    ingest never inserts into things, so lookups that miss fall back to the
+    database; IMEIs that are not in things are remembered for negative_ttl
+    seconds so unknown devices do not cost two SELECTs per message. A device
+    added to things later shows up once its negative entry has expired.
+    Both maps are bounded and evict the least recently used entry.
+    """
+
+    def __init__(self, max_size=100000, negative_ttl=60):
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.families = OrderedDict()
+        self.unknown = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.families)
+
+    def load(self, cur):
+        """ Loads all known devices from the things table
+
+        Args:
+            cur: psycopg2 cursor
+
+        Returns:
+            int: number of devices in the registry
+        """
+        cur.execute("SELECT swd_imei, imei FROM things")
+        return self.load_rows(cur.fetchall())
+
+    def load_rows(self, rows):
+        """ Fills the registry from (swd_imei, imei) rows of the things table """
+        with self.lock:
+            self.families.clear()
+            self.unknown.clear()
+            # swd_imei wins over imei, the same order the writer used to query in
+            for swd_imei, _ in rows:
+                if swd_imei:
+                    self._store(swd_imei, FAMILY_OLD)
+            for _, imei in rows:
+                if imei and imei not in self.families:
+                    self._store(imei, FAMILY_SWX)
+            return len(self.families)
+
+    def lookup(self, cur, imei, prepared=None):
+        """ Returns the device family of an IMEI
+
+        Args:
+            cur: psycopg2 cursor, only used when the IMEI is not cached
+            imei string: imei of thing
+            prepared PreparedStatements: run the lookups as prepared statements of this connection
+
+        Returns:
+            string: "old", "swx" or "" when the device is not in things
+        """
+        family = self.cached(imei)
+        if family is None:
+            family = self._query(cur, imei, prepared)
+            self.remember(imei, family)
+        return family
+
+    def cached(self, imei):
+        """ Returns the cached family of an IMEI, or None when the database has to be asked """
+        with self.lock:
+            family = self.families.get(imei)
+            if family is not None:
+                self.families.move_to_end(imei)
+                self.hits += 1
+                return family
+
+            expires = self.unknown.get(imei)
+            if expires is not None and expires > time.monotonic():
+                self.hits += 1
+                return ""
+
+            self.misses += 1
+            return None
+
+    def remember(self, imei, family):
+        """ Caches the result of a database lookup, "" for an IMEI that is not in things """
+        with self.lock:
+            if family:
+                self.unknown.pop(imei, None)
+                self._store(imei, family)
+            else:
+                self.unknown[imei] = time.monotonic() + self.negative_ttl
+                self.unknown.move_to_end(imei)
+                while len(self.unknown) > self.max_size:
+                    self.unknown.popitem(last=False)
+
+    def _store(self, imei, family):
+        self.families[imei] = family
+        self.families.move_to_end(imei)
+        while len(self.families) > self.max_size:
+            self.families.popitem(last=False)
+
+    def _query(self, cur, imei, prepared=None):
+        def execute(key, sql):
+            if prepared is not None:
+                prepared.execute(cur, key, sql, (imei,))
+            else:
+                cur.execute(sql, (imei,))
+            return cur.fetchone()
+
+        result = execute(("device_lookup", FAMILY_OLD), "SELECT swd_imei FROM things WHERE swd_imei = %s")
+        if result and result[0] == imei:
+            return FAMILY_OLD
+
+        result = execute(("device_lookup", FAMILY_SWX), "SELECT imei FROM things WHERE imei = %s")
+        if result and result[0] == imei:
+            return FAMILY_SWX
+
+        return ""
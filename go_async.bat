@@ -0,0 +1,7 @@
+@echo off
+:loop
+echo Starting Python script...
+python main_async.py
+echo Python script finished, restarting in 5 seconds...
+timeout /t 5
+goto loop
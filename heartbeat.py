@@ -0,0 +1,97 @@
+import time
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class Liveness:
+    """ Progress counters published by the ingest pipeline, per writer worker
+
+    received[worker] is only bumped by the MQTT network thread, for the
+    worker the message is queued for, and committed[worker] only by that
+    worker, so no counter is shared between threads and no lock is needed.
+    """
+
+    def __init__(self, workers=1):
+        self.received = [0] * workers
+        self.committed = [0] * workers
+
+    def snapshot(self):
+        """ Returns ([messages received], [rows committed]) per worker so far """
+        return list(self.received), list(self.committed)
+
+
+def skip_reason(previous, current, interval, settled=None):
+    """ Why no heartbeat should be sent for the interval between two snapshots, None when it should
+
+    Every worker that was handed messages must have committed rows, so a
+    single stuck writer stops the heartbeat even when the others keep going.
+    A worker only counts as stuck for the messages it had received by the
+    settled snapshot, taken a batch age before current, so a message that
+    arrives at the end of the interval still has time to be committed.
+
+    Args:
+        previous tuple: snapshot at the start of the interval
+        current tuple: snapshot at the end of the interval
+        interval int: seconds between previous and current
+        settled tuple: snapshot taken a batch age before current, current when None
+    """
+    (last_received, last_committed), (received, committed) = previous, current
+    arrived = [now - before for now, before in zip(received, last_received)]
+    if not any(arrived):
+        return f"No MQTT messages in the last {interval} seconds, heartbeat not sent"
+    due = [now - before for now, before in zip((settled or current)[0], last_received)]
+    stalled = [worker for worker, count in enumerate(due) if count and committed[worker] == last_committed[worker]]
+    if stalled:
+        waiting = sum(due[worker] for worker in stalled)
+        return f"Writers {stalled} received {waiting} messages but committed nothing in the last {interval} seconds, heartbeat not sent"
+    return None
+
+
+class HeartbeatScheduler(threading.Thread):
+    """ Sends the BetterStack heartbeat from its own thread
+
+    Every interval seconds the counters are compared with the previous
+    interval. The heartbeat is only sent when messages were received and
+    every worker that got some committed rows, so a stalled broker, a
+    stalled database or a single stuck writer stop the heartbeat, while a
+    slow heartbeat endpoint never holds up the writers. Messages received in
+    the last slack seconds of an interval are not yet expected to be committed.
+
+    Args:
+        liveness Liveness: counters of the pipeline
+        send: function that sends one heartbeat
+        interval int: seconds between checks
+        logger: logger for skipped heartbeats
+        slack float: seconds a writer may hold a message before committing it
+    """
+
+    def __init__(self, liveness, send, interval=60, logger=logger, slack=0):
+        super().__init__(name="heartbeat", daemon=True)
+        self.liveness = liveness
+        self.send = send
+        self.interval = interval
+        self.slack = min(slack, interval)
+        self.logger = logger
+        self.stopped = threading.Event()
+
+    def run(self):
+        last = self.liveness.snapshot()
+        while not self.stopped.wait(self.interval - self.slack):
+            settled = self.liveness.snapshot()
+            if self.stopped.wait(self.slack):
+                break
+            current = self.liveness.snapshot()
+            reason = skip_reason(last, current, self.interval, settled)
+            if reason is not None:
+                self.logger.warning(reason)
+            else:
+                started = time.monotonic()
+                self.send()
+                self.logger.debug(f"Heartbeat sent in {time.monotonic() - started:.2f} seconds")
+            last = current
+
+    def stop(self):
+        self.stopped.set()
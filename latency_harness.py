@@ -0,0 +1,549 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import struct
+import argparse
+import datetime
+import tempfile
+import threading
+import psycopg2
+import paho.mqtt.client as mqtt
+
+from collections import deque
+from bench_ingest import SCHEMA, TempPostgres, summarize, configure_environment
+
+
+# MQTT 3.1.1 control packet types the broker handles
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+SCENARIOS = ("steady", "reconnect", "broker-restart", "slow-db")
+
+# Attribute the harness publishes, its payload is the sequence number of the message
+ATTRIBUTE = "harness_seq"
+
+
+def encode_length(length):
+    """ Remaining length of an MQTT packet, seven bits per byte """
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def packet(kind, body=b"", flags=0):
+    return bytes([kind << 4 | flags]) + encode_length(len(body)) + body
+
+
+def encode_string(text):
+    data = text.encode("utf-8")
+    return struct.pack("!H", len(data)) + data
+
+
+def topic_matches(pattern, topic):
+    """ True when topic matches an MQTT topic filter with + and # wildcards """
+    patterns = pattern.split("/")
+    segments = topic.split("/")
+    for i, segment in enumerate(patterns):
+        if segment == "#":
+            return True
+        if i >= len(segments) or segment not in ("+", segments[i]):
+            return False
+    return len(patterns) == len(segments)
+
+
+def receive(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def read_packet(sock):
+    """ Returns (type, flags, body) of the next packet on sock """
+    header = receive(sock, 1)[0]
+    length = 0
+    shift = 0
+    while True:
+        byte = receive(sock, 1)[0]
+        length += (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    return header >> 4, header & 0x0F, receive(sock, length) if length else b""
+
+
+class BrokerSession:
+    """ One client connection of the broker """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.filters = []
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Broker:
+    """ In-process stand-in for the MQTT broker
+
+    Speaks enough MQTT 3.1.1 for the paho client of main.py: CONNECT,
+    SUBSCRIBE and UNSUBSCRIBE, PINGREQ and PUBLISH with QoS 0 or 1. Messages
+    are delivered with QoS 0 to the clients connected at that moment and
+    nothing is retained, as the production broker does for a clean session.
+    The harness publishes in-process with publish(); kick() drops the
+    clients and stop() and start() take the broker away and bring it back.
+
+    Args:
+        host string: address to listen on
+        port int: port to listen on, 0 picks a free one
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.listener = None
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen()
+        # Keep the port, so a restart comes back where the client reconnects to
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, args=(self.listener,), name="broker-accept", daemon=True).start()
+
+    def stop(self):
+        """ Stops listening and drops every client """
+        if self.listener is not None:
+            # shutdown wakes the accept thread, close alone leaves the port taken until it returns
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener.close()
+            self.listener = None
+        self.kick()
+
+    def kick(self):
+        """ Drops every client, without a DISCONNECT, like a broker that goes away """
+        with self.lock:
+            sessions, self.sessions = self.sessions, []
+        for session in sessions:
+            session.close()
+
+    def subscribers(self):
+        with self.lock:
+            return sum(1 for session in self.sessions if session.filters)
+
+    def publish(self, topic, payload):
+        """ Sends a message to every matching client, returns the number it was sent to """
+        data = packet(PUBLISH, encode_string(topic) + payload)
+        with self.lock:
+            sessions = list(self.sessions)
+        sent = 0
+        for session in sessions:
+            if any(topic_matches(pattern, topic) for pattern in session.filters):
+                try:
+                    session.send(data)
+                    sent += 1
+                except OSError:
+                    pass
+        return sent
+
+    def accept(self, listener):
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = BrokerSession(sock)
+            threading.Thread(target=self.serve, args=(session,), name="broker-session", daemon=True).start()
+
+    def serve(self, session):
+        try:
+            while True:
+                kind, flags, body = read_packet(session.sock)
+                if kind == CONNECT:
+                    with self.lock:
+                        self.sessions.append(session)
+                    session.send(packet(CONNACK, b"\x00\x00"))
+                elif kind == SUBSCRIBE:
+                    i, granted = 2, bytearray()
+                    while i < len(body):
+                        length = struct.unpack("!H", body[i:i + 2])[0]
+                        session.filters.append(body[i + 2:i + 2 + length].decode("utf-8"))
+                        i += 2 + length + 1
+                        granted.append(0)
+                    session.send(packet(SUBACK, body[:2] + bytes(granted)))
+                elif kind == UNSUBSCRIBE:
+                    i = 2
+                    while i < len(body):
+                        length = struct.unpack("!H", body[i:i + 2])[0]
+                        pattern = body[i + 2:i + 2 + length].decode("utf-8")
+                        session.filters = [f for f in session.filters if f != pattern]
+                        i += 2 + length
+                    session.send(packet(UNSUBACK, body[:2]))
+                elif kind == PUBLISH:
+                    length = struct.unpack("!H", body[:2])[0]
+                    topic = body[2:2 + length].decode("utf-8")
+                    qos = (flags >> 1) & 3
+                    payload = body[2 + length + (2 if qos else 0):]
+                    if qos:
+                        session.send(packet(PUBACK, body[2 + length:4 + length]))
+                    self.publish(topic, payload)
+                elif kind == PINGREQ:
+                    session.send(packet(PINGRESP))
+                elif kind == DISCONNECT:
+                    break
+        except (OSError, ConnectionError):
+            pass
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+        session.close()
+
+
+class Tracker:
+    """ Published messages and when they became visible in mqtt and things
+
+    A message is visible in things once things holds its sequence number or
+    a newer one of the same device; the writers coalesce updates, so older
+    values may never appear on their own.
+    """
+
+    def __init__(self, env, imeis, storage="columns"):
+        self.env = env
+        self.imeis = imeis
+        self.storage = storage
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.published = {}
+        self.mqtt_seen = {}
+        self.things_seen = {}
+        self.waiting_mqtt = {}
+        self.waiting_things = {imei: deque() for imei in imeis}
+
+    def publish(self, broker, imei):
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+        topic = f"harness/{imei}/{ATTRIBUTE}"
+        published = time.time()
+        delivered = broker.publish(topic, str(seq).encode("utf-8")) > 0
+        with self.lock:
+            self.published[seq] = (published, delivered)
+            if delivered:
+                self.waiting_mqtt[seq] = published
+                self.waiting_things[imei].append(seq)
+        return seq
+
+    def things_sql(self):
+        value = f"attrs->>'{ATTRIBUTE}'" if self.storage == "jsonb" else ATTRIBUTE
+        return f"SELECT imei, {value} FROM things WHERE imei = ANY(%s)"
+
+    def poll(self, cur):
+        """ Marks the messages that are visible now """
+        with self.lock:
+            if not self.waiting_mqtt and not any(self.waiting_things.values()):
+                return
+            oldest = min(self.waiting_mqtt.values(), default=time.time())
+        # main.py stamps a message when it receives it, after it was published
+        cur.execute(
+            "SELECT payload FROM mqtt WHERE env = %s AND timestamp >= %s",
+            (self.env, datetime.datetime.fromtimestamp(oldest - 1)),
+        )
+        mqtt_rows = cur.fetchall()
+        cur.execute(self.things_sql(), (self.imeis,))
+        things_rows = cur.fetchall()
+        now = time.time()
+        with self.lock:
+            for (payload,) in mqtt_rows:
+                seq = int(payload)
+                if self.waiting_mqtt.pop(seq, None) is not None:
+                    self.mqtt_seen[seq] = now
+            for imei, value in things_rows:
+                if value is None:
+                    continue
+                waiting = self.waiting_things[imei]
+                while waiting and waiting[0] <= int(value):
+                    self.things_seen[waiting.popleft()] = now
+
+    def settled(self):
+        with self.lock:
+            return not self.waiting_mqtt and not any(self.waiting_things.values())
+
+    def results(self, first, last):
+        """ Counts and latencies of the messages with sequence numbers first to last """
+        seqs = range(first, last + 1)
+        delivered = [seq for seq in seqs if self.published[seq][1]]
+        mqtt_latency = [self.mqtt_seen[seq] - self.published[seq][0] for seq in delivered if seq in self.mqtt_seen]
+        things_latency = [self.things_seen[seq] - self.published[seq][0] for seq in delivered if seq in self.things_seen]
+        return {
+            "published": len(seqs),
+            "delivered": len(delivered),
+            "visible_mqtt": len(mqtt_latency),
+            "visible_things": len(things_latency),
+            "lost": len(delivered) - len(mqtt_latency),
+            "mqtt_ms": summarize(mqtt_latency),
+            "things_ms": summarize(things_latency),
+        }
+
+
+def prepare_database(conn, imeis, storage, allow_schema_change=True):
+    """ Creates the tables in an empty database, the harness attribute and the things rows of the harness devices
+
+    Args:
+        allow_schema_change bool: False refuses to create tables or the harness column
+
+    Returns:
+        bool: True when the harness column was added, cleanup_database() drops it again
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('mqtt'), to_regclass('things')")
+    create_tables = None in cur.fetchone()
+    add_column = False
+    if storage != "jsonb":
+        cur.execute(
+            "SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'things' AND column_name = %s",
+            (ATTRIBUTE,),
+        )
+        add_column = cur.fetchone() is None
+    if (create_tables or add_column) and not allow_schema_change:
+        conn.rollback()
+        raise SystemExit(f"The database lacks the harness tables or the {ATTRIBUTE} column, pass --allow-destructive to create them")
+
+    if create_tables:
+        for statement in SCHEMA:
+            cur.execute(statement)
+    if add_column:
+        cur.execute(f"ALTER TABLE things ADD COLUMN IF NOT EXISTS {ATTRIBUTE} TEXT")
+    cur.execute(
+        "INSERT INTO things (imei, firstseen, lastupdated) SELECT i, NOW(), NOW() FROM unnest(%s::text[]) i "
+        "WHERE NOT EXISTS (SELECT 1 FROM things WHERE imei = i)",
+        (imeis,),
+    )
+    conn.commit()
+    return add_column
+
+
+def cleanup_database(conn, env, imeis, drop_column=False):
+    """ Deletes the rows of the harness, and its column when prepare_database() added it """
+    cur = conn.cursor()
+    cur.execute("DELETE FROM mqtt WHERE env = %s", (env,))
+    cur.execute("DELETE FROM things WHERE imei = ANY(%s)", (imeis,))
+    if drop_column:
+        cur.execute(f"ALTER TABLE things DROP COLUMN IF EXISTS {ATTRIBUTE}")
+    conn.commit()
+
+
+def stall_database(conn, seconds):
+    """ Blocks writes to mqtt and things for seconds, as a long migration or vacuum would; reads go on """
+    cur = conn.cursor()
+    cur.execute("LOCK TABLE mqtt, things IN SHARE MODE")
+    time.sleep(seconds)
+    conn.commit()
+
+
+def restart_broker(broker, seconds):
+    broker.stop()
+    time.sleep(seconds)
+    broker.start()
+
+
+def run_scenario(scenario, args, broker, tracker, connects, connect):
+    """ Publishes for args.phase seconds, disrupting a third of the way in, and waits for the rows
+
+    Returns:
+        dict: results of the phase
+    """
+    disruption = None
+    disrupt_at = args.phase / 3
+    interval = 1 / args.rate
+    first = tracker.seq + 1
+    started = time.monotonic()
+    sent = 0
+    while True:
+        elapsed = time.monotonic() - started
+        if elapsed >= args.phase:
+            break
+        if disruption is None and elapsed >= disrupt_at and scenario != "steady":
+            disruption = time.time()
+            if scenario == "reconnect":
+                broker.kick()
+            elif scenario == "broker-restart":
+                threading.Thread(target=restart_broker, args=(broker, args.outage), daemon=True).start()
+            elif scenario == "slow-db":
+                threading.Thread(target=stall_database, args=(connect(), args.stall), daemon=True).start()
+        tracker.publish(broker, tracker.imeis[sent % len(tracker.imeis)])
+        sent += 1
+        time.sleep(max(0.0, started + sent * interval - time.monotonic()))
+    last = tracker.seq
+
+    deadline = time.monotonic() + args.settle
+    while not tracker.settled() and time.monotonic() < deadline:
+        time.sleep(args.poll_interval)
+
+    results = tracker.results(first, last)
+    results["scenario"] = scenario
+    if disruption is not None:
+        reconnected = [t for t in connects if t >= disruption]
+        results["reconnects"] = len(reconnected)
+        results["reconnect_seconds"] = round(reconnected[0] - disruption, 3) if reconnected else None
+    return results
+
+
+def report(results):
+    print(f"{'scenario':<16}{'published':>10}{'delivered':>10}{'mqtt':>8}{'things':>8}{'lost':>6}"
+          f"{'mqtt p50':>10}{'p99':>10}{'max':>10}{'things p50':>12}{'p99':>10}{'max':>10}{'reconnect s':>13}")
+    for r in results:
+        m, t = r["mqtt_ms"], r["things_ms"]
+        print(f"{r['scenario']:<16}{r['published']:>10}{r['delivered']:>10}{r['visible_mqtt']:>8}{r['visible_things']:>8}{r['lost']:>6}"
+              f"{str(m['p50']):>10}{str(m['p99']):>10}{str(m['max']):>10}{str(t['p50']):>12}{str(t['p99']):>10}{str(t['max']):>10}"
+              f"{str(r.get('reconnect_seconds', '')):>13}")
+    print("Latencies in milliseconds from publish until the row is visible.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures publish to row-visible latency through a local broker, the paho client of main.py and Postgres")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma separated, out of {', '.join(SCENARIOS)}")
+    parser.add_argument("--rate", type=float, default=200, help="messages per second")
+    parser.add_argument("--phase", type=float, default=20, help="seconds each scenario publishes")
+    parser.add_argument("--devices", type=int, default=20, help="number of devices the messages are spread over")
+    parser.add_argument("--outage", type=float, default=3, help="broker-restart: seconds the broker is away")
+    parser.add_argument("--stall", type=float, default=5, help="slow-db: seconds writes to mqtt and things are blocked")
+    parser.add_argument("--settle", type=float, default=30, help="seconds to wait for the rows after the last message of a scenario")
+    parser.add_argument("--poll-interval", type=float, default=0.01, help="seconds between visibility queries, the resolution of the latencies")
+    parser.add_argument("--writers", type=int, default=int(os.environ.get("WRITER_POOL_SIZE", "1")), help="writer workers")
+    parser.add_argument("--spool-dir", help="enable the write-ahead spool in this directory")
+    parser.add_argument("--use-configured-db", action="store_true", help="run against the POSTGRES_* database instead of a throwaway cluster made with initdb")
+    parser.add_argument("--allow-destructive", action="store_true", help="with --use-configured-db, allow slow-db, which locks mqtt and things, and adding tables or the harness column")
+    parser.add_argument("--keep", action="store_true", help="keep the rows of the harness afterwards")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the log of main.py")
+    args = parser.parse_args()
+    args.env = "harness-" + uuid.uuid4().hex[:8]
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario: {scenario}")
+
+    # slow-db blocks every writer of the database, not only the harness
+    if args.use_configured_db and "slow-db" in scenarios and not args.allow_destructive:
+        parser.error("slow-db locks mqtt and things of the configured database, pass --allow-destructive or leave it out of --scenarios")
+
+    postgres = None if args.use_configured_db else TempPostgres()
+    if postgres is not None:
+        postgres.start()
+        print(f"Started Postgres on port {postgres.port}")
+
+    configure_environment(args, tempfile.mkdtemp(prefix="harness_"))
+    # Imported here, main.py reads its settings and builds its queues at import
+    import main
+    main.DEBUG_MODE = "False"
+    if not args.verbose:
+        main.logger.setLevel("WARNING")
+
+    rng = random.Random(args.env)
+    imeis = ["99" + "".join(rng.choice("0123456789") for _ in range(13)) for _ in range(args.devices)]
+    conn = main.connect_database()
+    added_column = prepare_database(conn, imeis, main.THINGS_STORAGE, allow_schema_change=postgres is not None or args.allow_destructive)
+    main.devices.load(conn.cursor())
+    main.columns.load(conn.cursor())
+    conn.commit()
+    if main.decoder is not None:
+        main.decoder.load_columns(main.columns.types)
+    main.writers.start(main.write_to_database)
+
+    broker = Broker()
+    broker.start()
+    print(f"Broker listening on port {broker.port}, env of the rows is {args.env}")
+
+    # The callbacks of main.py, on_connect also notes when a connection came up
+    connects = []
+
+    def on_connect(client, userdata, flags, rc):
+        connects.append(time.time())
+        main.on_connect(client, userdata, flags, rc)
+
+    client = mqtt.Client(client_id=args.env, clean_session=True)
+    client.on_connect = on_connect
+    client.on_message = main.on_message
+    client.on_disconnect = main.on_disconnect
+    client.connect(broker.host, broker.port, 60)
+    threading.Thread(target=client.loop_forever, name="paho", daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not broker.subscribers() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    if not broker.subscribers():
+        raise SystemExit("main.py did not subscribe to the broker")
+
+    tracker = Tracker(args.env, imeis, main.THINGS_STORAGE)
+    poller_conn = main.connect_database()
+    poller_conn.autocommit = True
+    stop = threading.Event()
+
+    def poll():
+        cur = poller_conn.cursor()
+        while not stop.wait(args.poll_interval):
+            try:
+                tracker.poll(cur)
+            except psycopg2.Error as e:
+                print(f"Visibility query failed: {e}")
+
+    threading.Thread(target=poll, name="harness-poll", daemon=True).start()
+
+    results = []
+    try:
+        for scenario in scenarios:
+            print(f"{datetime.datetime.now()} - Running {scenario}")
+            results.append(run_scenario(scenario, args, broker, tracker, connects, main.connect_database))
+    finally:
+        stop.set()
+        if not args.keep:
+            cleanup_database(conn, args.env, imeis, drop_column=added_column)
+        if postgres is not None:
+            postgres.stop()
+
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    # QoS 0 messages in flight when the connection drops are lost by design, without a disruption none may be
+    lost = sum(r["lost"] for r in results if r["scenario"] == "steady")
+    if lost:
+        print(f"{lost} delivered messages never became visible in mqtt")
+        sys.exit(1)
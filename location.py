@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import math
+import datetime
+import argparse
+import psycopg2
+
+from collections import Counter, OrderedDict
+from dotenv import load_dotenv
+from psycopg2.extras import execute_batch
+
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Characters stored per position, about 5 metres
+GEOHASH_PRECISION = 9
+
+EARTH_RADIUS = 6371000
+
+# Keys a JSON location payload may use
+LATITUDE_KEYS = ("lat", "latitude")
+LONGITUDE_KEYS = ("lon", "lng", "long", "longitude")
+
+CREATE_TABLES = (
+    "CREATE TABLE IF NOT EXISTS device_location ("
+    "imei TEXT PRIMARY KEY, lat DOUBLE PRECISION NOT NULL, lon DOUBLE PRECISION NOT NULL, "
+    "geohash TEXT NOT NULL, recorded TIMESTAMP NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS device_location_geohash ON device_location (geohash text_pattern_ops)",
+    "CREATE TABLE IF NOT EXISTS device_track ("
+    "imei TEXT NOT NULL, bucket TIMESTAMP NOT NULL, lat DOUBLE PRECISION NOT NULL, lon DOUBLE PRECISION NOT NULL, "
+    "geohash TEXT NOT NULL, recorded TIMESTAMP NOT NULL, PRIMARY KEY (imei, bucket))",
+    "CREATE INDEX IF NOT EXISTS device_track_geohash ON device_track (geohash text_pattern_ops, bucket)",
+)
+
+UPSERT_LOCATION = (
+    "INSERT INTO device_location (imei, lat, lon, geohash, recorded) VALUES (%s, %s, %s, %s, %s) "
+    "ON CONFLICT (imei) DO UPDATE SET lat = EXCLUDED.lat, lon = EXCLUDED.lon, geohash = EXCLUDED.geohash, "
+    "recorded = EXCLUDED.recorded WHERE device_location.recorded <= EXCLUDED.recorded"
+)
+
+UPSERT_TRACK = (
+    "INSERT INTO device_track (imei, bucket, lat, lon, geohash, recorded) VALUES (%s, %s, %s, %s, %s, %s) "
+    "ON CONFLICT (imei, bucket) DO UPDATE SET lat = EXCLUDED.lat, lon = EXCLUDED.lon, geohash = EXCLUDED.geohash, "
+    "recorded = EXCLUDED.recorded WHERE device_track.recorded <= EXCLUDED.recorded"
+)
+
+
+def parse_location(payload):
+    """ Reads coordinates from a location payload
+
+    Accepted are a JSON object with lat/latitude and lon/lng/long/longitude,
+    a JSON array [lat, lon] and the text "lat,lon".
+
+    Returns:
+        tuple: (lat, lon), or None when the payload holds no valid coordinates
+    """
+    text = payload.strip()
+    try:
+        if text[:1] == "{":
+            data = json.loads(text)
+            lat = next((data[k] for k in LATITUDE_KEYS if k in data), None)
+            lon = next((data[k] for k in LONGITUDE_KEYS if k in data), None)
+        elif text[:1] == "[":
+            lat, lon = json.loads(text)[:2]
+        else:
+            lat, lon = text.replace(";", ",").split(",")[:2]
+        lat, lon = float(lat), float(lon)
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or (lat == 0 and lon == 0):
+        return None
+    return lat, lon
+
+
+def geohash(lat, lon, precision=GEOHASH_PRECISION):
+    """ Encodes a position as a geohash of precision characters """
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if lon >= mid:
+                value = value * 2 + 1
+                lon_range[0] = mid
+            else:
+                value = value * 2
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                value = value * 2 + 1
+                lat_range[0] = mid
+            else:
+                value = value * 2
+                lat_range[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def cell_size(precision):
+    """ Returns (height, width) in degrees of a geohash cell """
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def covering_cells(lat, lon, radius):
+    """ Geohash prefixes whose cells together cover radius metres around a position
+
+    The precision is the finest one whose cells are at least radius in both
+    directions, so the cell of the position and its eight neighbours cover
+    the circle.
+    """
+    precision = 1
+    for p in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(p)
+        metres = math.pi * EARTH_RADIUS / 180
+        if min(height * metres, width * metres * math.cos(math.radians(lat))) >= radius:
+            precision = p
+            break
+
+    height, width = cell_size(precision)
+    cells = set()
+    for dlat in (-height, 0, height):
+        for dlon in (-width, 0, width):
+            cell_lat = lat + dlat
+            if not -90 <= cell_lat <= 90:
+                continue
+            cell_lon = (lon + dlon + 180) % 360 - 180
+            cells.add(geohash(cell_lat, cell_lon, precision))
+    return sorted(cells)
+
+
+def nearby_sql(table="device_location", cells=1):
+    """ Query for the rows of table near a position, nearest first
+
+    Parameters, in order: lat, lat, lon, one LIKE pattern per cell and the
+    radius in metres. The geohash patterns are index range scans, so the
+    distance is only computed for the rows in the covering cells.
+    """
+    matches = " OR ".join(["geohash LIKE %s"] * cells)
+    return (
+        "SELECT * FROM (SELECT t.*, 2 * " + str(EARTH_RADIUS) + " * asin(sqrt(least(1, "
+        "power(sin(radians(lat - %s) / 2), 2) + cos(radians(%s)) * cos(radians(lat)) * power(sin(radians(lon - %s) / 2), 2)"
+        "))) AS distance FROM " + table + " t WHERE " + matches + ") d WHERE distance <= %s ORDER BY distance"
+    )
+
+
+def nearby(cur, lat, lon, radius, table="device_location"):
+    """ Returns the rows of table within radius metres of (lat, lon), nearest first """
+    cells = covering_cells(lat, lon, radius)
+    cur.execute(nearby_sql(table, len(cells)), [lat, lat, lon] + [cell + "%" for cell in cells] + [radius])
+    return cur.fetchall()
+
+
+class LocationBuffer:
+    """ Positions waiting to be written, kept per writer
+
+    Per device only the newest position is kept for device_location, and per
+    device and track bucket the newest position for device_track, so a
+    device that reports every second costs one track row per bucket.
+    Payloads without valid coordinates are counted per IMEI.
+
+    Args:
+        bucket int: seconds per device_track row
+    """
+
+    def __init__(self, bucket=60):
+        self.bucket = bucket
+        self.last = OrderedDict()
+        self.track = OrderedDict()
+        self.failures = Counter()
+
+    def __len__(self):
+        return len(self.last)
+
+    def add(self, imei, payload, recorded):
+        """ Parses a location payload received at recorded, returns False when it holds no position """
+        position = parse_location(payload)
+        if position is None:
+            self.failures[imei] += 1
+            return False
+
+        lat, lon = position
+        row = (lat, lon, geohash(lat, lon), recorded)
+        previous = self.last.get(imei)
+        if previous is None or previous[3] <= recorded:
+            self.last[imei] = row
+
+        seconds = int(recorded.timestamp()) // self.bucket * self.bucket
+        bucket = datetime.datetime.fromtimestamp(seconds)
+        previous = self.track.get((imei, bucket))
+        if previous is None or previous[3] <= recorded:
+            self.track[(imei, bucket)] = row
+        return True
+
+    def statements(self):
+        """ Yields (key, sql, [params, ...]) for the pending positions """
+        if not self.last:
+            return
+        yield ("location_upsert",), UPSERT_LOCATION, [(imei,) + row for imei, row in self.last.items()]
+        yield ("track_upsert",), UPSERT_TRACK, [(imei, bucket) + row for (imei, bucket), row in self.track.items()]
+
+    def clear(self):
+        self.last = OrderedDict()
+        self.track = OrderedDict()
+
+    def flush(self, cur, prepared=None):
+        """ Writes the pending positions, the caller commits
+
+        Returns:
+            int: number of devices written
+        """
+        for key, sql, params in self.statements():
+            if prepared is not None:
+                prepared.execute_batch(cur, key, sql, params)
+            else:
+                execute_batch(cur, sql, params)
+        count = len(self.last)
+        self.clear()
+        return count
+
+    def take_failures(self):
+        """ Returns and resets the number of unreadable payloads per IMEI """
+        failures, self.failures = self.failures, Counter()
+        return failures
+
+
+def create_tables(conn):
+    """ Creates the location tables and their indexes when they do not exist, and commits """
+    cur = conn.cursor()
+    for statement in CREATE_TABLES:
+        cur.execute(statement)
+    conn.commit()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Device positions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("setup", help="create the location tables")
+    last = sub.add_parser("last", help="last known position of a device")
+    last.add_argument("imei")
+    near = sub.add_parser("near", help="devices whose last position is within radius metres")
+    near.add_argument("lat", type=float)
+    near.add_argument("lon", type=float)
+    near.add_argument("radius", type=float)
+    near.add_argument("--track", action="store_true", help="search the track instead of the last positions")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        host=os.environ.get('POSTGRES_HOST'),
+        dbname=os.environ.get('POSTGRES_DBNAME'),
+        user=os.environ.get('POSTGRES_USER'),
+        password=os.environ.get('POSTGRES_PASSWORD'),
+        port=os.environ.get('POSTGRES_PORT'),
+    )
+    cur = conn.cursor()
+
+    if args.command == "setup":
+        create_tables(conn)
+        print("Location tables are ready.")
+    elif args.command == "last":
+        cur.execute("SELECT imei, lat, lon, recorded FROM device_location WHERE imei = %s", (args.imei,))
+        row = cur.fetchone()
+        if row is None:
+            print(f"No position for {args.imei}")
+            sys.exit(1)
+        print("\t".join(str(v) for v in row))
+    else:
+        table = "device_track" if args.track else "device_location"
+        for row in nearby(cur, args.lat, args.lon, args.radius, table):
+            print("\t".join(str(v) for v in row))
@@ -0,0 +1,116 @@
+import queue
+import logging
+import threading
+import logging.handlers
+
+from collections import Counter, OrderedDict
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler that never blocks the thread that logs
+
+    Once the queue is shed_ratio full, records below WARNING are dropped;
+    when it is completely full every record is dropped. Dropped records are
+    counted per level so the shipper can report them.
+    """
+
+    def __init__(self, log_queue, shed_ratio=0.8):
+        super().__init__(log_queue)
+        self.shed_size = int(log_queue.maxsize * shed_ratio)
+        self.dropped = Counter()
+        self.dropped_lock = threading.Lock()
+
+    def enqueue(self, record):
+        if record.levelno < logging.WARNING and self.queue.qsize() >= self.shed_size:
+            self._drop(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._drop(record)
+
+    def _drop(self, record):
+        with self.dropped_lock:
+            self.dropped[record.levelname] += 1
+
+    def take_dropped(self):
+        """ Returns and resets the number of dropped records per level name """
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, Counter()
+            return dropped
+
+
+class LogShipper(threading.Thread):
+    """ Background thread that hands queued log records to a slow handler
+
+    Loggers get queue_handler instead of the target handler, for example the
+    LogtailHandler, so logging only costs a put on a bounded queue. The
+    shipper takes up to batch_size records at a time, collapses identical
+    records of a batch into one with a repeat count, and passes them on to
+    the target. Records dropped under overload are reported in a summary
+    record.
+
+    Args:
+        target logging.Handler: handler that ships the records
+        max_queue int: records that may wait before records are dropped
+        batch_size int: records taken from the queue at a time
+    """
+
+    def __init__(self, target, max_queue=10000, batch_size=500):
+        super().__init__(name="log-shipper", daemon=True)
+        self.target = target
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.queue_handler = DroppingQueueHandler(self.queue)
+        self.stopping = object()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = self.stopping in batch
+            for record in self.summarize(r for r in batch if r is not self.stopping):
+                self.target.handle(record)
+
+            dropped = self.queue_handler.take_dropped()
+            if dropped:
+                counts = ", ".join(f"{count} {level}" for level, count in sorted(dropped.items()))
+                self.target.handle(logging.makeLogRecord({
+                    "name": __name__,
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": f"Logging overloaded, dropped {sum(dropped.values())} records ({counts})",
+                }))
+
+            if stop:
+                self.target.flush()
+                return
+
+    def summarize(self, records):
+        """ Collapses records with the same logger, level and message """
+        groups = OrderedDict()
+        for record in records:
+            key = (record.name, record.levelno, record.getMessage())
+            if key in groups:
+                groups[key][1] += 1
+            else:
+                groups[key] = [record, 1]
+
+        for record, count in groups.values():
+            if count > 1:
+                record.msg = f"{record.getMessage()} (repeated {count} times)"
+                record.args = None
+            yield record
+
+    def stop(self, timeout=5):
+        """ Ships what is queued and stops the thread """
+        try:
+            self.queue.put(self.stopping, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
@@ -1,5 +1,6 @@
 import os
 import sys
+import glob
 import uuid
 import time
 import queue
@@ -9,15 +10,31 @@ import datetime
 import psycopg2
 import requests
 import binascii
-import threading
 import sentry_sdk
 import crcmod.predefined
 import paho.mqtt.client as mqtt
 
-from psycopg2 import errors
 from telit import telitHandler
 from dotenv import load_dotenv
+from batch_writer import MqttCopyBatch
+from commit_policy import make_commit_policy
+from device_registry import DeviceRegistry
+from things_coalescer import ThingsCoalescer
+from spill_queue import SpillQueue
+from spool import WriteAheadSpool
+from writer_pool import WriterPool
+from column_registry import ColumnRegistry
+from attribute_registry import AttributeRegistry
+from prepared_statements import PreparedStatements
+from payload_decoder import PayloadDecoder
+from location import LocationBuffer, create_tables as create_location_tables
+from stats_rollup import StatsRollup, create_tables as create_stats_tables
+from topic_router import TopicRouter, ATTRIBUTE, LOCATION, CONNECTION, STATS, parse_routes
+from partition_manager import PartitionManager, PartitionMaintenance
+from heartbeat import Liveness, HeartbeatScheduler
 from logtail import LogtailHandler
+from log_shipper import LogShipper
+from metrics import IngestMetrics, MetricsServer
 
 
 
@@ -26,8 +43,18 @@ from logtail import LogtailHandler
 def handle_termination_signals(signum, frame):
     logger.error(f"Signal received at line {frame.f_lineno} in {frame.f_code.co_filename}")
     logger.critical(f"Received signal {signum}. Stopping script.")
+    # Only raise: the interrupted code may hold the spool lock, which is released while
+    # SystemExit unwinds it, and shutdown() runs once the main loop has been left
     sys.exit(0)
 
+
+def shutdown():
+    # Make sure everything received so far is on disk for the next start
+    if spool is not None and not spool.close(timeout=SPOOL_CLOSE_TIMEOUT):
+        logger.error("Spool lock not released, closed without a final sync")
+    if log_shipper is not None:
+        log_shipper.stop()
+
 # Trap common stop signals
 signal.signal(signal.SIGINT, handle_termination_signals)  # Handle Ctrl+C
 signal.signal(signal.SIGTERM, handle_termination_signals)  # Handle termination
@@ -48,6 +75,102 @@ SENTRY_DSN=os.environ.get("SENTRY_DSN")
 BETTERSTACK_HEARTBEAT_URL=os.environ.get("BETTERSTACK_HEARTBEAT_URL")
 DEBUG_MODE = os.environ.get("DEBUG_MODE")
 
+# Raw messages are loaded into the mqtt table with COPY and committed in batches of up to
+# WRITE_BATCH_SIZE rows or WRITE_BATCH_MAX_BYTES bytes, or after WRITE_BATCH_MAX_AGE_MS
+# milliseconds, whichever comes first. With the "adaptive" policy these are upper limits and
+# batches shrink or grow to keep the p99 latency batching adds near WRITE_BATCH_TARGET_P99_MS.
+WRITE_BATCH_POLICY = os.environ.get("WRITE_BATCH_POLICY", "static")
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "1000"))
+WRITE_BATCH_MAX_BYTES = int(os.environ.get("WRITE_BATCH_MAX_BYTES", str(4 * 1024 * 1024)))
+WRITE_BATCH_MAX_AGE_MS = float(os.environ.get("WRITE_BATCH_MAX_AGE_MS", "1000"))
+WRITE_BATCH_TARGET_P99_MS = float(os.environ.get("WRITE_BATCH_TARGET_P99_MS", "500"))
+
+# Size of the in-memory IMEI to device family map, and how long an IMEI that
+# is not in things is remembered before the database is asked again
+DEVICE_REGISTRY_SIZE = int(os.environ.get("DEVICE_REGISTRY_SIZE", "100000"))
+DEVICE_REGISTRY_NEGATIVE_TTL = float(os.environ.get("DEVICE_REGISTRY_NEGATIVE_TTL", "60"))
+
+# Attribute updates to things are merged per device over this many seconds
+# and written as one UPDATE per device
+THINGS_COALESCE_WINDOW = float(os.environ.get("THINGS_COALESCE_WINDOW", "1.0"))
+THINGS_COALESCE_MAX_DEVICES = int(os.environ.get("THINGS_COALESCE_MAX_DEVICES", "5000"))
+
+# "columns" keeps one things column per topic, created with ALTER TABLE when a topic is new.
+# "jsonb" merges the attributes into things.attrs and shows them as columns in things_view.
+THINGS_STORAGE = os.environ.get("THINGS_STORAGE", "columns")
+
+# With PAYLOAD_TYPES=True attribute payloads are decoded to the type of their attribute
+# (integer, float, boolean, JSON or text) before they are written to things
+PAYLOAD_TYPES = os.environ.get("PAYLOAD_TYPES")
+
+# Payloads of an attribute that must agree on its type before its new column is typed, it is TEXT otherwise
+PAYLOAD_TYPE_SAMPLES = int(os.environ.get("PAYLOAD_TYPE_SAMPLES", "10"))
+
+# With LOCATION_TABLES=True positions from location topics are parsed and written to
+# device_location (last position) and device_track (one row per LOCATION_TRACK_BUCKET seconds)
+LOCATION_TABLES = os.environ.get("LOCATION_TABLES")
+LOCATION_TRACK_BUCKET = int(os.environ.get("LOCATION_TRACK_BUCKET", "60"))
+
+# With STATS_ROLLUP=True mqttstats payloads are counted per device and minute in memory and
+# written to mqttstats_rollup every STATS_ROLLUP_WINDOW seconds. The raw rows are only kept
+# in mqtt when STATS_KEEP_RAW=True.
+STATS_ROLLUP = os.environ.get("STATS_ROLLUP")
+STATS_ROLLUP_WINDOW = float(os.environ.get("STATS_ROLLUP_WINDOW", "60"))
+STATS_KEEP_RAW = os.environ.get("STATS_KEEP_RAW", "True")
+
+# Extra topic routes on top of the defaults in topic_router.py, as "filter=kind,..." where kind
+# is raw, attribute, location, connection or stats, e.g. "+/+/debug=raw"
+TOPIC_ROUTES = os.environ.get("TOPIC_ROUTES", "")
+
+# Memory budget of the write queue. Messages beyond it are spilled to a local file
+# and replayed in order; once the file is full, on_message blocks.
+WRITE_QUEUE_MEMORY_MB = float(os.environ.get("WRITE_QUEUE_MEMORY_MB", "256"))
+WRITE_QUEUE_SPILL_FILE = os.environ.get("WRITE_QUEUE_SPILL_FILE", "write_queue.spill")
+WRITE_QUEUE_SPILL_MAX_MB = float(os.environ.get("WRITE_QUEUE_SPILL_MAX_MB", "1024"))
+
+# Optional write-ahead spool. When SPOOL_DIR is set every message is logged there before
+# it is queued, and messages that were not committed are replayed on the next start.
+SPOOL_DIR = os.environ.get("SPOOL_DIR")
+SPOOL_SEGMENT_MB = float(os.environ.get("SPOOL_SEGMENT_MB", "64"))
+SPOOL_FSYNC_INTERVAL = float(os.environ.get("SPOOL_FSYNC_INTERVAL", "0.05"))
+
+# Seconds shutdown waits for the spool lock before it gives up on the final sync
+SPOOL_CLOSE_TIMEOUT = 5.0
+
+# Number of writer workers. Each has its own queue and Postgres connection, and
+# messages are routed by IMEI so the messages of a device stay in order.
+WRITER_POOL_SIZE = int(os.environ.get("WRITER_POOL_SIZE", "1"))
+
+# How often, in seconds, each writer logs how much of its time it spent writing
+WRITER_REPORT_INTERVAL = float(os.environ.get("WRITER_REPORT_INTERVAL", "300"))
+
+# Prepared statements kept per Postgres connection. The things updates are prepared
+# per device family and column set, the device lookups once.
+PREPARED_STATEMENTS_MAX = int(os.environ.get("PREPARED_STATEMENTS_MAX", "512"))
+
+# The heartbeat is sent, from its own thread, every HEARTBEAT_INTERVAL seconds in which messages
+# were received and every writer that got some committed rows; the request gives up after
+# HEARTBEAT_TIMEOUT seconds
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", "60"))
+HEARTBEAT_TIMEOUT = float(os.environ.get("HEARTBEAT_TIMEOUT", "10"))
+
+# When mqtt is partitioned (see partition_manager.py migrate), partitions of PARTITION_INTERVAL,
+# "day" or "week", are created PARTITION_PREMAKE intervals ahead and dropped PARTITION_RETENTION_DAYS
+# after their range ended (0 keeps them). Checked every PARTITION_CHECK_INTERVAL seconds.
+PARTITION_INTERVAL = os.environ.get("PARTITION_INTERVAL")
+PARTITION_PREMAKE = int(os.environ.get("PARTITION_PREMAKE", "7"))
+PARTITION_RETENTION_DAYS = int(os.environ.get("PARTITION_RETENTION_DAYS", "0"))
+PARTITION_CHECK_INTERVAL = float(os.environ.get("PARTITION_CHECK_INTERVAL", "3600"))
+
+# Log records waiting to be shipped to Logtail before records are dropped, and
+# records shipped at a time
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "500"))
+
+# Prometheus metrics are served on METRICS_HOST:METRICS_PORT/metrics when METRICS_PORT is set
+METRICS_PORT = os.environ.get("METRICS_PORT")
+METRICS_HOST = os.environ.get("METRICS_HOST", "0.0.0.0")
+
 print(f"DEBUG_MODE: {DEBUG_MODE}")
 
 # if DEBUG_MODE != "True":
@@ -67,16 +190,19 @@ print(f"DEBUG_MODE: {DEBUG_MODE}")
 # Create a CRC-32 checksum object
 crc32 = crcmod.predefined.Crc('crc-32')
 
-# To keep track of the last heartbeat time. this is used to check if the script has been running for more than 1 minute and send a heartbeat to betterstack. 
-# The check is done only when a MQTT message arrives. Hence, this is to verify MQTT messages are flowing.
-last_heartbeat_time = time.time()
+
+# Records are handed to a background thread that ships them to Logtail, so logging
+# never blocks the MQTT or writer threads
+log_shipper = None
 
 if DEBUG_MODE != "True":
     handler = LogtailHandler(source_token=BETTERSTACK_TOKEN)
+    log_shipper = LogShipper(handler, max_queue=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE)
+    log_shipper.start()
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
     logger.handlers = []
-    logger.addHandler(handler)
+    logger.addHandler(log_shipper.queue_handler)
 else:
     # Create a logger
     logger = logging.getLogger('screen_logger')
@@ -101,34 +227,49 @@ else:
 
     logger.info("Starting up...")
 
-# Create a queue for messages that need to be written to the database
-write_queue = queue.Queue()
+# Write-ahead spool of received messages that are not committed yet
+spool = None
+if SPOOL_DIR:
+    spool = WriteAheadSpool(SPOOL_DIR, segment_bytes=int(SPOOL_SEGMENT_MB * 1024 * 1024), fsync_interval=SPOOL_FSYNC_INTERVAL)
+    # The spool replays everything that was not committed, including what was spilled
+    for path in glob.glob(WRITE_QUEUE_SPILL_FILE + "*"):
+        os.remove(path)
 
+# crc of replayed messages whose raw row is already in mqtt
+replayed_crcs = set()
 
-def check_and_send_heartbeat():
-    """
-    This function checks if 60 seconds (1 minute) have passed since the last heartbeat.
-    If the time difference is greater than or equal to 60 seconds, it sends a heartbeat to BetterStack.
 
-    Global Variables:
-    last_heartbeat_time (int): The timestamp of the last heartbeat sent to BetterStack.
+def make_write_queue(worker):
+    # Every worker gets an equal share of the memory and spill budgets
+    spill_path = WRITE_QUEUE_SPILL_FILE if WRITER_POOL_SIZE == 1 else f"{WRITE_QUEUE_SPILL_FILE}.{worker}"
+    return SpillQueue(
+        max_memory=int(WRITE_QUEUE_MEMORY_MB * 1024 * 1024 / WRITER_POOL_SIZE),
+        spill_path=spill_path,
+        max_spill=int(WRITE_QUEUE_SPILL_MAX_MB * 1024 * 1024 / WRITER_POOL_SIZE),
+    )
 
-    Returns:
-    None
-    """
 
-    global last_heartbeat_time
+# Create the queues for messages that need to be written to the database, one per writer
+writers = WriterPool(WRITER_POOL_SIZE, make_write_queue)
 
+# Messages received and rows committed, read by the heartbeat thread
+liveness = Liveness(WRITER_POOL_SIZE)
 
-    # Get the current time
-    current_time = time.time()
-    
-    # Check if 60 seconds (1 minute) has passed since the last heartbeat
-    if current_time - last_heartbeat_time >= 60:
-        send_heartbeat()
-        # Update the last heartbeat time
-        last_heartbeat_time = current_time
-    
+# Counters and histograms for the metrics endpoint, kept per thread
+metrics = IngestMetrics()
+metrics.watch_queues(writers.queues)
+
+# Known devices, loaded from things at startup and consulted for every message
+devices = DeviceRegistry(max_size=DEVICE_REGISTRY_SIZE, negative_ttl=DEVICE_REGISTRY_NEGATIVE_TTL)
+
+# Decides per topic what happens with a message besides storing it in mqtt
+router = TopicRouter(parse_routes(TOPIC_ROUTES))
+
+# Columns of things, loaded at startup; missing ones are created before values are written
+columns = AttributeRegistry() if THINGS_STORAGE == "jsonb" else ColumnRegistry()
+
+# Type per attribute, None when payloads are stored as text
+decoder = PayloadDecoder(PAYLOAD_TYPE_SAMPLES) if PAYLOAD_TYPES == "True" else None
 
 
 def create_crc(data):
@@ -145,6 +286,7 @@ def create_crc(data):
     return hex_checksum
 
 def on_connect(client, userdata, flags, rc):
+    metrics.connects.inc("success" if rc == 0 else "failed")
     if rc == 0:
         logger.info("Connected to MQTT broker")
         # push.send_message("MQTT connected", title="MQTT Connected")
@@ -159,6 +301,7 @@ def on_disconnect(client, userdata, rc):
     retry_delay = 5        # Delay between retries in seconds
     retries = 0
     
+    metrics.disconnects.inc("true" if rc == 0 else "false")
     if rc != 0:
         logger.warning("MQTT connection lost. Reconnecting...")
 
@@ -166,10 +309,12 @@ def on_disconnect(client, userdata, rc):
         logger.warning(f"Attempting to reconnect, try {retries + 1} of {max_retries}...")
         try:
             client.reconnect()
+            metrics.connects.inc("reconnected")
             logger.info("Reconnected successfully.")
             return  # Exit function if reconnected successfully
         except Exception as e:
             retries += 1
+            metrics.connects.inc("failed")
             logger.error(f"Reconnect attempt {retries} failed. Error: {str(e)}")
             if retries < max_retries:
                 logger.info(f"Retrying in {retry_delay} seconds...")
@@ -188,139 +333,370 @@ def on_message(client, userdata, msg):
         my_date = datetime.datetime.now() 
         
         serial_number = my_date.strftime("%Y%m%d%H%M%S%f")
-        imei = msg.topic.split("/")[1]
+        route = router.route(msg.topic)
+        if route is None:
+            metrics.dropped.inc("no_imei")
+            logger.warning("Topic %s has no IMEI, message ignored", msg.topic)
+            return
+        imei = route.imei
         payload = msg.payload.decode("utf-8")
         crc = create_crc(msg.topic + payload + serial_number)
         t = uuid.uuid4().hex
         crc = crc + t
-        # Add message and CRC to write queue if CRC is unique
-        write_queue.put((my_date, imei, msg.topic, payload, crc))
+        message = (my_date, imei, msg.topic, payload, crc)
+        metrics.received.inc(route.kind, route.attribute)
+        shard = writers.shard(imei)
+        liveness.received[shard] += 1
+        if spool is not None:
+            spool.append(message, shard)
+        # Add message and CRC to the write queue of the worker that owns this IMEI
+        writers.put(message, shard)
         
     except Exception as e:
+        metrics.dropped.inc("error")
         logger.error("Error handling MQTT message: %s", str(e))
         
 
-def write_to_database():
-    global conn, telit
-    
-    # Call the function to send the heartbeat
-    
-   
-    while True:
-        try:
-
-                
-            cur = conn.cursor()
-            while True:
-                
+class PendingWrites:
+    """What a writer has taken from its queue besides raw rows: things updates, positions and stats."""
+
+    def __init__(self):
+        # Pending attribute updates for things, one UPDATE per device per window
+        self.coalescer = ThingsCoalescer(window=THINGS_COALESCE_WINDOW, max_devices=THINGS_COALESCE_MAX_DEVICES, storage=THINGS_STORAGE)
+        # Positions for the location tables, written with the raw batch
+        self.locations = LocationBuffer(bucket=LOCATION_TRACK_BUCKET) if LOCATION_TABLES == "True" else None
+        # Per-minute mqttstats counters, written every STATS_ROLLUP_WINDOW seconds
+        self.stats = StatsRollup(window=STATS_ROLLUP_WINDOW) if STATS_ROLLUP == "True" else None
+        # Messages taken from the queue at the last flush of each buffer
+        self.flushed_at = {"coalescer": 0, "stats": 0}
+
+    def timeouts(self):
+        """Seconds until each pending kind of write is due."""
+        if len(self.coalescer):
+            yield self.coalescer.window - self.coalescer.age()
+        if self.stats is not None and len(self.stats):
+            yield self.stats.remaining()
+
+    def is_due(self):
+        return self.coalescer.is_due() or (self.stats is not None and self.stats.is_due())
+
+    def flushed(self, name, taken):
+        """Records that the "coalescer" or "stats" buffer was written when taken messages had been taken from the queue."""
+        self.flushed_at[name] = taken
+
+    def written_through(self, taken):
+        """
+        Number of messages, counted from the start of the writer, whose writes are all done. A buffer
+        that still holds updates limits it to the messages taken up to its last flush, so the spool
+        keeps advancing while the coalescer or the stats rollup is never empty.
+        """
+        marks = [taken]
+        if len(self.coalescer):
+            marks.append(self.flushed_at["coalescer"])
+        if self.stats is not None and len(self.stats):
+            marks.append(self.flushed_at["stats"])
+        return min(marks)
+
+
+def write_to_database(worker, write_queue):
+    # Every worker has its own connection so a slow statement only holds up its own devices
+    conn = opendatabase()
+    prepared = PreparedStatements(max_statements=PREPARED_STATEMENTS_MAX)
+
+    # Raw rows for the mqtt table, sent with COPY just before each commit
+    policy = make_commit_policy(WRITE_BATCH_POLICY, WRITE_BATCH_SIZE, WRITE_BATCH_MAX_BYTES, WRITE_BATCH_MAX_AGE_MS, WRITE_BATCH_TARGET_P99_MS)
+    batch = MqttCopyBatch(policy)
+    pending = PendingWrites()
+    coalescer, locations, stats = pending.coalescer, pending.locations, pending.stats
+    # Messages taken from the queue, and how many of them are acknowledged to the spool
+    taken = 0
+    acknowledged = 0
+    # When idle and busy time was last reported
+    last_report = time.monotonic()
 
+    try:
+        cur = conn.cursor()
+        while True:
+            # Sleep until a message arrives or pending work has to be written
+            timeout = next_flush_timeout(batch, pending)
+            if timeout is None:
+                # Nothing is pending, but a device lookup of a replayed message may have opened
+                # a transaction; it must not keep its lock on things while the writer sleeps
+                conn.commit()
+            waited = time.monotonic()
+            try:
+                message = write_queue.get(timeout=timeout)
+            except queue.Empty:
+                message = None
+            woke = time.monotonic()
+            writers.idle[worker] += woke - waited
+
+            if message is not None:
+                taken += 1
+                process_message(cur, message, batch, pending, prepared)
+
+            # Commit when the batch is full or its oldest row, the coalescing window or the stats window is due
+            if batch.is_due() or pending.is_due():
+                if coalescer.is_due():
+                    flush_things_updates(conn, cur, coalescer, prepared)
+                    pending.flushed("coalescer", taken)
+
+                waited_in_batch = batch.age()
+                flush_started = time.monotonic()
+                rows = 0
+                rolled_up = 0
                 if DEBUG_MODE != "True":
-                    check_and_send_heartbeat()
-
-                try:
-                    # Get the next message from the write queue
-                    message = write_queue.get(block=False)
-                    # if DEBUG_MODE == "True":
-                    #     print("Processing message: %s", str(message))
-
-                except queue.Empty:
-                    break
-                try:
-                    # Insert the message into the database
-                    env = MQTT_ENV
-                    last_slash_index = message[2].rfind('/')
-                    # Slice the string from the character after the last '/'
-                    topic = message[2][last_slash_index + 1:]
-                    imei = message[1]
-                    
-                    if DEBUG_MODE != "True":
-                        cur.execute("INSERT INTO mqtt (timestamp, imei, message, payload, crc, env, topic) VALUES (%s, %s, %s, %s, %s, %s, %s)", (*message,env,topic))
-                   
-                    
-                    device_type = ""
-
-                    cur.execute("SELECT swd_imei FROM things WHERE swd_imei = %s", (message[1],))
-                    # Fetch the result
-                    result = cur.fetchone()
-                    # Check if a row was returned and if the IMEI matches
-                    if result and result[0] == message[1]:
-                        device_type = "old"
-                    
-                    if device_type == "":
-                        cur.execute("SELECT imei FROM things WHERE imei = %s", (message[1],))
-                        # Fetch the result
-                        result = cur.fetchone()
-                        # Check if a row was returned and if the IMEI matches
-                        if result and result[0] == message[1]:
-                            device_type = "swx"
-                        
-                    
-                    if device_type != "":
-
-                        if device_type == "old":
-                            q = "UPDATE things SET " + topic + "='"+ message[3] +"', lastupdated=NOW() WHERE swd_imei = '"+ message[1] +"'"
-                        elif device_type == "swx":
-                            q = "UPDATE things SET " + topic + "='"+ message[3] +"', lastupdated=NOW() WHERE imei = '"+ message[1] +"'"
-                        
-                            
-                        if device_type != "" and DEBUG_MODE != "True":
-                            cur.execute(q)
-                        else:
-                            print(q)
-
-                    else:
-                        strings_to_check = ["connect", "connection", "disconnect", "location", "mqttstats"]
-                        if not any(s in topic for s in strings_to_check):
-                            if device_type == "old":
-                                q = "INSERT INTO things (swd_imei, " + topic + "," + "lastupdated, firstseen) VALUES ('" + message[1] +"', '" + message[3] + "', NOW(), NOW())"
-                            elif device_type == "swx":
-                                q = "INSERT INTO things (imei, " + topic + "," + "lastupdated, firstseen) VALUES ('" + message[1] +"', '" + message[3] + "', NOW(), NOW())"
-                            
-                            if DEBUG_MODE != "True":
-                                cur.execute(q)
-                            else:
-                                print(q)
-
-                except errors.UndefinedColumn as e:
-                        conn.rollback()
-                        logger.warning("Column not present: %s", str(e))
-                        logger.info("Creating column: ", topic)
-                        sql="ALTER TABLE things ADD COLUMN " + topic + " TEXT;"
-                        if DEBUG_MODE != "True":
-                            cur.execute(sql)
-                            conn.commit()
-                        else:
-                            logger.info(sql)
-                        
-                        
-                        
-                        
-                
-                except Exception as e:
-                    logger.error("Error inserting/updating message in database: %s", str(e))
-                    sys.exit(1)
-                    # Handle unique constraint violations separately
-                    
-            conn.commit()
-            
-        except Exception as e:
-            logger.error("Error writing to database: %s", str(e))
-            sys.exit(1)
+                    if locations is not None:
+                        with metrics.statement_seconds.time("locations"):
+                            locations.flush(cur, prepared)
+                    if stats is not None and stats.is_due():
+                        with metrics.statement_seconds.time("stats_rollup"):
+                            rolled_up = stats.flush(cur, prepared)
+                        pending.flushed("stats", taken)
+                    if len(batch):
+                        metrics.batch_rows.observe(len(batch))
+                        metrics.batch_bytes.observe(batch.bytes)
+                        with metrics.statement_seconds.time("copy"):
+                            rows = batch.flush(cur)
+                else:
+                    if locations is not None:
+                        locations.clear()
+                    if stats is not None and stats.is_due():
+                        stats.clear()
+                        pending.flushed("stats", taken)
+                    batch.clear()
+                with metrics.commit_seconds.time():
+                    conn.commit()
+                liveness.committed[worker] += rows + rolled_up
+                metrics.committed.inc(amount=rows)
+                if rows:
+                    policy.observe(waited_in_batch + time.monotonic() - flush_started, rows)
+
+                # Acknowledge everything taken up to the oldest flush of a buffer that still holds updates
+                if spool is not None:
+                    written = pending.written_through(taken)
+                    if written > acknowledged:
+                        spool.commit(written - acknowledged, worker)
+                        acknowledged = written
+
+            writers.busy[worker] += time.monotonic() - woke
+
+            if woke - last_report >= WRITER_REPORT_INTERVAL:
+                idle, busy = writers.idle[worker], writers.busy[worker]
+                logger.info(f"Writer {worker} was busy {100 * busy / max(idle + busy, 1e-9):.1f}% of the time, queue depth {write_queue.qsize()}, commit policy {policy.describe()}")
+                writers.idle[worker] = writers.busy[worker] = 0.0
+                if decoder is not None:
+                    widened = decoder.take_widened()
+                    if widened:
+                        logger.warning(f"Attributes whose type was widened by payloads that did not fit: {dict(widened.most_common(20))}")
+                if locations is not None:
+                    failures = locations.take_failures()
+                    if failures:
+                        logger.warning(f"Location payloads without coordinates: {dict(failures.most_common(20))}")
+                if stats is not None:
+                    failures = stats.take_failures()
+                    if failures:
+                        logger.warning(f"Stats payloads without numbers: {dict(failures.most_common(20))}")
+                last_report = woke
+
+    except Exception as e:
+        logger.error("Error writing to database: %s", str(e))
+        sys.exit(1)
+
+
+def next_flush_timeout(batch, pending):
+    """
+    Seconds until the raw batch, the coalesced things updates or the stats are due to be written,
+    or None when nothing is pending and the writer can wait for the next message.
+    """
+
+    timeouts = list(pending.timeouts())
+    if len(batch):
+        timeouts.append(batch.remaining())
+    if not timeouts:
+        return None
+    return max(min(timeouts), 0)
+
+
+def process_message(cur, message, batch, pending, prepared):
+    """Adds a message to the raw batch and hands it to the handler of its topic."""
+
+    route = router.route(message[2])
+
+    # Queue the raw row for the next COPY into mqtt, unless a replay found it committed
+    # or it is a stats message that only goes into the rollup
+    if message[4] in replayed_crcs:
+        replayed_crcs.discard(message[4])
+    elif route.kind != STATS or pending.stats is None or STATS_KEEP_RAW == "True":
+        batch.add((*message, MQTT_ENV, route.attribute))
+
+    handler = TOPIC_HANDLERS.get(route.kind)
+    if handler is not None:
+        handler(cur, route, message, pending, prepared)
+
+
+def store_attribute(cur, route, message, pending, prepared):
+    """Queues the payload as the latest value of an attribute of a known device."""
+
+    # Old devices are keyed on swd_imei, swx devices on imei
+    device_type = devices.lookup(cur, route.imei, prepared)
+    if device_type == "":
+        return
+
+    column = columns.column_name(route.attribute)
+    if column is None:
+        if columns.reject(route.attribute):
+            logger.warning("Topic %s cannot be stored as a things column", route.attribute)
+        return
+
+    value = message[3]
+    if decoder is not None:
+        value = decoder.decode(column, value)
+    # Keep the latest value, it is written when the coalescing window closes
+    pending.coalescer.add(device_type, route.imei, column, value)
+
+
+def store_location(cur, route, message, pending, prepared):
+    """Queues the position for the location tables and keeps the payload as a things attribute."""
+
+    if pending.locations is not None and not pending.locations.add(route.imei, message[3], message[0]):
+        metrics.dropped.inc("no_position")
+    store_attribute(cur, route, message, pending, prepared)
+
+
+def store_stats(cur, route, message, pending, prepared):
+    """Adds the payload to the stats rollup, or keeps it as a things attribute without one."""
+
+    if pending.stats is None:
+        store_attribute(cur, route, message, pending, prepared)
+    elif not pending.stats.add(route.imei, message[3], message[0]):
+        metrics.dropped.inc("no_numbers")
+
+
+# Handler per topic kind; raw topics are only stored in mqtt. Connection events are
+# still kept as things attributes of known devices.
+TOPIC_HANDLERS = {
+    ATTRIBUTE: store_attribute,
+    LOCATION: store_location,
+    CONNECTION: store_attribute,
+    STATS: store_stats,
+}
+
+
+def flush_things_updates(conn, cur, coalescer, prepared=None):
+    """
+    Writes the coalesced things updates. Columns that are not in the column registry
+    are created first, and columns narrower than the decoded values are widened, so the
+    updates never refer to a column that does not exist or cannot hold the value.
+    """
+
+    names = coalescer.columns()
+    missing = columns.missing(names)
+    typed = decoder is not None and THINGS_STORAGE != "jsonb"
+    retype = decoder.retype(names, columns.types) if typed else {}
+    if (missing or retype) and DEBUG_MODE != "True":
+        # ALTER TABLE waits for every open transaction on things, including our own
+        conn.commit()
+        types = decoder.sql_types(missing) if typed else None
+        for name in columns.create(conn, missing, types):
+            metrics.columns_created.inc(columns.kind)
+            logger.info("Created %s: %s", columns.kind, name)
+        for name in columns.retype(conn, retype):
+            logger.info("Changed the type of column %s to %s", name, retype[name])
+
+    with metrics.statement_seconds.time("things_update"):
+        return coalescer.flush(cur, debug=DEBUG_MODE == "True", prepared=prepared, types=columns.types if typed else None)
+
+
+def remember_committed(cur, messages):
+    """Adds the crc of the messages whose raw row is already in mqtt to replayed_crcs."""
+
+    cur.execute("SELECT crc FROM mqtt WHERE crc = ANY(%s)", ([m[4] for m in messages],))
+    replayed_crcs.update(row[0] for row in cur.fetchall())
+
+
+def check_spilled(conn, chunk_size=1000):
+    """
+    Looks up the messages a previous run left in the spill files. The read offset of a
+    spill file can be behind what was committed, so some of them may already be in mqtt;
+    their crc is remembered so the writer skips the raw row but still applies the things
+    update.
+
+    Returns:
+    int: number of spilled messages
+    """
+
+    cur = conn.cursor()
+    count = 0
+    for write_queue in writers.queues:
+        chunk = []
+        for message in write_queue.unread():
+            chunk.append(message)
+            if len(chunk) >= chunk_size:
+                remember_committed(cur, chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            remember_committed(cur, chunk)
+            count += len(chunk)
+
+    conn.commit()
+    return count
+
+
+def replay_spool(conn, chunk_size=1000):
+    """
+    Puts the messages the spool holds past its committed offset back on the write queue.
+    The offset is only written after a commit, so the raw row of some of them may already
+    be in mqtt; their crc is remembered so the writer skips the raw row but still applies
+    the things update.
+
+    Returns:
+    int: number of messages replayed
+    """
+
+    cur = conn.cursor()
+    count = 0
+    chunk = []
+
+    def enqueue(messages):
+        remember_committed(cur, [m for _, m in messages])
+        for shard, m in messages:
+            writers.put(m, shard)
+
+    for seq, message in spool.uncommitted():
+        # Hand the message to its worker right away so the spool cannot commit past it
+        shard = writers.shard(message[1])
+        spool.track(seq, shard)
+        chunk.append((shard, message))
+        if len(chunk) >= chunk_size:
+            enqueue(chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        enqueue(chunk)
+        count += len(chunk)
+
+    conn.commit()
+    return count
+
             
-def opendatabase():
-    global conn
-    
+def connect_database():
     # Retrieve Postgres database credentials from environment variables
     host = os.environ.get('POSTGRES_HOST')
     dbname = os.environ.get('POSTGRES_DBNAME')
     user = os.environ.get('POSTGRES_USER')
     password = os.environ.get('POSTGRES_PASSWORD')
     port = os.environ.get('POSTGRES_PORT')
-    
+
+    return psycopg2.connect(host=host, dbname=dbname, user=user, password=password, port=port)
+
+
+def opendatabase():
     try:
         if DEBUG_MODE != "True":
             logger.info("Opening database")
-        conn = psycopg2.connect(host=host, dbname=dbname, user=user, password=password, port=port)
+        conn = connect_database()
     except Exception as e:
         if DEBUG_MODE != "True":
             logger.critical("Error connecting to database: %s", str(e))
@@ -335,7 +711,7 @@ def send_heartbeat():
     
     try:
         # Send a GET request to the heartbeat URL
-        response = requests.get(BETTERSTACK_HEARTBEAT_URL)
+        response = requests.get(BETTERSTACK_HEARTBEAT_URL, timeout=HEARTBEAT_TIMEOUT)
         
         # Check if the request was successful
         if response.status_code != 200:
@@ -357,13 +733,49 @@ if __name__ == "__main__":
     
 
     conn = opendatabase()
+
+    # Load the known devices so the writer does not have to query things per message
+    loaded = devices.load(conn.cursor())
+    conn.commit()
+    logger.info(f"Loaded {loaded} devices into the device registry")
+    logger.info(f"Loaded {columns.load(conn.cursor())} {columns.kind}s of things")
+    if decoder is not None:
+        logger.info(f"Loaded the types of {decoder.load_columns(columns.types)} attributes")
+    conn.commit()
+
+    if LOCATION_TABLES == "True":
+        create_location_tables(conn)
+    if STATS_ROLLUP == "True":
+        create_stats_tables(conn)
+
+    # Make sure the partitions the writers need exist before they start
+    if PARTITION_INTERVAL:
+        partitions = PartitionManager(interval=PARTITION_INTERVAL, premake=PARTITION_PREMAKE, retention_days=PARTITION_RETENTION_DAYS)
+        if partitions.is_partitioned(conn.cursor()):
+            created, dropped = partitions.maintain(conn)
+            logger.info(f"Partitions created: {created}, dropped: {dropped}")
+            PartitionMaintenance(partitions, connect_database, interval=PARTITION_CHECK_INTERVAL, logger=logger).start()
+        else:
+            logger.warning("PARTITION_INTERVAL is set but mqtt is not partitioned, run partition_manager.py migrate")
+        conn.commit()
     
-    # Create a separate thread to process messages in the write queue
+    # Create separate threads to process messages in the write queues
     if DEBUG_MODE != "True":
-        logger.info("Starting message queue thread")
+        logger.info(f"Starting {len(writers)} message queue threads")
     
-    write_thread = threading.Thread(target=write_to_database, daemon=True)
-    write_thread.start()
+    # Spill files are only left behind without the spool, which removes them at startup
+    if spool is None:
+        spilled = check_spilled(conn)
+        if spilled:
+            logger.info(f"Replaying {spilled} messages from the spill files")
+
+    writers.start(write_to_database)
+
+    # Replay what the previous run received but did not commit, before new messages arrive.
+    # The writers are already running so a large replay cannot fill the bounded queues.
+    if spool is not None:
+        replayed = replay_spool(conn)
+        logger.info(f"Replayed {replayed} messages from the spool")
 
     # Connect to the MQTT broker
     logger.info("Setting up MQTT")
@@ -374,18 +786,30 @@ if __name__ == "__main__":
     client.on_message = on_message
     client.on_disconnect = on_disconnect
     send_heartbeat()
+
+    if METRICS_PORT:
+        MetricsServer(metrics.registry, METRICS_HOST, int(METRICS_PORT)).start()
+        logger.info(f"Serving metrics on port {METRICS_PORT}")
+
+    # Keep the heartbeat off the writer threads
+    if DEBUG_MODE != "True":
+        HeartbeatScheduler(liveness, send_heartbeat, interval=HEARTBEAT_INTERVAL, logger=logger,
+                           slack=WRITE_BATCH_MAX_AGE_MS / 1000).start()
     
     
     
-    while True:
-        try:
-            if DEBUG_MODE != "True":
-                logger.info("Connecting to MQTT broker")
-            
-            client.connect(MQTT_HOST, int(MQTT_PORT), 60)
-            client.loop_forever()
-        
-        except Exception as e:
-            if DEBUG_MODE != "True":
-                logger.critical("Error connecting to MQTT broker: %s", str(e))
-            exit()
+    try:
+        while True:
+            try:
+                if DEBUG_MODE != "True":
+                    logger.info("Connecting to MQTT broker")
+
+                client.connect(MQTT_HOST, int(MQTT_PORT), 60)
+                client.loop_forever()
+
+            except Exception as e:
+                if DEBUG_MODE != "True":
+                    logger.critical("Error connecting to MQTT broker: %s", str(e))
+                exit()
+    finally:
+        shutdown()
@@ -0,0 +1,528 @@
+import os
+import sys
+import uuid
+import time
+import signal
+import asyncio
+import asyncpg
+import aiomqtt
+import logging
+import datetime
+import requests
+import binascii
+import crcmod.predefined
+
+from dotenv import load_dotenv
+from logtail import LogtailHandler
+from log_shipper import LogShipper
+from heartbeat import Liveness, skip_reason
+from metrics import IngestMetrics, MetricsServer
+from batch_writer import MQTT_COPY_COLUMNS, MqttCopyBatch
+from commit_policy import make_commit_policy
+from device_registry import DeviceRegistry
+from column_registry import ColumnRegistry
+from attribute_registry import AttributeRegistry
+from things_coalescer import ThingsCoalescer
+from writer_pool import shard_for
+from prepared_statements import numbered
+from payload_decoder import PayloadDecoder
+from location import LocationBuffer, CREATE_TABLES as LOCATION_TABLES_SQL
+from stats_rollup import StatsRollup, CREATE_TABLES as STATS_TABLES_SQL
+from topic_router import TopicRouter, RAW, LOCATION, STATS, parse_routes
+
+
+# asyncio based alternative to main.py. The MQTT consumer, the Postgres writers and the
+# heartbeat all run on one event loop. Messages use the same tuple layout as main.py
+# and are written to the same mqtt and things tables, so both can run side by side.
+
+
+# Handle signals for script stop
+def handle_termination_signals(signum, frame):
+    logger.error(f"Signal received at line {frame.f_lineno} in {frame.f_code.co_filename}")
+    logger.critical(f"Received signal {signum}. Stopping script.")
+    if log_shipper is not None:
+        log_shipper.stop()
+    sys.exit(0)
+
+# Trap common stop signals
+signal.signal(signal.SIGINT, handle_termination_signals)  # Handle Ctrl+C
+signal.signal(signal.SIGTERM, handle_termination_signals)  # Handle termination
+
+# Load environment variables from the .env file
+load_dotenv()
+
+# Access the variables
+MQTT_HOST = os.environ.get("MQTT_HOST")
+MQTT_PORT = os.environ.get("MQTT_PORT")
+MQTT_CLIENT_ID = os.environ.get("MQTT_CLIENT_ID")
+MQTT_PASSWORD = os.environ.get("MQTT_PASSWORD")
+MQTT_USERNAME = os.environ.get("MQTT_USERNAME")
+MQTT_ENV = os.environ.get("MQTT_ENV")
+BETTERSTACK_TOKEN = os.environ.get("BETTERSTACK_TOKEN")
+BETTERSTACK_HEARTBEAT_URL=os.environ.get("BETTERSTACK_HEARTBEAT_URL")
+DEBUG_MODE = os.environ.get("DEBUG_MODE")
+
+# Batching and caching settings, shared with main.py
+WRITE_BATCH_POLICY = os.environ.get("WRITE_BATCH_POLICY", "static")
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "1000"))
+WRITE_BATCH_MAX_BYTES = int(os.environ.get("WRITE_BATCH_MAX_BYTES", str(4 * 1024 * 1024)))
+WRITE_BATCH_MAX_AGE_MS = float(os.environ.get("WRITE_BATCH_MAX_AGE_MS", "1000"))
+WRITE_BATCH_TARGET_P99_MS = float(os.environ.get("WRITE_BATCH_TARGET_P99_MS", "500"))
+DEVICE_REGISTRY_SIZE = int(os.environ.get("DEVICE_REGISTRY_SIZE", "100000"))
+DEVICE_REGISTRY_NEGATIVE_TTL = float(os.environ.get("DEVICE_REGISTRY_NEGATIVE_TTL", "60"))
+THINGS_COALESCE_WINDOW = float(os.environ.get("THINGS_COALESCE_WINDOW", "1.0"))
+THINGS_COALESCE_MAX_DEVICES = int(os.environ.get("THINGS_COALESCE_MAX_DEVICES", "5000"))
+
+# "columns" keeps one things column per topic, created with ALTER TABLE when a topic is new.
+# "jsonb" merges the attributes into things.attrs and shows them as columns in things_view.
+THINGS_STORAGE = os.environ.get("THINGS_STORAGE", "columns")
+
+# Decode attribute payloads to the type of their attribute, see main.py
+PAYLOAD_TYPES = os.environ.get("PAYLOAD_TYPES")
+PAYLOAD_TYPE_SAMPLES = int(os.environ.get("PAYLOAD_TYPE_SAMPLES", "10"))
+
+# Positions from location topics for device_location and device_track, see main.py
+LOCATION_TABLES = os.environ.get("LOCATION_TABLES")
+LOCATION_TRACK_BUCKET = int(os.environ.get("LOCATION_TRACK_BUCKET", "60"))
+
+# Per-minute rollup of mqttstats payloads, see main.py
+STATS_ROLLUP = os.environ.get("STATS_ROLLUP")
+STATS_ROLLUP_WINDOW = float(os.environ.get("STATS_ROLLUP_WINDOW", "60"))
+STATS_KEEP_RAW = os.environ.get("STATS_KEEP_RAW", "True")
+
+# Extra topic routes on top of the defaults in topic_router.py, see main.py
+TOPIC_ROUTES = os.environ.get("TOPIC_ROUTES", "")
+
+# Concurrency limits of the event loop: number of writers (and Postgres connections),
+# queued messages per writer before the consumer waits, and blocking calls such as
+# the heartbeat or Telit requests that may run in worker threads at the same time
+ASYNC_WRITERS = int(os.environ.get("ASYNC_WRITERS", "4"))
+ASYNC_QUEUE_SIZE = int(os.environ.get("ASYNC_QUEUE_SIZE", "10000"))
+ASYNC_BLOCKING_CALLS = int(os.environ.get("ASYNC_BLOCKING_CALLS", "2"))
+
+# Seconds between heartbeats, sent when messages were received and every writer that got some
+# committed rows, and seconds before a heartbeat request is abandoned
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", "60"))
+HEARTBEAT_TIMEOUT = float(os.environ.get("HEARTBEAT_TIMEOUT", "10"))
+
+# Log records waiting to be shipped to Logtail, and records shipped at a time
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "500"))
+
+# Prepared statements kept per Postgres connection
+PREPARED_STATEMENTS_MAX = int(os.environ.get("PREPARED_STATEMENTS_MAX", "512"))
+
+# Prometheus metrics endpoint, see main.py
+METRICS_PORT = os.environ.get("METRICS_PORT")
+METRICS_HOST = os.environ.get("METRICS_HOST", "0.0.0.0")
+
+print(f"DEBUG_MODE: {DEBUG_MODE}")
+
+# Create a CRC-32 checksum object
+crc32 = crcmod.predefined.Crc('crc-32')
+
+# Records are handed to a background thread that ships them to Logtail, so logging
+# never blocks the MQTT or writer threads
+log_shipper = None
+
+if DEBUG_MODE != "True":
+    handler = LogtailHandler(source_token=BETTERSTACK_TOKEN)
+    log_shipper = LogShipper(handler, max_queue=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE)
+    log_shipper.start()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    logger.handlers = []
+    logger.addHandler(log_shipper.queue_handler)
+else:
+    # Log to the console (screen)
+    logger = logging.getLogger('screen_logger')
+    logger.setLevel(logging.DEBUG)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    console_handler.setFormatter(formatter)
+    logger.addHandler(console_handler)
+
+    logger.info("Starting up...")
+
+# Known devices, loaded from things at startup and consulted for every message
+devices = DeviceRegistry(max_size=DEVICE_REGISTRY_SIZE, negative_ttl=DEVICE_REGISTRY_NEGATIVE_TTL)
+
+# Decides per topic what happens with a message besides storing it in mqtt
+router = TopicRouter(parse_routes(TOPIC_ROUTES))
+
+# Columns of things, loaded at startup; missing ones are created before values are written
+columns = AttributeRegistry() if THINGS_STORAGE == "jsonb" else ColumnRegistry()
+
+# Type per attribute, None when payloads are stored as text
+decoder = PayloadDecoder(PAYLOAD_TYPE_SAMPLES) if PAYLOAD_TYPES == "True" else None
+
+# Messages received and rows committed per writer, read by the heartbeat
+liveness = Liveness(ASYNC_WRITERS)
+
+# Counters and histograms for the metrics endpoint
+metrics = IngestMetrics()
+
+# Serialises column creation between the writer tasks
+column_lock = asyncio.Lock()
+
+
+def create_crc(data):
+    # Convert data to bytes and calculate the CRC-32 checksum
+    crc32.update(data.encode('utf-8'))
+    checksum = crc32.digest()
+
+    # Convert checksum to an ASCII-encoded hexadecimal string
+    return binascii.hexlify(checksum).decode('ascii')
+
+
+def build_message(topic, payload):
+    """ Builds the write queue tuple for a message, the same way on_message in main.py does
+
+    Returns:
+        tuple: (message, its Route), so the topic is only routed once
+    """
+    my_date = datetime.datetime.now()
+    serial_number = my_date.strftime("%Y%m%d%H%M%S%f")
+    route = router.route(topic)
+    if route is None:
+        raise ValueError(f"Topic {topic} has no IMEI")
+    imei = route.imei
+    payload = payload.decode("utf-8")
+    crc = create_crc(topic + payload + serial_number) + uuid.uuid4().hex
+    return (my_date, imei, topic, payload, crc), route
+
+
+async def run_blocking(limit, fn, *args):
+    """ Runs a blocking call, such as requests or telitHandler, in a worker thread
+
+    Args:
+        limit asyncio.Semaphore: bounds the number of blocking calls in flight
+        fn: function to call with args
+
+    Returns:
+        the result of fn
+    """
+    async with limit:
+        return await asyncio.to_thread(fn, *args)
+
+
+def send_heartbeat():
+    try:
+        # Send a GET request to the heartbeat URL
+        response = requests.get(BETTERSTACK_HEARTBEAT_URL, timeout=HEARTBEAT_TIMEOUT)
+
+        # Check if the request was successful
+        if response.status_code != 200:
+            logger.warning(f"Failed to send heartbeat. Status code: {response.status_code}. Will retry.")
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Heartbeat, an error occurred: {e}")
+
+
+async def heartbeat(limit):
+    # Send a heartbeat every HEARTBEAT_INTERVAL seconds in which MQTT messages arrived and
+    # every writer that got some committed rows. Messages received in the last batch age
+    # of the interval are not yet expected to be committed.
+    slack = min(WRITE_BATCH_MAX_AGE_MS / 1000, HEARTBEAT_INTERVAL)
+    last = liveness.snapshot()
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL - slack)
+        settled = liveness.snapshot()
+        await asyncio.sleep(slack)
+        current = liveness.snapshot()
+        reason = skip_reason(last, current, HEARTBEAT_INTERVAL, settled)
+        last = current
+        if decoder is not None:
+            widened = decoder.take_widened()
+            if widened:
+                logger.warning(f"Attributes whose type was widened by payloads that did not fit: {dict(widened.most_common(20))}")
+        if DEBUG_MODE == "True":
+            continue
+        if reason is not None:
+            logger.warning(reason)
+            continue
+        # Runs in a worker thread so a slow endpoint does not hold up the event loop
+        await run_blocking(limit, send_heartbeat)
+
+
+async def consume(queues):
+    max_retries = 10       # Maximum number of reconnect attempts
+    retry_delay = 5        # Delay between retries in seconds
+    retries = 0
+    cid = MQTT_CLIENT_ID + "-" + str(uuid.uuid4().hex)[:8]
+
+    while True:
+        try:
+            logger.info("Connecting to MQTT broker")
+            async with aiomqtt.Client(MQTT_HOST, int(MQTT_PORT), username=MQTT_USERNAME, password=MQTT_PASSWORD,
+                                      identifier=cid, clean_session=True) as client:
+                logger.info("Connected to MQTT broker")
+                metrics.connects.inc("success")
+                retries = 0
+                await client.subscribe("#")
+
+                async for msg in client.messages:
+                    try:
+                        message, route = build_message(str(msg.topic), msg.payload)
+                    except Exception as e:
+                        metrics.dropped.inc("error")
+                        logger.error("Error handling MQTT message: %s", str(e))
+                        continue
+                    metrics.received.inc(route.kind, route.attribute)
+                    shard = shard_for(message[1], len(queues))
+                    liveness.received[shard] += 1
+                    # Waits when the writer is ASYNC_QUEUE_SIZE messages behind
+                    await queues[shard].put((message, route))
+
+        except aiomqtt.MqttError as e:
+            metrics.disconnects.inc("false")
+            metrics.connects.inc("failed")
+            retries += 1
+            logger.error(f"Reconnect attempt {retries} failed. Error: {str(e)}")
+            if retries >= max_retries:
+                logger.critical("Max reconnect attempts reached. Exiting script.")
+                sys.exit(1)
+            logger.info(f"Retrying in {retry_delay} seconds...")
+            await asyncio.sleep(retry_delay)
+
+
+async def lookup_family(conn, imei):
+    family = devices.cached(imei)
+    if family is None:
+        if await conn.fetchval("SELECT swd_imei FROM things WHERE swd_imei = $1", imei) == imei:
+            family = "old"
+        elif await conn.fetchval("SELECT imei FROM things WHERE imei = $1", imei) == imei:
+            family = "swx"
+        else:
+            family = ""
+        devices.remember(imei, family)
+    return family
+
+
+async def flush(conn, rows, coalescer, locations=None, stats=None, worker=0):
+    """
+    Writes a batch of raw rows, its positions and, when their windows have closed, the coalesced
+    things updates and the stats rollup, in one transaction. Things columns that do not exist yet
+    are created beforehand.
+    """
+
+    flush_things = coalescer.is_due()
+    flush_stats = stats is not None and stats.is_due()
+
+    if DEBUG_MODE == "True":
+        logger.debug(f"Would copy {len(rows)} rows into mqtt")
+        if flush_things:
+            coalescer.flush(None, debug=True)
+        if locations is not None:
+            locations.clear()
+        if flush_stats:
+            stats.clear()
+        return
+
+    if flush_things:
+        # Outside the transaction, ALTER TABLE waits for every open transaction on things
+        async with column_lock:
+            names = coalescer.columns()
+            missing = columns.missing(names)
+            typed = decoder is not None and THINGS_STORAGE != "jsonb"
+            retype = decoder.retype(names, columns.types) if typed else {}
+            if missing or retype:
+                types = (decoder.sql_types(missing) if typed else None) or {}
+                statements = columns.create_statements(missing, types) + columns.retype_statements(retype)
+                for attempt in range(1, columns.attempts + 1):
+                    # Gives up on the table lock after lock_timeout, so other connections
+                    # queued behind the ALTER TABLE are not held up, and tries again
+                    try:
+                        async with conn.transaction():
+                            await conn.execute(columns.lock_timeout_sql())
+                            for statement in statements:
+                                await conn.execute(statement)
+                        break
+                    except asyncpg.exceptions.LockNotAvailableError:
+                        if attempt == columns.attempts:
+                            raise
+                        await asyncio.sleep(min(0.1 * attempt, 1.0))
+                for name in missing:
+                    columns.add(name, types.get(name, "TEXT"))
+                    metrics.columns_created.inc(columns.kind)
+                    logger.info("Created %s: %s", columns.kind, name)
+                for name, sql_type in sorted(retype.items()):
+                    columns.retyped(name, sql_type)
+                    logger.info("Changed the type of column %s to %s", name, sql_type)
+
+    # Started and committed by hand so the commit can be timed on its own
+    transaction = conn.transaction()
+    await transaction.start()
+    try:
+        if flush_things:
+            # executemany pipelines the statements of each group; asyncpg prepares
+            # them and keeps them in the connection's statement cache
+            with metrics.statement_seconds.time("things_update"):
+                for _, sql, params in coalescer.statements(columns.types if decoder is not None and THINGS_STORAGE != "jsonb" else None):
+                    await conn.executemany(numbered(sql), params)
+        if locations is not None:
+            with metrics.statement_seconds.time("locations"):
+                for _, sql, params in locations.statements():
+                    await conn.executemany(numbered(sql), params)
+        if flush_stats:
+            with metrics.statement_seconds.time("stats_rollup"):
+                for _, sql, params in stats.statements():
+                    await conn.executemany(numbered(sql), params)
+        if rows:
+            with metrics.statement_seconds.time("copy"):
+                await conn.copy_records_to_table("mqtt", records=rows, columns=MQTT_COPY_COLUMNS)
+    except BaseException:
+        await transaction.rollback()
+        raise
+    with metrics.commit_seconds.time():
+        await transaction.commit()
+    liveness.committed[worker] += len(rows)
+    metrics.committed.inc(amount=len(rows))
+
+    if locations is not None:
+        locations.clear()
+    if flush_stats:
+        liveness.committed[worker] += len(stats)
+        stats.clear()
+
+    if flush_things:
+        coalescer.clear()
+
+
+async def write_to_database(worker, write_queue, pool):
+    policy = make_commit_policy(WRITE_BATCH_POLICY, WRITE_BATCH_SIZE, WRITE_BATCH_MAX_BYTES, WRITE_BATCH_MAX_AGE_MS, WRITE_BATCH_TARGET_P99_MS)
+    # Only used to hold the rows and apply the commit policy, the rows go out with copy_records_to_table
+    batch = MqttCopyBatch(policy)
+    coalescer = ThingsCoalescer(window=THINGS_COALESCE_WINDOW, max_devices=THINGS_COALESCE_MAX_DEVICES, storage=THINGS_STORAGE)
+    locations = LocationBuffer(bucket=LOCATION_TRACK_BUCKET) if LOCATION_TABLES == "True" else None
+    stats = StatsRollup(window=STATS_ROLLUP_WINDOW) if STATS_ROLLUP == "True" else None
+
+    async with pool.acquire() as conn:
+        while True:
+            # Collect a batch until the commit policy says it is due, or the coalescing
+            # window closes or max_devices devices are pending. The consumer keeps filling
+            # the queue while the previous batch is written.
+            while not batch.is_due() and not coalescer.is_due():
+                limits = []
+                if len(batch):
+                    limits.append(batch.remaining())
+                if len(coalescer):
+                    limits.append(coalescer.window - coalescer.age())
+                if stats is not None and len(stats):
+                    limits.append(stats.remaining())
+                timeout = min(limits) if limits else None
+                if timeout is not None and timeout <= 0:
+                    break
+
+                try:
+                    message, route = await asyncio.wait_for(write_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+                if route.kind == STATS and stats is not None:
+                    # Stats go into the rollup instead of things
+                    if STATS_KEEP_RAW == "True":
+                        batch.add((*message, MQTT_ENV, route.attribute))
+                    stats.add(route.imei, message[3], message[0])
+                    continue
+                batch.add((*message, MQTT_ENV, route.attribute))
+                if route.kind == RAW:
+                    continue
+                if route.kind == LOCATION and locations is not None:
+                    locations.add(route.imei, message[3], message[0])
+
+                # Only devices already in things get their attributes updated, as in main.py
+                device_type = await lookup_family(conn, route.imei)
+                if device_type != "":
+                    column = columns.column_name(route.attribute)
+                    if column is None:
+                        if columns.reject(route.attribute):
+                            logger.warning("Topic %s cannot be stored as a things column", route.attribute)
+                    else:
+                        value = decoder.decode(column, message[3]) if decoder is not None else message[3]
+                        coalescer.add(device_type, route.imei, column, value)
+
+            try:
+                waited_in_batch = batch.age()
+                flush_started = time.monotonic()
+                rows = len(batch)
+                if rows:
+                    metrics.batch_rows.observe(rows)
+                    metrics.batch_bytes.observe(batch.bytes)
+                await flush(conn, batch.rows, coalescer, locations, stats, worker)
+                batch.clear()
+                if rows:
+                    policy.observe(waited_in_batch + time.monotonic() - flush_started, rows)
+            except Exception as e:
+                logger.error("Error writing to database: %s", str(e))
+                sys.exit(1)
+
+
+async def main():
+    port = os.environ.get('POSTGRES_PORT')
+    pool = await asyncpg.create_pool(
+        host=os.environ.get('POSTGRES_HOST'),
+        database=os.environ.get('POSTGRES_DBNAME'),
+        user=os.environ.get('POSTGRES_USER'),
+        password=os.environ.get('POSTGRES_PASSWORD'),
+        port=int(port) if port else None,
+        min_size=ASYNC_WRITERS,
+        max_size=ASYNC_WRITERS + 1,
+        statement_cache_size=PREPARED_STATEMENTS_MAX,
+    )
+
+    # Load the known devices so the writers do not have to query things per message
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("SELECT swd_imei, imei FROM things")
+        if LOCATION_TABLES == "True":
+            for statement in LOCATION_TABLES_SQL:
+                await conn.execute(statement)
+        if STATS_ROLLUP == "True":
+            for statement in STATS_TABLES_SQL:
+                await conn.execute(statement)
+        if THINGS_STORAGE == "jsonb":
+            # Same steps as AttributeRegistry.load: add attrs, load the attributes, rebuild the view
+            async with conn.transaction():
+                await conn.execute(columns.attrs_column_sql())
+                columns.load_rows(await conn.fetch(numbered(columns.table_columns_sql()), columns.table))
+                loaded = columns.load_keys(await conn.fetch(columns.keys_sql()))
+                for statement in columns.create_statements([]):
+                    await conn.execute(statement)
+        else:
+            loaded = columns.load_rows(await conn.fetch(
+                "SELECT column_name, data_type FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = $1",
+                columns.table,
+            ))
+    logger.info(f"Loaded {devices.load_rows(rows)} devices into the device registry")
+    logger.info(f"Loaded {loaded} {columns.kind}s of things")
+    if decoder is not None:
+        logger.info(f"Loaded the types of {decoder.load_columns(columns.types)} attributes")
+
+    queues = [asyncio.Queue(maxsize=ASYNC_QUEUE_SIZE) for _ in range(ASYNC_WRITERS)]
+    metrics.watch_queues(queues)
+    if METRICS_PORT:
+        # The server runs in its own thread, a scrape only reads the counters
+        MetricsServer(metrics.registry, METRICS_HOST, int(METRICS_PORT)).start()
+        logger.info(f"Serving metrics on port {METRICS_PORT}")
+    blocking_calls = asyncio.Semaphore(ASYNC_BLOCKING_CALLS)
+
+    await run_blocking(blocking_calls, send_heartbeat)
+
+    tasks = [asyncio.create_task(write_to_database(worker, q, pool)) for worker, q in enumerate(queues)]
+    tasks.append(asyncio.create_task(heartbeat(blocking_calls)))
+    tasks.append(asyncio.create_task(consume(queues)))
+
+    # The first task that fails stops the engine
+    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for task in done:
+        task.result()
+
+
+if __name__ == "__main__":
+
+    # aiomqtt needs the selector event loop, which is not the default on Windows
+    if sys.platform.startswith("win"):
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    asyncio.run(main())
@@ -0,0 +1,27 @@
+import json
+import datetime
+
+
+def encode_message(message):
+    """ Serialises a write queue message to a single line of text
+
+    Args:
+        message tuple: (timestamp, imei, topic, payload, crc)
+
+    Returns:
+        string: JSON text without a trailing newline
+    """
+    timestamp, *rest = message
+    return json.dumps([timestamp.isoformat(), *rest], separators=(",", ":"))
+
+
+def decode_message(line):
+    """ Turns a line written by encode_message back into a message tuple """
+    timestamp, *rest = json.loads(line)
+    return (datetime.datetime.fromisoformat(timestamp), *rest)
+
+
+def message_size(message):
+    """ Rough number of bytes a queued message keeps in memory """
+    # Tuple, datetime and string object headers come to about 250 bytes
+    return 250 + sum(len(part) for part in message[1:])
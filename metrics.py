@@ -0,0 +1,298 @@
+import time
+import bisect
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Seconds, for statement and commit latency
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Rows per COPY batch
+ROW_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Bytes per COPY batch
+BYTE_BUCKETS = (1024, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    """ Metric whose values are kept per thread
+
+    Every thread that updates the metric gets its own dict of series, so
+    the hot path is a dict update without a lock; only the first update of
+    a thread takes the lock, to register its dict. A scrape copies every
+    thread's dict, which is atomic, and adds them up. Series of threads
+    that have ended are kept, so counters never go back.
+
+    A thread keeps at most max_series label combinations, further ones are
+    counted under "other" for every label, so a label taken from a topic
+    cannot grow without bound.
+
+    Args:
+        name string: metric name
+        help string: description
+        labels tuple: label names, values are passed positionally
+        max_series int: label combinations kept per thread
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, help, labels=(), max_series=1000):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.max_series = max_series
+        self.overflow = tuple("other" for _ in self.labels)
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def series(self):
+        """ The series dict of the calling thread """
+        try:
+            return self.local.series
+        except AttributeError:
+            series = self.local.series = {}
+            with self.lock:
+                self.shards.append(series)
+            return series
+
+    def key(self, series, values):
+        if values in series or len(series) < self.max_series:
+            return values
+        return self.overflow
+
+    def collect_shards(self):
+        with self.lock:
+            shards = list(self.shards)
+        return [shard.copy() for shard in shards]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *values, amount=1):
+        series = self.series()
+        key = self.key(series, values)
+        series[key] = series.get(key, 0) + amount
+
+    def values(self):
+        """ Returns {label values: total} over all threads """
+        totals = {}
+        for shard in self.collect_shards():
+            for key, value in shard.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def samples(self):
+        for key, value in sorted(self.values().items()):
+            yield self.name + format_labels(self.labels, key), value
+
+
+class Timer:
+    """ Observes the seconds its with block took """
+
+    def __init__(self, histogram, values):
+        self.histogram = histogram
+        self.values = values
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.started, *self.values)
+        return False
+
+
+class Histogram(Metric):
+    """ Histogram with fixed buckets; per series the count per bucket, then the sum and the count """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, max_series=1000):
+        super().__init__(name, help, labels, max_series)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *values):
+        series = self.series()
+        key = self.key(series, values)
+        cells = series.get(key)
+        if cells is None:
+            cells = series[key] = [0] * (len(self.buckets) + 3)
+        cells[bisect.bisect_left(self.buckets, value)] += 1
+        cells[-2] += value
+        cells[-1] += 1
+
+    def time(self, *values):
+        """ with histogram.time(...): observes the duration of the block """
+        return Timer(self, values)
+
+    def values(self):
+        totals = {}
+        for shard in self.collect_shards():
+            for key, cells in shard.items():
+                cells = list(cells)
+                total = totals.get(key)
+                if total is None:
+                    totals[key] = cells
+                else:
+                    for i, cell in enumerate(cells):
+                        total[i] += cell
+        return totals
+
+    def samples(self):
+        for key, cells in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), cells):
+                cumulative += count
+                yield self.name + "_bucket" + format_labels(self.labels, key, f'le="{format_value(float(bound))}"'), cumulative
+            yield self.name + "_sum" + format_labels(self.labels, key), cells[-2]
+            yield self.name + "_count" + format_labels(self.labels, key), cells[-1]
+
+
+class Gauge(Metric):
+    """ Value read when the metrics are scraped
+
+    Args:
+        collect: returns {label values: value}
+        type string: "gauge", or "counter" for a total kept elsewhere
+    """
+
+    def __init__(self, name, help, labels=(), collect=None, type="gauge"):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.type = type
+
+    def samples(self):
+        for key, value in sorted(self.collect().items()):
+            yield self.name + format_labels(self.labels, key), value
+
+
+class MetricsRegistry:
+    """ Metrics rendered together in the Prometheus text format """
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), **kwargs):
+        return self.register(Counter(name, help, labels, **kwargs))
+
+    def histogram(self, name, help, labels=(), **kwargs):
+        return self.register(Histogram(name, help, labels, **kwargs))
+
+    def gauge(self, name, help, labels=(), collect=None, **kwargs):
+        return self.register(Gauge(name, help, labels, collect, **kwargs))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class IngestMetrics:
+    """ The metrics both engines expose
+
+    Counters that are updated per message, received and dropped, are only
+    touched by the thread that handles the message; everything else is
+    updated once per batch.
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry or MetricsRegistry()
+        r = self.registry
+        self.received = r.counter("mqtt_messages_received_total", "Messages received from the broker, by topic kind and attribute", ("kind", "attribute"))
+        self.dropped = r.counter("mqtt_messages_dropped_total", "Messages, or the part of a message for things, the locations or the rollup, that were not written", ("reason",))
+        self.committed = r.counter("mqtt_rows_committed_total", "Raw rows committed into mqtt")
+        self.batch_rows = r.histogram("mqtt_batch_rows", "Rows per COPY into mqtt", buckets=ROW_BUCKETS)
+        self.batch_bytes = r.histogram("mqtt_batch_bytes", "Payload bytes per COPY into mqtt", buckets=BYTE_BUCKETS)
+        self.statement_seconds = r.histogram("db_statement_seconds", "Seconds per database write, by statement", ("statement",))
+        self.commit_seconds = r.histogram("db_commit_seconds", "Seconds per commit")
+        self.columns_created = r.counter("things_columns_created_total", "Columns, or view columns, created for new attributes", ("kind",))
+        self.connects = r.counter("mqtt_connects_total", "Connection attempts to the broker, by result", ("result",))
+        self.disconnects = r.counter("mqtt_disconnects_total", "Connections to the broker that ended, by whether it was asked for", ("expected",))
+
+    def watch_queues(self, queues):
+        """ Exposes depth and, where the queue keeps them, memory and spill bytes of the write queues """
+        def read(attribute):
+            return lambda: {(str(worker),): getattr(q, attribute) for worker, q in enumerate(queues) if hasattr(q, attribute)}
+
+        self.registry.gauge("write_queue_depth", "Messages waiting in the write queue of each writer", ("worker",),
+                            lambda: {(str(worker),): q.qsize() for worker, q in enumerate(queues)})
+        self.registry.gauge("write_queue_memory_bytes", "Bytes of messages the write queue holds in memory", ("worker",), read("memory_bytes"))
+        self.registry.gauge("write_queue_spill_bytes", "Bytes of messages spilled to disk", ("worker",), read("spill_bytes"))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line
+        pass
+
+
+class MetricsServer(threading.Thread):
+    """ Serves the metrics of a registry on /metrics from its own thread
+
+    Args:
+        registry MetricsRegistry: metrics to serve
+        host string: address to listen on
+        port int: port to listen on
+    """
+
+    def __init__(self, registry, host="0.0.0.0", port=9100):
+        super().__init__(name="metrics", daemon=True)
+        handler = type("Handler", (MetricsHandler,), {"registry": registry})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,373 @@
+import os
+import re
+import sys
+import logging
+import datetime
+import argparse
+import threading
+import psycopg2
+
+from dotenv import load_dotenv
+
+
+logger = logging.getLogger(__name__)
+
+INTERVALS = ("day", "week")
+
+# Bounds as returned by pg_get_expr(relpartbound), e.g.
+# FOR VALUES FROM ('2024-05-01 00:00:00') TO ('2024-05-02 00:00:00')
+PARTITION_BOUND = re.compile(r"FROM \('(\d{4}-\d{2}-\d{2})[^']*'\) TO \('(\d{4}-\d{2}-\d{2})[^']*'\)")
+
+# Rows this close to the newest one are left for the copy that runs with mqtt locked, as
+# writers may still commit rows with a slightly older timestamp
+LOCKED_COPY_MARGIN = datetime.timedelta(minutes=5)
+
+# CREATE [UNIQUE] INDEX name ON [schema.]table USING method (columns) ...
+INDEX_DEFINITION = re.compile(r"^CREATE (UNIQUE )?INDEX \S+ ON (?:ONLY )?\S+ (USING .*)$")
+
+
+def partition_start(day, interval):
+    """ First day of the partition that holds day, weeks start on Monday """
+    if interval == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    return day
+
+
+def partition_end(start, interval):
+    return start + datetime.timedelta(days=7 if interval == "week" else 1)
+
+
+def partition_name(table, start):
+    return f"{table}_{start:%Y%m%d}"
+
+
+class PartitionManager:
+    """ Keeps the range partitions of the mqtt table ahead of the writers
+
+    mqtt is partitioned by range on timestamp, one partition per day or per
+    week. ensure() creates the partitions for the next premake intervals so
+    the writers never hit a missing range, expire() detaches and drops the
+    partitions that ended more than retention_days ago, which is a catalog
+    change instead of a DELETE over millions of rows. Rows outside every
+    range land in the default partition.
+
+    Args:
+        table string: partitioned table
+        interval string: "day" or "week"
+        premake int: intervals to create ahead of today
+        retention_days int: days a partition is kept after its range ended, 0 keeps them all
+    """
+
+    def __init__(self, table="mqtt", interval="day", premake=7, retention_days=0):
+        if interval not in INTERVALS:
+            raise ValueError(f"Unknown partition interval: {interval}")
+        self.table = table
+        self.interval = interval
+        self.premake = premake
+        self.retention_days = retention_days
+
+    def is_partitioned(self, cur):
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (self.table,))
+        row = cur.fetchone()
+        return row is not None and row[0] == "p"
+
+    def partitions(self, cur):
+        """ Returns [(name, first day, day after the last)] of the range partitions, oldest first """
+        cur.execute(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)",
+            (self.table,),
+        )
+        result = []
+        for name, bound in cur.fetchall():
+            match = PARTITION_BOUND.search(bound or "")
+            if match:
+                start, end = (datetime.date.fromisoformat(d) for d in match.groups())
+                result.append((name, start, end))
+        return sorted(result, key=lambda p: p[1])
+
+    def ranges(self, first, last):
+        """ Yields (start, end) of the partitions needed to cover first up to and including last """
+        start = partition_start(first, self.interval)
+        while start <= last:
+            end = partition_end(start, self.interval)
+            yield start, end
+            start = end
+
+    def create_sql(self, start, end, table=None):
+        table = table or self.table
+        return (
+            f"CREATE TABLE IF NOT EXISTS {partition_name(table, start)} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+
+    def ensure(self, conn, today=None):
+        """ Creates the missing partitions from today up to premake intervals ahead
+
+        Ranges that overlap an existing partition, for example after switching
+        from daily to weekly partitions, are left alone. Every partition is
+        created in its own transaction, so the writers are only blocked for
+        a moment.
+
+        Returns:
+            list: names of the partitions created
+        """
+        today = today or datetime.date.today()
+        last = today + datetime.timedelta(days=(7 if self.interval == "week" else 1) * self.premake)
+        cur = conn.cursor()
+        existing = self.partitions(cur)
+        conn.commit()
+
+        created = []
+        for start, end in self.ranges(today, last):
+            if any(s < end and start < e for _, s, e in existing):
+                continue
+            try:
+                cur.execute(self.create_sql(start, end))
+                conn.commit()
+            except psycopg2.Error as e:
+                # Typically rows for this range already sit in the default partition
+                conn.rollback()
+                logger.error(f"Could not create partition {partition_name(self.table, start)}: {e}")
+                continue
+            created.append(partition_name(self.table, start))
+        return created
+
+    def expire(self, conn, today=None):
+        """ Detaches and drops the partitions that ended more than retention_days ago
+
+        Returns:
+            list: names of the partitions dropped
+        """
+        if not self.retention_days:
+            return []
+        today = today or datetime.date.today()
+        cutoff = today - datetime.timedelta(days=self.retention_days)
+        cur = conn.cursor()
+        dropped = []
+        for name, _, end in self.partitions(cur):
+            if end > cutoff:
+                break
+            cur.execute(f"ALTER TABLE {self.table} DETACH PARTITION {name}")
+            cur.execute(f"DROP TABLE {name}")
+            conn.commit()
+            dropped.append(name)
+        conn.commit()
+        return dropped
+
+    def maintain(self, conn, today=None):
+        """ Runs ensure() and expire(), returns (created, dropped) """
+        return self.ensure(conn, today), self.expire(conn, today)
+
+
+class PartitionMaintenance(threading.Thread):
+    """ Runs the partition manager every interval seconds on its own connection
+
+    Args:
+        manager PartitionManager: the manager to run
+        connect: function that opens a new psycopg2 connection
+        interval int: seconds between runs
+        logger: logger for created and dropped partitions
+    """
+
+    def __init__(self, manager, connect, interval=3600, logger=logger):
+        super().__init__(name="partition-maintenance", daemon=True)
+        self.manager = manager
+        self.connect = connect
+        self.interval = interval
+        self.logger = logger
+        self.stopped = threading.Event()
+
+    def run(self):
+        conn = None
+        while not self.stopped.wait(self.interval):
+            try:
+                if conn is None or conn.closed:
+                    conn = self.connect()
+                created, dropped = self.manager.maintain(conn)
+                if created or dropped:
+                    self.logger.info(f"Partitions created: {created}, dropped: {dropped}")
+            except Exception as e:
+                self.logger.error(f"Partition maintenance failed: {e}")
+                if conn is not None:
+                    conn.close()
+                conn = None
+
+    def stop(self):
+        self.stopped.set()
+
+
+def partitioned_indexes(cur, table, target):
+    """ Rewrites the index definitions of table for target
+
+    A unique index on a partitioned table has to contain the partition key,
+    so unique indexes without timestamp, such as the one on crc, become
+    plain indexes.
+    """
+    cur.execute(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s "
+        "AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE contype = 'p' AND conrelid = to_regclass(%s))",
+        (table, table),
+    )
+    statements = []
+    for name, definition in cur.fetchall():
+        match = INDEX_DEFINITION.match(definition)
+        if not match:
+            print(f"Skipping index {name}: {definition}")
+            continue
+        unique, rest = match.groups()
+        if unique and "timestamp" not in rest:
+            print(f"Index {name} cannot stay unique on a partitioned table, it is created as a plain index")
+            unique = None
+        statements.append(f"CREATE {unique or ''}INDEX ON {target} {rest}")
+    return statements
+
+
+def partitioned_primary_key(cur, table, target):
+    """ The statement that gives target the primary key of table, with timestamp added, or None
+
+    A primary key on a partitioned table has to contain the partition key,
+    so timestamp is added to its columns. That needs a timestamp in every
+    row; when some rows have none the key is left out.
+    """
+    cur.execute(
+        "SELECT a.attname FROM pg_constraint c CROSS JOIN LATERAL unnest(c.conkey) WITH ORDINALITY AS k(attnum, position) "
+        "JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum "
+        "WHERE c.contype = 'p' AND c.conrelid = to_regclass(%s) ORDER BY k.position",
+        (table,),
+    )
+    columns = [row[0] for row in cur.fetchall()]
+    if not columns:
+        return None
+    if "timestamp" not in columns:
+        cur.execute(f"SELECT EXISTS (SELECT 1 FROM {table} WHERE timestamp IS NULL)")
+        if cur.fetchone()[0]:
+            print(f"Warning: the primary key ({', '.join(columns)}) of {table} is dropped, it needs timestamp and some rows have none")
+            return None
+        print(f"Warning: the primary key of {table} changes from ({', '.join(columns)}) to ({', '.join(columns + ['timestamp'])}), it has to contain the partition key")
+        columns.append("timestamp")
+    return f"ALTER TABLE {target} ADD PRIMARY KEY (" + ", ".join(f'"{c}"' for c in columns) + ")"
+
+
+def migrate(conn, manager, keep_old):
+    """ Converts a plain mqtt table into a partitioned one
+
+    The rows are copied partition by partition with INSERT ... SELECT while
+    the writers keep running; a partition that already has rows was copied
+    by an earlier run and is skipped, so the migration can be stopped and
+    started again. The current partition is copied up to a few minutes
+    before its newest row while the writers run too, so only the rows after
+    that cutoff are copied with mqtt locked, right before the tables are
+    swapped. The primary key is recreated with timestamp added. The old
+    table is kept as mqtt_unpartitioned unless keep_old is False.
+
+    Rows that arrive with an older timestamp after their partition was
+    copied, for example from a spool replay, are not picked up. Stop the
+    writers first if that matters.
+    """
+    table = manager.table
+    target = table + "_partitioned"
+    cur = conn.cursor()
+
+    if manager.is_partitioned(cur):
+        print(f"{table} is already partitioned.")
+        return
+
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {target} (LIKE {table} INCLUDING DEFAULTS) PARTITION BY RANGE (\"timestamp\")")
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {target}_default PARTITION OF {target} DEFAULT")
+    conn.commit()
+
+    cur.execute(f"SELECT min(timestamp)::date FROM {table}")
+    first = cur.fetchone()[0] or datetime.date.today()
+    today = datetime.date.today()
+    last = today + datetime.timedelta(days=(7 if manager.interval == "week" else 1) * manager.premake)
+    ranges = list(manager.ranges(first, last))
+    for start, end in ranges:
+        cur.execute(manager.create_sql(start, end, target))
+    conn.commit()
+    print(f"Created {len(ranges)} partitions from {first} to {last}")
+
+    # Everything before the partition of today is copied while the writers run
+    live = partition_start(today, manager.interval)
+    for start, end in ranges:
+        if start >= live:
+            break
+        name = partition_name(target, start)
+        cur.execute(f"SELECT EXISTS (SELECT 1 FROM {name})")
+        if cur.fetchone()[0]:
+            continue
+        cur.execute(
+            f"INSERT INTO {target} SELECT * FROM {table} WHERE timestamp >= %s AND timestamp < %s",
+            (start, end),
+        )
+        conn.commit()
+        print(f"{datetime.datetime.now()} - Copied {cur.rowcount} rows into {name}")
+
+    statements = partitioned_indexes(cur, table, target)
+    primary_key = partitioned_primary_key(cur, table, target)
+    if primary_key is not None:
+        statements.append(primary_key)
+    for statement in statements:
+        print(statement)
+        cur.execute(statement)
+    conn.commit()
+
+    # The current partition up to a few minutes before its newest row is copied while the
+    # writers run; an earlier run may have copied part of it, so that is replaced
+    cur.execute(f"SELECT max(timestamp) FROM {table} WHERE timestamp >= %s", (live,))
+    newest = cur.fetchone()[0]
+    cutoff = max(newest - LOCKED_COPY_MARGIN, datetime.datetime.combine(live, datetime.time())) if newest else live
+    cur.execute(f"DELETE FROM {target} WHERE timestamp >= %s", (live,))
+    cur.execute(f"INSERT INTO {target} SELECT * FROM {table} WHERE timestamp >= %s AND timestamp < %s", (live, cutoff))
+    conn.commit()
+    print(f"{datetime.datetime.now()} - Copied {cur.rowcount} rows of the current partition up to {cutoff}")
+
+    # The rest is copied with mqtt locked, then the tables change places
+    cur.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+    cur.execute(f"INSERT INTO {target} SELECT * FROM {table} WHERE timestamp >= %s OR timestamp IS NULL", (cutoff,))
+    print(f"Copied {cur.rowcount} recent rows")
+    old = table + "_unpartitioned"
+    cur.execute(f"ALTER TABLE {table} RENAME TO {old}")
+    cur.execute(f"ALTER TABLE {target} RENAME TO {table}")
+    cur.execute(f"ALTER TABLE {target}_default RENAME TO {table}_default")
+    for name, start, _ in manager.partitions(cur):
+        if name.startswith(target):
+            cur.execute(f"ALTER TABLE {name} RENAME TO {partition_name(table, start)}")
+    if not keep_old:
+        cur.execute(f"DROP TABLE {old}")
+    conn.commit()
+    print(f"{table} is now partitioned by {manager.interval}" + (f", the old table is {old}" if keep_old else ""))
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Partition maintenance of the mqtt table")
+    parser.add_argument("command", choices=("migrate", "maintain", "list"))
+    parser.add_argument("--interval", choices=INTERVALS, default=os.environ.get("PARTITION_INTERVAL") or "day")
+    parser.add_argument("--premake", type=int, default=int(os.environ.get("PARTITION_PREMAKE", "7")))
+    parser.add_argument("--retention-days", type=int, default=int(os.environ.get("PARTITION_RETENTION_DAYS", "0")))
+    parser.add_argument("--drop-old", action="store_true", help="migrate: drop the unpartitioned table after the swap")
+    args = parser.parse_args()
+
+    manager = PartitionManager(interval=args.interval, premake=args.premake, retention_days=args.retention_days)
+    conn = psycopg2.connect(
+        host=os.environ.get('POSTGRES_HOST'),
+        dbname=os.environ.get('POSTGRES_DBNAME'),
+        user=os.environ.get('POSTGRES_USER'),
+        password=os.environ.get('POSTGRES_PASSWORD'),
+        port=os.environ.get('POSTGRES_PORT'),
+    )
+
+    if args.command == "migrate":
+        migrate(conn, manager, keep_old=not args.drop_old)
+    elif args.command == "maintain":
+        if not manager.is_partitioned(conn.cursor()):
+            print("mqtt is not partitioned, run migrate first.")
+            sys.exit(1)
+        created, dropped = manager.maintain(conn)
+        print(f"Created: {created}")
+        print(f"Dropped: {dropped}")
+    else:
+        for name, start, end in manager.partitions(conn.cursor()):
+            print(f"{name}\t{start}\t{end}")
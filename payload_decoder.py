@@ -0,0 +1,184 @@
+import re
+import json
+import threading
+
+from collections import Counter
+
+
+INTEGER = "integer"
+FLOAT = "float"
+BOOLEAN = "boolean"
+JSON = "json"
+TEXT = "text"
+
+# Column type created for an attribute of each type
+SQL_TYPES = {INTEGER: "BIGINT", FLOAT: "DOUBLE PRECISION", BOOLEAN: "BOOLEAN", JSON: "JSONB", TEXT: "TEXT"}
+
+# Type of an existing column, by its information_schema data_type
+COLUMN_TYPES = {
+    "smallint": INTEGER,
+    "integer": INTEGER,
+    "bigint": INTEGER,
+    "real": FLOAT,
+    "double precision": FLOAT,
+    "numeric": FLOAT,
+    "boolean": BOOLEAN,
+    "json": JSON,
+    "jsonb": JSON,
+}
+
+# Leading zeros are kept as text, they are identifiers rather than numbers
+INTEGER_VALUE = re.compile(r"^-?(0|[1-9][0-9]*)$")
+FLOAT_VALUE = re.compile(r"^-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?$")
+BOOLEAN_VALUES = {"true": True, "false": False}
+
+# Range of a BIGINT column
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def infer_type(payload):
+    """ Returns the narrowest type that can hold the payload """
+    text = payload.strip()
+    if INTEGER_VALUE.match(text) and abs(int(text)) <= MAX_INTEGER:
+        return INTEGER
+    if FLOAT_VALUE.match(text):
+        return FLOAT
+    if text.lower() in BOOLEAN_VALUES:
+        return BOOLEAN
+    if text[:1] in ("{", "["):
+        try:
+            json.loads(text)
+            return JSON
+        except ValueError:
+            pass
+    return TEXT
+
+
+def parse(value_type, payload):
+    """ Converts a payload to a value of value_type
+
+    Integers are accepted where floats are expected. JSON values are
+    returned as parsed objects.
+
+    Raises:
+        ValueError: the payload is not a value of that type
+    """
+    if value_type == TEXT:
+        return payload
+    text = payload.strip()
+    if value_type == INTEGER:
+        if not INTEGER_VALUE.match(text) or abs(int(text)) > MAX_INTEGER:
+            raise ValueError(f"not an integer: {payload!r}")
+        return int(text)
+    if value_type == FLOAT:
+        if not FLOAT_VALUE.match(text):
+            raise ValueError(f"not a number: {payload!r}")
+        return float(text)
+    if value_type == BOOLEAN:
+        if text.lower() not in BOOLEAN_VALUES:
+            raise ValueError(f"not a boolean: {payload!r}")
+        return BOOLEAN_VALUES[text.lower()]
+    if value_type == JSON:
+        return json.loads(text)
+    raise ValueError(f"Unknown payload type: {value_type}")
+
+
+def widen(value_type, payload_type):
+    """ The narrowest type that holds values of both types: integers widen to floats, anything else to text """
+    if {value_type, payload_type} <= {INTEGER, FLOAT}:
+        return FLOAT
+    return TEXT
+
+
+class PayloadDecoder:
+    """ Decodes attribute payloads to the type of their attribute
+
+    The type of an attribute is taken from its column when it exists, and
+    otherwise inferred from its payloads. A payload that does not fit the
+    type widens it, integers to floats and anything else to text, so a
+    value is never dropped: the writer changes the column type with
+    retype() before the value is written. A new column only gets a type
+    other than TEXT once min_samples payloads agreed on it, and numbers
+    get DOUBLE PRECISION, so a single "100" does not make a column that
+    "99.5" cannot go into.
+
+    Shared by the writer threads.
+
+    Args:
+        min_samples int: payloads needed before a new column is typed
+    """
+
+    def __init__(self, min_samples=10):
+        self.min_samples = min_samples
+        self.types = {}
+        self.samples = Counter()
+        self.widened = Counter()
+        self.lock = threading.Lock()
+
+    def load_columns(self, column_types):
+        """ Takes the types of existing columns from {name: information_schema data_type} """
+        with self.lock:
+            for name, data_type in column_types.items():
+                self.types[name] = COLUMN_TYPES.get(data_type, TEXT)
+            return len(self.types)
+
+    def decode(self, attribute, payload):
+        """ Returns the payload as a value of the type of attribute, widening the type when it does not fit """
+        value_type = self.types.get(attribute)
+        if value_type is not None:
+            try:
+                value = parse(value_type, payload)
+                self.samples[attribute] += 1
+                return value
+            except ValueError:
+                pass
+
+        with self.lock:
+            current = self.types.get(attribute)
+            payload_type = infer_type(payload)
+            if current is None:
+                current = payload_type
+            elif current != payload_type and not (current == FLOAT and payload_type == INTEGER):
+                current = widen(current, payload_type)
+                self.widened[attribute] += 1
+            self.types[attribute] = current
+            self.samples[attribute] += 1
+        return parse(current, payload)
+
+    def sql_types(self, names):
+        """ Column types for new columns, {name: SQL type}, and the types of their attributes from now on
+
+        Attributes with fewer than min_samples payloads get TEXT.
+        """
+        result = {}
+        with self.lock:
+            for name in names:
+                value_type = self.types.get(name, TEXT)
+                if self.samples[name] < self.min_samples:
+                    value_type = TEXT
+                elif value_type == INTEGER:
+                    value_type = FLOAT
+                self.types[name] = value_type
+                result[name] = SQL_TYPES[value_type]
+        return result
+
+    def retype(self, names, column_types):
+        """ Columns, out of names, that are narrower than their attribute, {name: SQL type to change them to}
+
+        Args:
+            names: attribute names about to be written
+            column_types dict: information_schema data_type per existing column
+        """
+        with self.lock:
+            return {
+                name: SQL_TYPES[self.types[name]]
+                for name in names
+                if name in column_types and name in self.types
+                and COLUMN_TYPES.get(column_types[name], TEXT) != self.types[name]
+            }
+
+    def take_widened(self):
+        """ Returns and resets the number of payloads that widened the type of their attribute """
+        with self.lock:
+            widened, self.widened = self.widened, Counter()
+            return widened
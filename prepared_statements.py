@@ -0,0 +1,76 @@
+import re
+
+from collections import OrderedDict
+from psycopg2.extras import execute_batch
+
+
+def numbered(sql):
+    """ Turns %s placeholders into the $1, $2, ... form used by PREPARE and asyncpg """
+    counter = iter(range(1, sql.count("%s") + 1))
+    return re.sub(r"%s", lambda _: f"${next(counter)}", sql)
+
+
+class PreparedStatements:
+    """ Server-side prepared statements of one connection
+
+    A statement is prepared the first time its key is used, for example
+    ("things_update", "swx", ("battery", "rssi"), ("", "")), and then run with
+    EXECUTE, so Postgres parses and plans it once per connection instead of
+    once per message. At most max_statements are kept; the least recently
+    used one is deallocated to make room.
+
+    Prepared statements belong to a connection, so every connection needs
+    its own instance.
+    """
+
+    def __init__(self, max_statements=512, prefix="fa"):
+        self.max_statements = max_statements
+        self.prefix = prefix
+        self.statements = OrderedDict()
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.statements)
+
+    def prepare(self, cur, key, sql):
+        """ Prepares sql under key unless it already is
+
+        Args:
+            cur: psycopg2 cursor
+            key: hashable identifying the statement
+            sql string: statement with %s placeholders
+
+        Returns:
+            string: EXECUTE statement with %s placeholders for the parameters
+        """
+        execute = self.statements.get(key)
+        if execute is not None:
+            self.statements.move_to_end(key)
+            return execute
+
+        self.counter += 1
+        name = f"{self.prefix}_{self.counter}"
+        cur.execute("PREPARE " + name + " AS " + numbered(sql))
+
+        count = sql.count("%s")
+        execute = "EXECUTE " + name
+        if count:
+            execute += " (" + ", ".join(["%s"] * count) + ")"
+        self.statements[key] = execute
+
+        while len(self.statements) > self.max_statements:
+            _, old = self.statements.popitem(last=False)
+            cur.execute("DEALLOCATE " + old.split()[1])
+        return execute
+
+    def execute(self, cur, key, sql, params=()):
+        """ Runs sql as a prepared statement """
+        cur.execute(self.prepare(cur, key, sql), params)
+
+    def execute_batch(self, cur, key, sql, params_list):
+        """ Runs sql as a prepared statement for every set of parameters, in few round trips """
+        execute_batch(cur, self.prepare(cur, key, sql), params_list)
+
+    def clear(self):
+        """ Forgets all statements, for when the connection has been replaced """
+        self.statements.clear()
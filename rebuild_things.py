@@ -0,0 +1,181 @@
+import os
+import sys
+import argparse
+import datetime
+import psycopg2
+
+from dotenv import load_dotenv
+from column_registry import ColumnRegistry, quote_column
+from attribute_registry import AttributeRegistry
+from things_coalescer import KEY_COLUMNS
+from partition_manager import PartitionManager
+from topic_router import TopicRouter, RAW, STATS, parse_routes
+
+
+STAGING_TABLE = "things_rebuild"
+
+# Lets DISTINCT ON read the newest row per device and topic straight from an index
+HISTORY_INDEX = "mqtt_imei_topic_timestamp"
+
+
+def stage_sql(since):
+    """ Latest payload per (IMEI, lower case topic) since the watermark, into the staging table """
+    where = "WHERE timestamp >= %s " if since is not None else ""
+    return (
+        f"CREATE UNLOGGED TABLE {STAGING_TABLE} AS "
+        f"SELECT DISTINCT ON (imei, lower(topic)) imei, lower(topic) AS name, message, payload, timestamp "
+        f"FROM mqtt {where}ORDER BY imei, lower(topic), timestamp DESC"
+    )
+
+
+def columns_update_sql(names, key_column):
+    """ One UPDATE that writes every staged attribute of a device family, one new row version per device """
+    pivot = ", ".join(
+        f"max(payload) FILTER (WHERE name = '{name}') AS {quote_column(name)}" for name in names
+    )
+    assignments = ", ".join(
+        f"{quote_column(name)} = COALESCE(p.{quote_column(name)}, t.{quote_column(name)})" for name in names
+    )
+    return (
+        f"UPDATE things t SET {assignments} "
+        f"FROM (SELECT imei, {pivot} FROM {STAGING_TABLE} GROUP BY imei) p WHERE t.{key_column} = p.imei"
+    )
+
+
+def jsonb_update_sql(key_column):
+    return (
+        f"UPDATE things t SET attrs = t.attrs || p.attrs "
+        f"FROM (SELECT imei, jsonb_object_agg(name, payload) AS attrs FROM {STAGING_TABLE} GROUP BY imei) p "
+        f"WHERE t.{key_column} = p.imei"
+    )
+
+
+def read_watermark(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        text = f.read().strip()
+    return datetime.datetime.fromisoformat(text) if text else None
+
+
+def write_watermark(path, value):
+    with open(path + ".tmp", "w") as f:
+        f.write(value.isoformat())
+    os.replace(path + ".tmp", path)
+
+
+def create_history_index(conn):
+    """ Creates the (imei, lower(topic), timestamp) index on mqtt, without blocking the writers where possible """
+    partitioned = PartitionManager().is_partitioned(conn.cursor())
+    conn.commit()
+    conn.autocommit = True
+    try:
+        # CREATE INDEX CONCURRENTLY is not supported on a partitioned table
+        concurrently = "" if partitioned else "CONCURRENTLY "
+        conn.cursor().execute(
+            f"CREATE INDEX {concurrently}IF NOT EXISTS {HISTORY_INDEX} ON mqtt (imei, lower(topic), timestamp DESC)"
+        )
+    finally:
+        conn.autocommit = False
+
+
+def rebuild(conn, router, storage="columns", since=None):
+    """ Writes the latest value of every attribute in mqtt since the watermark to things
+
+    The newest row per device and topic is selected with one DISTINCT ON
+    query into an unlogged staging table. Topics the router does not treat
+    as attributes are removed from it, missing columns are created, and
+    each device family is updated with a single UPDATE ... FROM. Only
+    devices that are already in things are updated, as by the writers.
+    Columns that are not TEXT, for example typed by PAYLOAD_TYPES, are
+    left alone, as a payload that does not cast would fail the update.
+
+    Values the writers store while a rebuild runs can be replaced by the
+    slightly older value from the staging table.
+
+    Returns:
+        tuple: (devices updated, newest timestamp staged or None)
+    """
+    cur = conn.cursor()
+    cur.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
+    cur.execute(stage_sql(since), (since,) if since is not None else None)
+    print(f"{datetime.datetime.now()} - Staged {cur.rowcount} latest values")
+    cur.execute(f"SELECT max(timestamp) FROM {STAGING_TABLE}")
+    newest = cur.fetchone()[0]
+
+    registry = AttributeRegistry() if storage == "jsonb" else ColumnRegistry()
+    registry.load(cur)
+    conn.commit()
+
+    # The router works on whole topics, one sample topic per name decides for all devices
+    cur.execute(f"SELECT DISTINCT ON (name) name, message FROM {STAGING_TABLE}")
+    names = []
+    for name, message in cur.fetchall():
+        route = router.route(message)
+        if route is None or route.kind in (RAW, STATS) or registry.column_name(name) is None:
+            continue
+        if storage == "columns" and registry.types.get(name, "text") != "text":
+            print(f"Skipping {name}, its column is {registry.types[name]}")
+            continue
+        names.append(name)
+    cur.execute(f"DELETE FROM {STAGING_TABLE} WHERE NOT (name = ANY(%s))", (names,))
+    conn.commit()
+    print(f"{len(names)} attributes to rebuild")
+
+    if not names:
+        cur.execute(f"DROP TABLE {STAGING_TABLE}")
+        conn.commit()
+        return 0, newest
+
+    # Columns, or view columns, in their own transaction so things is not locked during the updates
+    for name in registry.create(conn, registry.missing(names)):
+        print(f"Created {registry.kind}: {name}")
+
+    updated = 0
+    for key_column in KEY_COLUMNS.values():
+        if storage == "columns":
+            cur.execute(columns_update_sql(sorted(names), key_column))
+        else:
+            cur.execute(jsonb_update_sql(key_column))
+        updated += cur.rowcount
+        print(f"{datetime.datetime.now()} - Updated {cur.rowcount} things rows keyed on {key_column}")
+    cur.execute(f"DROP TABLE {STAGING_TABLE}")
+    conn.commit()
+    return updated, newest
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Rebuilds the attributes in things from the mqtt history")
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat, help="only use mqtt rows from this timestamp on")
+    parser.add_argument("--incremental", action="store_true", help="continue from the watermark of the previous run")
+    parser.add_argument("--watermark-file", default="things_rebuild.watermark")
+    parser.add_argument("--create-index", action="store_true", help=f"create {HISTORY_INDEX} on mqtt first")
+    parser.add_argument("--storage", choices=("columns", "jsonb"), default=os.environ.get("THINGS_STORAGE", "columns"))
+    args = parser.parse_args()
+
+    since = args.since
+    if since is None and args.incremental:
+        since = read_watermark(args.watermark_file)
+    print(f"Rebuilding things from mqtt rows since {since or 'the beginning'}")
+
+    conn = psycopg2.connect(
+        host=os.environ.get('POSTGRES_HOST'),
+        dbname=os.environ.get('POSTGRES_DBNAME'),
+        user=os.environ.get('POSTGRES_USER'),
+        password=os.environ.get('POSTGRES_PASSWORD'),
+        port=os.environ.get('POSTGRES_PORT'),
+    )
+
+    if args.create_index:
+        print(f"Creating index {HISTORY_INDEX}")
+        create_history_index(conn)
+
+    router = TopicRouter(parse_routes(os.environ.get("TOPIC_ROUTES", "")))
+    updated, newest = rebuild(conn, router, args.storage, since)
+    if newest is not None:
+        write_watermark(args.watermark_file, newest)
+        print(f"Watermark is now {newest}")
+    print(f"Done, {updated} things rows updated.")
+    sys.exit(0)
@@ -0,0 +1,190 @@
+import os
+import queue
+import threading
+
+from collections import deque
+from message_codec import encode_message, decode_message, message_size
+
+
+class SpillQueue:
+    """ FIFO queue with a memory budget that overflows to a local file
+
+    Messages are kept in memory until max_memory bytes are in use. Further
+    messages are appended to spill_path, and as long as the file holds
+    messages every new message is appended to it as well, so the order is
+    preserved. The writer replays the file once the in-memory part has been
+    drained, and the file is truncated when it is empty again. Once the
+    part already read back is at least compact_bytes and no smaller than
+    the unread part, the unread part is moved to the start of the file, so
+    a writer that stays slightly behind does not grow it forever. When the
+    file reaches max_spill bytes put() blocks, pushing back on the MQTT client.
+
+    The offset up to which the file has been read back is kept next to it,
+    and set to 0 before the file is truncated or compacted, so a restart
+    replays a spill file left behind by a previous run from that offset;
+    at worst lines that were already read back come again, never fewer.
+    Compaction writes a new file and swaps it in with os.replace.
+
+    The get/put/qsize interface follows queue.Queue.
+    """
+
+    def __init__(self, max_memory, spill_path, max_spill=0, refill_size=1000, compact_bytes=None):
+        self.max_memory = max_memory
+        self.spill_path = spill_path
+        self.offset_path = spill_path + ".offset"
+        self.max_spill = max_spill
+        self.refill_size = refill_size
+        # Half the limit, so a full file is always compacted before the writer has read it all
+        self.compact_bytes = compact_bytes or (max_spill // 2 if max_spill else 64 * 1024 * 1024)
+
+        self.items = deque()
+        self.memory_bytes = 0
+        self.spilled = 0
+        self.spill_bytes = 0
+        self.total_spilled = 0
+
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+        self.writer = open(self.spill_path, "ab")
+        self.reader = open(self.spill_path, "rb")
+        self._recover()
+
+    def _recover(self):
+        # Count the messages a previous run left in the spill file past its read offset
+        # and drop a last line that was cut short when that run died
+        data = self.reader.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            self.writer.truncate(end)
+        offset = self._load_offset()
+        if offset > end or (offset and data[offset - 1:offset] != b"\n"):
+            # Not an offset of this file, replay all of it
+            offset = 0
+        self.spilled = data.count(b"\n", offset, end)
+        self.spill_bytes = end - offset
+        self.reader.seek(offset)
+
+    def _load_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _save_offset(self, offset):
+        temp_path = self.offset_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(str(offset))
+        os.replace(temp_path, self.offset_path)
+
+    def unread(self):
+        """ Yields the messages in the spill file that have not been read back yet, without consuming them """
+        with self.lock:
+            offset = self.reader.tell()
+        with open(self.spill_path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if line.endswith(b"\n"):
+                    yield decode_message(line.decode("utf-8"))
+
+    def qsize(self):
+        with self.lock:
+            return len(self.items) + self.spilled
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def put(self, item, block=True, timeout=None):
+        """ Adds a message, spilling it to disk when the memory budget is used up """
+        size = message_size(item)
+        with self.not_full:
+            if not self.spilled and self.memory_bytes + size <= self.max_memory:
+                self.items.append((item, size))
+                self.memory_bytes += size
+                self.not_empty.notify()
+                return
+
+            line = (encode_message(item) + "\n").encode("utf-8")
+            if self.max_spill:
+                # The size of the file itself, including what has been read back but not compacted away
+                if not block and self.writer.tell() + len(line) > self.max_spill:
+                    raise queue.Full
+                if not self.not_full.wait_for(lambda: self.writer.tell() + len(line) <= self.max_spill or not self.spilled, timeout):
+                    raise queue.Full
+
+            self.writer.write(line)
+            self.writer.flush()
+            self.spilled += 1
+            self.spill_bytes += len(line)
+            self.total_spilled += 1
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        """ Removes and returns the oldest message, raises queue.Empty like queue.Queue """
+        with self.not_empty:
+            if not self.items and not self.spilled:
+                if not block:
+                    raise queue.Empty
+                if not self.not_empty.wait_for(lambda: self.items or self.spilled, timeout):
+                    raise queue.Empty
+
+            if not self.items:
+                self._refill()
+
+            item, size = self.items.popleft()
+            self.memory_bytes -= size
+            return item
+
+    def _refill(self):
+        # Replay the next run of spilled messages in the order they were written
+        for _ in range(self.refill_size):
+            if self.items and self.memory_bytes >= self.max_memory:
+                break
+            line = self.reader.readline()
+            if not line:
+                break
+            self.spilled -= 1
+            self.spill_bytes -= len(line)
+            item = decode_message(line.decode("utf-8"))
+            size = message_size(item)
+            self.items.append((item, size))
+            self.memory_bytes += size
+
+        if not self.spilled:
+            # Everything has been replayed, start over with an empty file
+            self._save_offset(0)
+            self.writer.truncate(0)
+            self.reader.seek(0)
+            self.spill_bytes = 0
+        elif self.reader.tell() >= self.compact_bytes and self.reader.tell() >= self.spill_bytes:
+            self._compact()
+        else:
+            self._save_offset(self.reader.tell())
+        self.not_full.notify_all()
+
+    def _compact(self):
+        # Copy the unread messages to a new file and swap it in. The offset goes back to 0
+        # first, so a crash before the swap replays the old file from its start.
+        self._save_offset(0)
+        temp_path = self.spill_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            while True:
+                chunk = self.reader.read(1024 * 1024)
+                if not chunk:
+                    break
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        self.writer.close()
+        self.reader.close()
+        os.replace(temp_path, self.spill_path)
+        self.writer = open(self.spill_path, "ab")
+        self.reader = open(self.spill_path, "rb")
+
+    def close(self):
+        with self.lock:
+            self._save_offset(self.reader.tell())
+            self.writer.close()
+            self.reader.close()
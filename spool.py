@@ -0,0 +1,206 @@
+import os
+import time
+import threading
+
+from collections import deque
+from message_codec import encode_message, decode_message
+
+
+class WriteAheadSpool:
+    """ Segmented local log of received messages that are not yet committed
+
+    Every message is appended to the current segment before it is queued for
+    the writer and gets the next sequence number. Appends are only buffered;
+    a background thread flushes and fsyncs the segment every fsync_interval
+    seconds, so a burst of messages shares one fsync. After a database commit
+    the writer calls commit() with the number of messages it has finished,
+    which advances the committed offset and removes segments that are fully
+    committed. Messages past the committed offset are returned by
+    uncommitted() so they can be replayed at startup.
+
+    Each message is appended for a shard, the writer worker that will handle
+    it. A worker finishes its own messages in order, so it acknowledges by
+    count; the committed offset is the oldest sequence number that any shard
+    still has outstanding.
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync_interval=0.05):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        # Outstanding sequence numbers per shard, oldest first
+        self.pending = {}
+        # Sequence number replay has reached, nothing from there on may be committed yet
+        self.replay_floor = None
+        self.dirty = False
+        self.closed = False
+
+        self.committed = self._read_offset()
+        # Sorted list of (first sequence number, path)
+        self.segments = self._recover_segments()
+        if self.segments:
+            first, path = self.segments[-1]
+            self.next_seq = first + self._count_lines(path)
+        else:
+            self.next_seq = self.committed
+        if self.committed > self.next_seq:
+            # The offset got ahead of the log, nothing is left to replay
+            self.committed = self.next_seq
+
+        self._open_segment(self.next_seq)
+
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def _offset_path(self):
+        return os.path.join(self.directory, "committed")
+
+    def _segment_path(self, first):
+        return os.path.join(self.directory, "%020d.log" % first)
+
+    def _read_offset(self):
+        try:
+            with open(self._offset_path()) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset):
+        tmp = self._offset_path() + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(offset))
+        os.replace(tmp, self._offset_path())
+
+    def _count_lines(self, path):
+        with open(path, "rb") as f:
+            return f.read().count(b"\n")
+
+    def _recover_segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".log"):
+                segments.append((int(name[:-4]), os.path.join(self.directory, name)))
+        segments.sort()
+
+        if segments:
+            # Drop a last record that was cut short when the previous run died
+            path = segments[-1][1]
+            with open(path, "rb+") as f:
+                data = f.read()
+                end = data.rfind(b"\n") + 1
+                if end < len(data):
+                    f.truncate(end)
+        return segments
+
+    def _open_segment(self, first):
+        path = self._segment_path(first)
+        if not self.segments or self.segments[-1][1] != path:
+            self.segments.append((first, path))
+        self.segment = open(path, "ab")
+        self.segment_size = self.segment.tell()
+
+    def append(self, message, shard=0):
+        """ Appends a message to the log
+
+        Args:
+            message tuple: (timestamp, imei, topic, payload, crc)
+            shard int: writer worker that will handle the message
+
+        Returns:
+            int: sequence number of the message
+        """
+        line = (encode_message(message) + "\n").encode("utf-8")
+        with self.lock:
+            if self.segment_size >= self.segment_bytes:
+                self._sync()
+                self.segment.close()
+                self._open_segment(self.next_seq)
+            self.segment.write(line)
+            self.segment_size += len(line)
+            self.dirty = True
+            seq = self.next_seq
+            self.next_seq += 1
+            self.pending.setdefault(shard, deque()).append(seq)
+            return seq
+
+    def track(self, seq, shard=0):
+        """ Assigns a replayed message to the shard that will handle it """
+        with self.lock:
+            self.pending.setdefault(shard, deque()).append(seq)
+
+    def _sync(self):
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.dirty = False
+
+    def _flush_loop(self):
+        while not self.closed:
+            time.sleep(self.fsync_interval)
+            with self.lock:
+                if self.dirty and not self.closed:
+                    self._sync()
+
+    def commit(self, count, shard=0):
+        """ Marks the next count messages of a shard as committed to the database """
+        if count <= 0:
+            return
+        with self.lock:
+            outstanding = self.pending.get(shard)
+            for _ in range(min(count, len(outstanding or ()))):
+                outstanding.popleft()
+
+            oldest = [seqs[0] for seqs in self.pending.values() if seqs]
+            if self.replay_floor is not None:
+                oldest.append(self.replay_floor)
+            committed = min(oldest) if oldest else self.next_seq
+            if committed <= self.committed:
+                return
+            self.committed = committed
+            self._write_offset(self.committed)
+
+            # Remove segments whose messages have all been committed
+            while len(self.segments) > 1 and self.segments[1][0] <= self.committed:
+                _, path = self.segments.pop(0)
+                os.remove(path)
+
+    def uncommitted(self):
+        """ Yields (sequence number, message) after the committed offset, oldest first """
+        with self.lock:
+            self._sync()
+            segments = list(self.segments)
+            committed = self.committed
+
+        try:
+            for first, path in segments:
+                with open(path, "rb") as f:
+                    for seq, line in enumerate(f, start=first):
+                        if seq >= committed:
+                            with self.lock:
+                                self.replay_floor = seq
+                            yield seq, decode_message(line.decode("utf-8"))
+        finally:
+            with self.lock:
+                self.replay_floor = None
+
+    def close(self, timeout=-1):
+        """ Syncs and closes the segment
+
+        Args:
+            timeout float: seconds to wait for the lock, forever when negative
+
+        Returns:
+            bool: False when the lock could not be had in time and nothing was done
+        """
+        if not self.lock.acquire(timeout=timeout):
+            return False
+        try:
+            if not self.closed:
+                self._sync()
+                self.segment.close()
+                self.closed = True
+            return True
+        finally:
+            self.lock.release()
@@ -0,0 +1,166 @@
+import re
+import json
+import time
+import datetime
+
+from collections import Counter, OrderedDict
+from psycopg2.extras import execute_batch
+
+
+CREATE_TABLES = (
+    "CREATE TABLE IF NOT EXISTS mqttstats_rollup ("
+    "imei TEXT NOT NULL, minute TIMESTAMP NOT NULL, field TEXT NOT NULL, samples BIGINT NOT NULL, "
+    "sum DOUBLE PRECISION NOT NULL, min DOUBLE PRECISION NOT NULL, max DOUBLE PRECISION NOT NULL, "
+    "last DOUBLE PRECISION NOT NULL, PRIMARY KEY (imei, minute, field))",
+    "CREATE INDEX IF NOT EXISTS mqttstats_rollup_minute ON mqttstats_rollup (minute)",
+)
+
+# A row that already exists, from an earlier flush of the same minute, is merged
+UPSERT_ROLLUP = (
+    "INSERT INTO mqttstats_rollup (imei, minute, field, samples, sum, min, max, last) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s) "
+    "ON CONFLICT (imei, minute, field) DO UPDATE SET samples = mqttstats_rollup.samples + EXCLUDED.samples, "
+    "sum = mqttstats_rollup.sum + EXCLUDED.sum, min = LEAST(mqttstats_rollup.min, EXCLUDED.min), "
+    "max = GREATEST(mqttstats_rollup.max, EXCLUDED.max), last = EXCLUDED.last"
+)
+
+# key=value pairs separated by commas, semicolons or white space
+KEY_VALUE = re.compile(r"([A-Za-z_][\w.]*)\s*[=:]\s*(-?[0-9]+(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?)")
+
+
+def flatten(data, prefix=""):
+    """ Yields (field, number) for the numbers of a decoded JSON object, nested keys joined with dots """
+    for key, value in data.items():
+        field = prefix + str(key)
+        if isinstance(value, dict):
+            yield from flatten(value, field + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield field, float(value)
+
+
+def parse_stats(payload):
+    """ Reads the numeric fields of a mqttstats payload
+
+    Accepted are a JSON object, whose numeric values are used, a single
+    number, stored as field "value", and "key=value" pairs.
+
+    Returns:
+        dict: field to number, empty when nothing could be read
+    """
+    text = payload.strip()
+    if text[:1] == "{":
+        try:
+            return dict(flatten(json.loads(text)))
+        except ValueError:
+            return {}
+    try:
+        return {"value": float(text)}
+    except ValueError:
+        pass
+    return {key: float(value) for key, value in KEY_VALUE.findall(text)}
+
+
+class StatsRollup:
+    """ Per-device, per-minute counters of mqttstats messages
+
+    Every numeric field of a stats payload adds to the counters of its
+    device, minute and field: samples, sum, min, max and the last value.
+    When window seconds have passed since the first pending message, the
+    counters are upserted into mqttstats_rollup with one execute_batch, and
+    a minute that spans several flushes is merged by the upsert. Payloads
+    without numbers are counted per IMEI.
+
+    With the raw rows dropped, the rollup is the only copy of a stats
+    message; a spool replay after a crash counts the replayed messages again.
+
+    Args:
+        window float: seconds counters are kept before they are flushed
+        bucket int: seconds per rollup row
+    """
+
+    def __init__(self, window=60, bucket=60):
+        self.window = window
+        self.bucket = bucket
+        self.counters = OrderedDict()
+        self.messages = 0
+        self.started = None
+        self.failures = Counter()
+
+    def __len__(self):
+        return self.messages
+
+    def add(self, imei, payload, recorded):
+        """ Adds a payload received at recorded, returns False when it holds no numbers """
+        fields = parse_stats(payload)
+        if not fields:
+            self.failures[imei] += 1
+            return False
+
+        if not self.messages:
+            self.started = time.monotonic()
+        self.messages += 1
+        minute = datetime.datetime.fromtimestamp(int(recorded.timestamp()) // self.bucket * self.bucket)
+        for field, value in fields.items():
+            key = (imei, minute, field)
+            counter = self.counters.get(key)
+            if counter is None:
+                self.counters[key] = [1, value, value, value, value]
+            else:
+                counter[0] += 1
+                counter[1] += value
+                counter[2] = min(counter[2], value)
+                counter[3] = max(counter[3], value)
+                counter[4] = value
+        return True
+
+    def age(self):
+        if self.started is None:
+            return 0.0
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        """ Seconds until the counters are due, None when nothing is pending """
+        if not self.messages:
+            return None
+        return self.window - self.age()
+
+    def is_due(self):
+        return bool(self.messages) and self.age() >= self.window
+
+    def statements(self):
+        """ Yields (key, sql, [params, ...]) for the pending counters """
+        if self.counters:
+            yield ("stats_rollup",), UPSERT_ROLLUP, [key + tuple(counter) for key, counter in self.counters.items()]
+
+    def clear(self):
+        self.counters = OrderedDict()
+        self.messages = 0
+        self.started = None
+
+    def flush(self, cur, prepared=None):
+        """ Writes the pending counters, the caller commits
+
+        Returns:
+            int: number of messages rolled up
+        """
+        for key, sql, params in self.statements():
+            if prepared is not None:
+                prepared.execute_batch(cur, key, sql, params)
+            else:
+                execute_batch(cur, sql, params)
+        count = self.messages
+        self.clear()
+        return count
+
+    def take_failures(self):
+        """ Returns and resets the number of payloads without numbers per IMEI """
+        failures, self.failures = self.failures, Counter()
+        return failures
+
+
+def create_tables(conn):
+    """ Creates the rollup table when it does not exist, and commits """
+    cur = conn.cursor()
+    for statement in CREATE_TABLES:
+        cur.execute(statement)
+    conn.commit()
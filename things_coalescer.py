@@ -0,0 +1,177 @@
+import json
+import time
+
+from collections import OrderedDict
+from psycopg2.extras import execute_batch
+from column_registry import quote_column
+
+
+# Column that identifies the row in things for each device family
+KEY_COLUMNS = {"old": "swd_imei", "swx": "imei"}
+
+# "columns" stores every attribute in its own things column, "jsonb" merges
+# them into things.attrs
+STORAGE_MODES = ("columns", "jsonb")
+
+# Column types, by information_schema data_type, that values are cast to in the UPDATE
+CAST_TYPES = {"text", "bigint", "double precision", "boolean", "jsonb"}
+
+
+def column_value(value, data_type=None):
+    """ Decoded JSON payloads go to their column as JSON text, any value goes to a text column as text """
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if data_type == "text" and not isinstance(value, str):
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        return str(value)
+    return value
+
+
+def column_cast(data_type):
+    return "::" + data_type if data_type in CAST_TYPES else ""
+
+
+class ThingsCoalescer:
+    """ Accumulates things attribute updates and writes them per device
+
+    Values are kept last-write-wins per (IMEI, column). When the window has
+    elapsed, or max_devices devices are pending, each device gets a single
+    multi-column UPDATE. Devices that changed the same set of columns are sent
+    together with execute_batch, so a flush costs a handful of round trips.
+
+    With storage "jsonb" the values are merged into things.attrs with
+    jsonb_build_object instead, and devices are grouped by the number of
+    attributes they changed, whatever their names.
+    """
+
+    def __init__(self, window=1.0, max_devices=5000, storage="columns"):
+        if storage not in STORAGE_MODES:
+            raise ValueError(f"Unknown things storage: {storage}")
+        self.storage = storage
+        self.window = window
+        self.max_devices = max_devices
+        self.pending = OrderedDict()
+        self.started = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, device_type, imei, column, value):
+        """ Records the latest value of one attribute of a device
+
+        Args:
+            device_type string: "old" or "swx"
+            imei string: imei of thing
+            column string: things column, as returned by ColumnRegistry.column_name
+            value: payload, or its value from PayloadDecoder
+        """
+        if not self.pending:
+            self.started = time.monotonic()
+        key = (device_type, imei)
+        columns = self.pending.get(key)
+        if columns is None:
+            columns = self.pending[key] = {}
+        columns[column] = value
+
+    def columns(self):
+        """ Set of all columns that have pending values """
+        names = set()
+        for columns in self.pending.values():
+            names.update(columns)
+        return names
+
+    def age(self):
+        if self.started is None:
+            return 0.0
+        return time.monotonic() - self.started
+
+    def is_due(self):
+        """ True when the window has elapsed or too many devices are pending """
+        if not self.pending:
+            return False
+        return len(self.pending) >= self.max_devices or self.age() >= self.window
+
+    def clear(self):
+        self.pending = OrderedDict()
+        self.started = None
+
+    def statements(self, types=None):
+        """ Groups the pending updates into (key, sql, [params, ...]) tuples
+
+        The key identifies the statement by device family, column set and
+        column types. With types, {column: information_schema data_type},
+        the values are cast to the type of their column, so a statement
+        prepared before a column changed type is not used for it anymore.
+        """
+        if self.storage == "jsonb":
+            yield from self.jsonb_statements()
+            return
+
+        types = types or {}
+        groups = OrderedDict()
+        for (device_type, imei), columns in self.pending.items():
+            names = tuple(sorted(columns))
+            group = groups.get((device_type, names))
+            if group is None:
+                group = groups[(device_type, names)] = []
+            group.append(tuple(column_value(columns[name], types.get(name)) for name in names) + (imei,))
+
+        for (device_type, names), params in groups.items():
+            casts = tuple(column_cast(types.get(name)) for name in names)
+            assignments = ", ".join(quote_column(name) + " = %s" + cast for name, cast in zip(names, casts))
+            sql = "UPDATE things SET " + assignments + ", lastupdated = NOW() WHERE " + KEY_COLUMNS[device_type] + " = %s"
+            yield ("things_update", device_type, names, casts), sql, params
+
+    def jsonb_statements(self):
+        """ Same as statements(), for attributes merged into things.attrs
+
+        The attribute names are parameters too, so the key only holds the
+        device family and the number of attributes. Values are sent as JSON,
+        so decoded numbers, booleans and objects keep their JSON type.
+        """
+        groups = OrderedDict()
+        for (device_type, imei), columns in self.pending.items():
+            group = groups.get((device_type, len(columns)))
+            if group is None:
+                group = groups[(device_type, len(columns))] = []
+            params = []
+            for name in sorted(columns):
+                params += [name, json.dumps(columns[name])]
+            group.append(tuple(params) + (imei,))
+
+        for (device_type, count), params in groups.items():
+            pairs = ", ".join(["%s::text, %s::jsonb"] * count)
+            sql = "UPDATE things SET attrs = attrs || jsonb_build_object(" + pairs + "), lastupdated = NOW() WHERE " + KEY_COLUMNS[device_type] + " = %s"
+            yield ("things_attrs", device_type, count), sql, params
+
+    def flush(self, cur, debug=False, prepared=None, types=None):
+        """ Writes all pending updates
+
+        Pending values are only discarded once every statement has been
+        executed, so a failed flush can be retried after a rollback. The
+        caller is responsible for committing the transaction.
+
+        Args:
+            cur: psycopg2 cursor
+            debug bool: print the statements instead of executing them
+            prepared PreparedStatements: run the updates as prepared statements of this connection
+            types dict: information_schema data_type per column, see statements()
+
+        Returns:
+            int: number of devices updated
+        """
+        if not self.pending:
+            return 0
+
+        for key, sql, params in self.statements(types):
+            if debug:
+                print(sql, params)
+            elif prepared is not None:
+                prepared.execute_batch(cur, key, sql, params)
+            else:
+                execute_batch(cur, sql, params)
+
+        count = len(self.pending)
+        self.clear()
+        return count
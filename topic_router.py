@@ -0,0 +1,120 @@
+from collections import namedtuple
+
+
+# What the writer does with a message, besides storing it in mqtt
+RAW = "raw"
+ATTRIBUTE = "attribute"
+LOCATION = "location"
+CONNECTION = "connection"
+STATS = "stats"
+KINDS = (RAW, ATTRIBUTE, LOCATION, CONNECTION, STATS)
+
+# Kind of a topic by its attribute, the last segment, whatever the depth of
+# the topic. Whole segments are compared, so "connect" does not match
+# "connection" or "disconnect".
+LAST_SEGMENT_KINDS = {
+    "connect": CONNECTION,
+    "connection": CONNECTION,
+    "disconnect": CONNECTION,
+    "location": LOCATION,
+    "mqttstats": STATS,
+}
+
+Route = namedtuple("Route", "kind imei attribute")
+
+
+def parse_routes(text):
+    """ Parses "filter=kind,filter=kind" as used by TOPIC_ROUTES
+
+    Returns:
+        list: (filter, kind) tuples
+    """
+    routes = []
+    for entry in (text or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        pattern, _, kind = entry.partition("=")
+        routes.append((pattern.strip(), kind.strip()))
+    return routes
+
+
+class TopicRouter:
+    """ Maps a topic to its handler kind, IMEI and attribute in one pass
+
+    Routes are MQTT topic filters, "+" matches one segment and "#" the rest
+    of the topic, compiled into a segment trie when the router is built.
+    A topic is split once and walked down the trie; an exact segment wins
+    over "+", which wins over "#". Topics no route matches get the kind of
+    their last segment from last_segment_kinds, and are attributes
+    otherwise.
+    Results are cached per topic, as a device publishes the same handful of
+    topics over and over and the writers route every message again.
+
+    Args:
+        routes: (filter, kind) tuples, later routes replace earlier ones with the same filter
+        last_segment_kinds dict: kind by last segment, for topics no route matches
+        default string: kind of the other topics
+        imei_segment int: position of the IMEI in the topic
+        cache_size int: topics kept in the cache before it is emptied
+    """
+
+    def __init__(self, routes=(), last_segment_kinds=LAST_SEGMENT_KINDS, default=ATTRIBUTE, imei_segment=1, cache_size=100000):
+        if default not in KINDS:
+            raise ValueError(f"Unknown topic kind: {default}")
+        self.last_segment_kinds = dict(last_segment_kinds)
+        self.default = default
+        self.imei_segment = imei_segment
+        self.cache_size = cache_size
+        self.cache = {}
+        self.root = {}
+        for pattern, kind in routes:
+            self.add(pattern, kind)
+
+    def add(self, pattern, kind):
+        """ Adds a route, the kind is stored under the None key of the node of its last segment """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown topic kind for {pattern}: {kind}")
+        node = self.root
+        for segment in pattern.split("/"):
+            node = node.setdefault(segment, {})
+        node[None] = kind
+        self.cache = {}
+
+    def match(self, node, segments, i=0):
+        """ Returns the kind of the most specific route below node for segments[i:], or None """
+        if i == len(segments):
+            kind = node.get(None)
+            if kind is None and "#" in node:
+                # "a/#" also matches "a"
+                kind = node["#"].get(None)
+            return kind
+
+        for key in (segments[i], "+"):
+            child = node.get(key)
+            if child is not None:
+                kind = self.match(child, segments, i + 1)
+                if kind is not None:
+                    return kind
+
+        child = node.get("#")
+        if child is not None:
+            return child.get(None)
+        return None
+
+    def route(self, topic):
+        """ Returns the Route of a topic, or None when it has no IMEI segment """
+        route = self.cache.get(topic)
+        if route is not None:
+            return route
+
+        segments = topic.split("/")
+        if len(segments) <= self.imei_segment:
+            return None
+        kind = self.match(self.root, segments) or self.last_segment_kinds.get(segments[-1], self.default)
+        route = Route(kind, segments[self.imei_segment], segments[-1])
+
+        if len(self.cache) >= self.cache_size:
+            self.cache = {}
+        self.cache[topic] = route
+        return route
@@ -0,0 +1,50 @@
+import zlib
+import threading
+
+
+def shard_for(imei, size):
+    """ Index of the worker, out of size, that handles an IMEI """
+    # crc32 rather than hash() so the mapping is the same in every run
+    return zlib.crc32(imei.encode("utf-8")) % size
+
+
+class WriterPool:
+    """ Set of writer workers, each with its own queue
+
+    Messages are routed to a worker by a hash of the IMEI, so all messages of
+    a device are written by the same worker, in the order they arrived.
+
+    Args:
+        size int: number of workers
+        make_queue: called with the worker index, returns that worker's queue
+    """
+
+    def __init__(self, size, make_queue):
+        self.queues = [make_queue(worker) for worker in range(size)]
+        self.threads = []
+        # Seconds each worker spent waiting for messages and handling them
+        self.idle = [0.0] * size
+        self.busy = [0.0] * size
+
+    def __len__(self):
+        return len(self.queues)
+
+    def shard(self, imei):
+        """ Index of the worker that handles an IMEI """
+        return shard_for(imei, len(self.queues))
+
+    def put(self, message, shard=None):
+        """ Queues a message for the worker that owns its IMEI """
+        if shard is None:
+            shard = self.shard(message[1])
+        self.queues[shard].put(message)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def start(self, target):
+        """ Starts one daemon thread per worker running target(worker, queue) """
+        for worker, write_queue in enumerate(self.queues):
+            thread = threading.Thread(target=target, args=(worker, write_queue), name=f"writer-{worker}", daemon=True)
+            thread.start()
+            self.threads.append(thread)